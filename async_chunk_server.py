@@ -0,0 +1,304 @@
+"""
+Asyncio Front End for the Chunk Server
+
+Serves a ChunkServer from a single event loop instead of one thread per
+connection. Connections are multiplexed by asyncio, blocking file I/O runs in a
+bounded thread pool, and responses are only written as fast as each client
+reads them, so one process can keep tens of thousands of connections open.
+"""
+
+import asyncio
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+import protocol
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Threads running blocking file I/O
+DEFAULT_MAX_WORKERS = 32
+# Threads copying whole files that are sent while their read lock is held
+DEFAULT_READ_WORKERS = 4
+# Requests being processed at once across all connections
+DEFAULT_MAX_PENDING_REQUESTS = 1024
+# Pending connections queued by the kernel before accept
+DEFAULT_BACKLOG = 4096
+# Buffered response bytes per connection before the server waits for the client
+DEFAULT_WRITE_BUFFER_LIMIT = 4 * 1024 * 1024
+
+
+class AsyncChunkServer:
+    """
+    Event loop server with the same request semantics as ChunkServer.handle_client
+
+    This class:
+    - Accepts connections on the chunk server's listening socket
+    - Reads request frames without blocking and runs them in a bounded executor
+    - Applies backpressure to slow clients through writer.drain()
+    - Closes idle connections after the chunk server timeout
+    """
+
+    def __init__(self, chunk_server, max_workers=DEFAULT_MAX_WORKERS,
+                 max_pending_requests=DEFAULT_MAX_PENDING_REQUESTS, backlog=DEFAULT_BACKLOG,
+                 write_buffer_limit=DEFAULT_WRITE_BUFFER_LIMIT):
+        """
+        Initialize the asyncio front end
+
+        Args:
+            chunk_server (ChunkServer): Chunk server whose requests are served
+            max_workers (int): Threads used for blocking file I/O
+            max_pending_requests (int): Requests processed at once across all connections
+            backlog (int): Listen backlog of the server socket
+            write_buffer_limit (int): Buffered bytes per connection before writes wait
+        """
+        self.chunk_server = chunk_server
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chunk-io")
+        # Reads done while a read lock is held, kept out of executor where they
+        # could queue behind writers waiting for that same lock
+        self.read_executor = ThreadPoolExecutor(max_workers=DEFAULT_READ_WORKERS, thread_name_prefix="chunk-read")
+        self.max_pending_requests = max_pending_requests
+        self.backlog = backlog
+        self.write_buffer_limit = write_buffer_limit
+        self.pending_requests = None  # Created inside the event loop
+        self.connection_count = 0
+
+    @staticmethod
+    def raise_file_descriptor_limit():
+        """
+        Raise the open file limit to the hard limit, every connection uses one descriptor
+        """
+        if resource is None:
+            return
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            print(f"Open file limit raised from {soft} to {hard}")
+
+    async def run_blocking(self, function, *args):
+        """
+        Run a blocking chunk server method in the I/O executor
+
+        Args:
+            function: Method to call
+            *args: Method arguments
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve the requests of one client connection until it is closed
+
+        Args:
+            reader (asyncio.StreamReader): Incoming stream
+            writer (asyncio.StreamWriter): Outgoing stream
+        """
+        chunk_server = self.chunk_server
+        writer.transport.set_write_buffer_limits(high=self.write_buffer_limit)
+        # asyncio only disables Nagle's algorithm on sockets it created itself,
+        # without this a header and payload written separately wait for a delayed ACK
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connection_count += 1
+
+        try:
+            while True:
+                # Idle connections are closed after the chunk server timeout
+                frame = await asyncio.wait_for(protocol.read_frame(reader), timeout=chunk_server.timeout)
+                if frame is None:
+                    break  # Client closed the connection
+                opcode, request_id, payload = frame
+
+                async with self.pending_requests:
+                    with chunk_server.request_in_flight():
+                        if opcode in (protocol.READ_FILE, protocol.READ_RANGE, protocol.READ_CHUNK):
+                            # Zero-copy read, the response is written by send_file_region
+                            response_opcode, region = await self.run_blocking(
+                                chunk_server.open_read_request, opcode, payload
+                            )
+                            await self.send_file_region(writer, request_id, response_opcode, region)
+                            continue
+                        elif opcode == protocol.PUSH_CHUNK:
+                            # Chunk data follows the request on the same connection
+                            response_opcode, response_payload = await self.receive_pushed_chunk(reader, request_id, payload)
+                        elif opcode == protocol.WRITE_FILE_STREAM:
+                            # File content follows the request on the same connection
+                            response_opcode, response_payload = await self.receive_streamed_file(reader, request_id, payload)
+                        else:
+                            response_opcode, response_payload = await self.run_blocking(
+                                chunk_server.handle_request, opcode, payload
+                            )
+
+                protocol.write_frame(writer, response_opcode, request_id, response_payload)
+                # Wait until a slow client has read enough of the response
+                await writer.drain()
+
+        except asyncio.TimeoutError:
+            print(f"Closing idle connection to Chunk Server {chunk_server.chunk_server_id}")
+
+        except (ConnectionError, protocol.ProtocolError) as e:
+            print(f"Connection to Chunk Server {chunk_server.chunk_server_id} lost: {e}")
+
+        except Exception as e:
+            print(f"Error handling client request: {e}")
+
+        finally:
+            self.connection_count -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def send_file_region(self, writer, request_id, response_opcode, region):
+        """
+        Asyncio counterpart of ChunkServer.send_file_region using loop.sendfile()
+
+        A whole file is sent while its read lock is held, so a client that does
+        not read it within the chunk server timeout is disconnected and the lock
+        released, instead of holding back every writer of the file.
+
+        Args:
+            writer (asyncio.StreamWriter): Stream of the requesting connection
+            request_id (int): Id of the request being answered
+            response_opcode (int): Response opcode
+            region (tuple): (file, offset, count, release) from open_read_request, a memoryview, or None
+        """
+        if region is None:
+            protocol.write_frame(writer, response_opcode, request_id)
+            await writer.drain()
+            return
+
+        if isinstance(region, memoryview):
+            # Content from the block cache
+            protocol.write_frame(writer, response_opcode, request_id, region)
+            await writer.drain()
+            self.chunk_server.record_io(bytes_read=len(region))
+            return
+
+        region_file, offset, count, release = region
+        loop = asyncio.get_running_loop()
+        try:
+            writer.write(protocol.pack_header(response_opcode, request_id, count))
+            if release is None:
+                await writer.drain()
+                if count:
+                    await loop.sendfile(writer.transport, region_file, offset, count)
+            else:
+                # Written in place: the bytes must be copied out before the lock is released
+                await self.drain_holding_lock(writer)
+                for position in range(offset, offset + count, protocol.DATA_PART_SIZE):
+                    part_size = min(protocol.DATA_PART_SIZE, offset + count - position)
+                    part = await loop.run_in_executor(
+                        self.read_executor, os.pread, region_file.fileno(), part_size, position
+                    )
+                    writer.write(part)
+                    await self.drain_holding_lock(writer)
+        finally:
+            region_file.close()
+            if release is not None:
+                release()
+        self.chunk_server.record_io(bytes_read=count)
+
+    async def drain_holding_lock(self, writer):
+        """
+        Wait for a client to read a response sent while a lock is held
+
+        Args:
+            writer (asyncio.StreamWriter): Stream of the requesting connection
+
+        Raises:
+            ConnectionError: If the client did not read it within the chunk server timeout,
+                             the connection is then dropped
+        """
+        try:
+            await asyncio.wait_for(writer.drain(), self.chunk_server.timeout)
+        except asyncio.TimeoutError:
+            writer.transport.abort()
+            raise ConnectionError(f"Client did not read the response within {self.chunk_server.timeout}s")
+
+    async def receive_pushed_chunk(self, reader, request_id, payload):
+        """
+        Asyncio counterpart of ChunkServer.receive_pushed_chunk
+
+        Parts are read from the event loop, forwarding and disk writes run in
+        the executor one part at a time.
+
+        Args:
+            reader (asyncio.StreamReader): Stream the chunk data is received on
+            request_id (int): Id of the PUSH_CHUNK request
+            payload (bytes): PUSH_CHUNK request payload
+        """
+        chunk_server = self.chunk_server
+        push = await self.run_blocking(chunk_server.begin_pushed_chunk, request_id, payload)
+        try:
+            while push['received'] < push['chunk_length']:
+                part = await self.receive_data_part(reader, request_id)
+                await self.run_blocking(chunk_server.write_pushed_part, push, part)
+        except (OSError, protocol.ProtocolError) as e:
+            print(f"Error receiving chunk {push['chunk_handle']}: {e}")
+            await self.run_blocking(chunk_server.abort_pushed_chunk, push)
+            return protocol.REPLICATION_ERROR, b""
+        return await self.run_blocking(chunk_server.finish_pushed_chunk, push)
+
+    async def receive_data_part(self, reader, request_id):
+        """
+        Asyncio counterpart of protocol.recv_data_part
+
+        Args:
+            reader (asyncio.StreamReader): Stream the data is received on
+            request_id (int): Id of the request the data belongs to
+        """
+        frame = await protocol.read_frame(reader)
+        if frame is None:
+            raise protocol.ProtocolError("Connection closed while receiving data")
+        opcode, part_request_id, part = frame
+        if opcode != protocol.DATA_PART or part_request_id != request_id:
+            raise protocol.ProtocolError(f"Expected DATA_PART for request {request_id}")
+        return part
+
+    async def receive_streamed_file(self, reader, request_id, payload):
+        """
+        Asyncio counterpart of ChunkServer.receive_streamed_file
+
+        Args:
+            reader (asyncio.StreamReader): Stream the file content is received on
+            request_id (int): Id of the WRITE_FILE_STREAM request
+            payload (bytes): WRITE_FILE_STREAM request payload
+        """
+        chunk_server = self.chunk_server
+        upload = await self.run_blocking(chunk_server.begin_streamed_file, payload)
+        try:
+            while upload['received'] < upload['length']:
+                part = await self.receive_data_part(reader, request_id)
+                await self.run_blocking(chunk_server.write_streamed_part, upload, part)
+        except BaseException:
+            await self.run_blocking(chunk_server.abort_streamed_file, upload)
+            raise
+        return await self.run_blocking(chunk_server.finish_streamed_file, upload)
+
+    async def serve(self):
+        """
+        Accept connections on the chunk server socket until cancelled
+        """
+        self.pending_requests = asyncio.Semaphore(self.max_pending_requests)
+        self.raise_file_descriptor_limit()
+        server = await asyncio.start_server(
+            self.handle_connection, sock=self.chunk_server.server_socket, backlog=self.backlog
+        )
+        print(f"Chunk Server {self.chunk_server.chunk_server_id} serving in asyncio mode")
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        """
+        Run the event loop, this method blocks forever
+        """
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=False)
+            self.read_executor.shutdown(wait=False)
@@ -0,0 +1,144 @@
+"""
+Asyncio Front End for the Master Server
+
+Serves a Main_Server from a single event loop. Every connection is persistent
+and multiplexed: a client may send several requests without waiting, each one
+is dispatched to a small fixed pool of metadata workers and its response is
+written as soon as it is ready, tagged with the request id.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import protocol
+
+# Metadata operations are short and lock protected, a few workers are enough
+DEFAULT_MAX_WORKERS = 4
+# Requests being processed at once across all connections
+DEFAULT_MAX_PENDING_REQUESTS = 4096
+# Pending connections queued by the kernel before accept
+DEFAULT_BACKLOG = 4096
+
+
+class AsyncMasterServer:
+    """
+    Event driven front end with the same request semantics as Main_Server.handle_client
+
+    This class:
+    - Accepts connections with a large listen backlog
+    - Reads request frames from every connection without blocking
+    - Runs metadata operations on a fixed size worker pool
+    - Sends responses out of order, matched to requests by request id
+    """
+
+    def __init__(self, master_server, max_workers=DEFAULT_MAX_WORKERS,
+                 max_pending_requests=DEFAULT_MAX_PENDING_REQUESTS, backlog=DEFAULT_BACKLOG):
+        """
+        Initialize the asyncio front end
+
+        Args:
+            master_server (Main_Server): Master server whose requests are served
+            max_workers (int): Threads running metadata operations
+            max_pending_requests (int): Requests processed at once across all connections
+            backlog (int): Listen backlog of the server socket
+        """
+        self.master_server = master_server
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="master-worker")
+        # Heartbeats never wait behind metadata operations, a late one fails its chunk server
+        self.heartbeat_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="master-heartbeat")
+        self.max_pending_requests = max_pending_requests
+        self.backlog = backlog
+        self.pending_requests = None  # Created inside the event loop
+
+    async def handle_request(self, writer, opcode, request_id, payload):
+        """
+        Run one request on the worker pool and send its response
+
+        Heartbeats run on their own thread and do not count against
+        max_pending_requests, there is at most one per chunk server.
+
+        Args:
+            writer (asyncio.StreamWriter): Stream of the requesting connection
+            opcode (int): Request opcode
+            request_id (int): Id the response is tagged with
+            payload (bytes): Request payload
+        """
+        loop = asyncio.get_running_loop()
+        heartbeat = opcode == protocol.HEARTBEAT
+        try:
+            response_opcode, response_payload = await loop.run_in_executor(
+                self.heartbeat_executor if heartbeat else self.executor,
+                self.master_server.handle_request, opcode, payload
+            )
+        except Exception as e:
+            print(f"Error handling request {protocol.opcode_name(opcode)}: {e}")
+            response_opcode, response_payload = protocol.INVALID_REQUEST, b""
+        finally:
+            if not heartbeat:
+                self.pending_requests.release()
+
+        if not writer.is_closing():
+            # Header and payload are queued together, frames never interleave
+            protocol.write_frame(writer, response_opcode, request_id, response_payload)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def handle_connection(self, reader, writer):
+        """
+        Read requests from one connection until it is closed
+
+        Args:
+            reader (asyncio.StreamReader): Incoming stream
+            writer (asyncio.StreamWriter): Outgoing stream
+        """
+        tasks = set()
+        try:
+            while True:
+                frame = await protocol.read_frame(reader)
+                if frame is None:
+                    break  # Peer closed the connection
+                opcode, request_id, payload = frame
+
+                # Stop reading new requests while the workers are saturated
+                if opcode != protocol.HEARTBEAT:
+                    await self.pending_requests.acquire()
+                task = asyncio.ensure_future(self.handle_request(writer, opcode, request_id, payload))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        except (ConnectionError, protocol.ProtocolError) as e:
+            print(f"Connection to master lost: {e}")
+
+        finally:
+            # Answer the requests already read before closing
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def serve(self):
+        """
+        Accept connections on the master server socket until cancelled
+        """
+        self.pending_requests = asyncio.Semaphore(self.max_pending_requests)
+        server = await asyncio.start_server(
+            self.handle_connection, sock=self.master_server.server_socket, backlog=self.backlog
+        )
+        print("Master Server serving in asyncio mode")
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        """
+        Run the event loop, this method blocks forever
+        """
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=False)
+            self.heartbeat_executor.shutdown(wait=False)
@@ -0,0 +1,132 @@
+"""
+Block Cache for Chunk Servers
+
+Small files and chunks that are read often (configuration blobs, manifests,
+index chunks) are kept in memory, so repeated reads are answered without
+opening the file or touching the disk. Each cached block is the whole content
+of one file or chunk, keyed like the chunk server locks: ("file", file_name)
+or ("chunk", chunk_handle). Objects larger than max_block_size are never
+cached, they are sent with sendfile() straight from the page cache.
+
+The cache is filled and invalidated while the lock of the key is held (read
+lock to fill, write lock to invalidate), so a block read from a file that is
+being replaced can never be cached after the replacement invalidated it.
+"""
+
+import collections
+import threading
+
+# Bytes of block content kept in memory before the least recently used blocks are evicted
+DEFAULT_CAPACITY = 64 * 1024 * 1024
+# Largest object cached, bigger ones are sent with sendfile() from the page cache
+DEFAULT_MAX_BLOCK_SIZE = 1024 * 1024
+
+
+class BlockCache:
+    """
+    LRU cache: lock key -> content of a small file or chunk
+
+    This class:
+    - Returns cached content and marks it as recently used
+    - Evicts the least recently used blocks beyond capacity bytes
+    - Drops a block when its file or chunk is written or deleted
+    - Counts hits, misses and evictions
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, max_block_size=DEFAULT_MAX_BLOCK_SIZE):
+        """
+        Initialize the cache
+
+        Args:
+            capacity (int): Memory budget in bytes of cached content, 0 disables the cache
+            max_block_size (int): Largest object cached
+        """
+        self.capacity = capacity
+        self.max_block_size = min(max_block_size, capacity)
+        self.lock = threading.Lock()
+        # Lock key -> bytes, least recently used first
+        self.blocks = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Return the cached content of a file or chunk
+
+        Args:
+            key (tuple): ("file", file_name) or ("chunk", chunk_handle)
+
+        Returns:
+            bytes: Cached content, or None if the object is not cached
+        """
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+    def cacheable(self, size):
+        """
+        Return whether an object of a given size is kept in the cache
+
+        Args:
+            size (int): Size of the object in bytes
+        """
+        return self.capacity > 0 and size <= self.max_block_size
+
+    def put(self, key, block):
+        """
+        Cache the content of a file or chunk, must be called with the read lock of key held
+
+        Args:
+            key (tuple): ("file", file_name) or ("chunk", chunk_handle)
+            block (bytes): Whole content of the object
+        """
+        if not self.cacheable(len(block)):
+            return
+        with self.lock:
+            previous = self.blocks.pop(key, None)
+            if previous is not None:
+                self.cached_bytes -= len(previous)
+            self.blocks[key] = block
+            self.cached_bytes += len(block)
+
+            # Evict the least recently used blocks, the one just cached is the newest
+            while self.cached_bytes > self.capacity:
+                _, evicted = self.blocks.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Drop a block, must be called with the write lock of key held
+
+        Args:
+            key (tuple): ("file", file_name) or ("chunk", chunk_handle)
+        """
+        with self.lock:
+            block = self.blocks.pop(key, None)
+            if block is not None:
+                self.cached_bytes -= len(block)
+
+    def stats(self):
+        """
+        Return the counters of the cache
+
+        Returns:
+            dict: hits, misses, evictions, cached_blocks, cached_bytes and capacity
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'cached_blocks': len(self.blocks),
+                'cached_bytes': self.cached_bytes,
+                'capacity': self.capacity,
+            }
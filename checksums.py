@@ -0,0 +1,243 @@
+"""
+Block Checksums for Chunk Servers
+
+Every file and chunk stored on a chunk server has a checksum file next to it
+holding one CRC-32 per 64 KB block of its content:
+
+    +------------------------+------------------------+-----+
+    | block 0 crc32 (uint32) | block 1 crc32 (uint32) | ... |
+    +------------------------+------------------------+-----+
+
+Reads only verify the blocks overlapping the requested range, so a small
+range read of a large chunk costs one or two block checksums, not a hash of
+the whole chunk. A background scrubber verifies idle data at a bounded rate.
+"""
+
+import os
+import struct
+import zlib
+
+# Bytes covered by one checksum
+BLOCK_SIZE = 64 * 1024
+# Checksums are stored as unsigned 32-bit integers in network byte order
+CHECKSUM_FORMAT = "!I"
+CHECKSUM_SIZE = struct.calcsize(CHECKSUM_FORMAT)
+
+
+class ChecksumError(Exception):
+    """
+    Raised when stored data does not match its block checksums
+    """
+
+
+class BlockChecksums:
+    """
+    Running per-block checksums of data written in parts of any size
+
+    Streamed writes receive parts that do not line up with blocks, the CRC of
+    the current block is carried over from one part to the next.
+    """
+
+    def __init__(self):
+        self.checksums = []
+        # CRC and length of the block being filled
+        self.crc = 0
+        self.filled = 0
+
+    def update(self, data):
+        """
+        Add the next bytes of the content
+
+        Args:
+            data (bytes): Data following the data added before
+        """
+        view = memoryview(data)
+        while view:
+            take = min(BLOCK_SIZE - self.filled, len(view))
+            self.crc = zlib.crc32(view[:take], self.crc)
+            self.filled += take
+            view = view[take:]
+            if self.filled == BLOCK_SIZE:
+                self.checksums.append(self.crc)
+                self.crc = self.filled = 0
+
+    def finish(self):
+        """
+        Return the checksums of every block, the last one may be partial
+
+        Returns:
+            list: CRC-32 of each block
+        """
+        if self.filled:
+            self.checksums.append(self.crc)
+            self.crc = self.filled = 0
+        return self.checksums
+
+
+def block_checksums(data):
+    """
+    Return the checksums of every block of a content
+
+    Args:
+        data (bytes): Whole content
+    """
+    checksums = BlockChecksums()
+    checksums.update(data)
+    return checksums.finish()
+
+
+def write_checksum_file(path, checksums):
+    """
+    Atomically replace a checksum file
+
+    Args:
+        path (str): Path of the checksum file
+        checksums (list): CRC-32 of each block
+    """
+    with open(f"{path}.tmp", 'wb') as checksum_file:
+        checksum_file.write(struct.pack(f"!{len(checksums)}I", *checksums))
+    os.replace(f"{path}.tmp", path)
+
+
+def read_checksum_file(path):
+    """
+    Read a checksum file
+
+    Args:
+        path (str): Path of the checksum file
+
+    Returns:
+        tuple: CRC-32 of each block, or None if the data has no checksum file
+    """
+    try:
+        with open(path, 'rb') as checksum_file:
+            data = checksum_file.read()
+    except FileNotFoundError:
+        return None
+    return struct.unpack_from(f"!{len(data) // CHECKSUM_SIZE}I", data)
+
+
+def remove_checksum_file(path):
+    """
+    Remove a checksum file if it exists
+
+    Args:
+        path (str): Path of the checksum file
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def verify_data(data, checksums):
+    """
+    Verify a whole content held in memory
+
+    Args:
+        data (bytes): Whole content
+        checksums (tuple): Stored CRC-32 of each block
+
+    Raises:
+        ChecksumError: If a block does not match or the block count differs
+    """
+    actual = block_checksums(data)
+    if len(actual) != len(checksums):
+        raise ChecksumError(f"{len(actual)} blocks stored, {len(checksums)} checksummed")
+    for index, (crc, expected) in enumerate(zip(actual, checksums)):
+        if crc != expected:
+            raise ChecksumError(f"block {index} does not match its checksum")
+
+
+def verify_blocks(fd, size, checksum_fd, positions):
+    """
+    Verify the blocks holding a few byte positions, reading only their checksums
+
+    Args:
+        fd (int): File descriptor of the data
+        size (int): Size of the data in bytes
+        checksum_fd (int): File descriptor of the checksum file
+        positions (iterable): Byte positions, those past the end stand for the last block
+
+    Raises:
+        ChecksumError: If a block does not match or the checksum file does not cover the data
+    """
+    count = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    if os.fstat(checksum_fd).st_size != count * CHECKSUM_SIZE:
+        raise ChecksumError(f"{size} bytes stored, checksum file does not hold {count} blocks")
+    if not size:
+        return
+    for index in {min(position, size - 1) // BLOCK_SIZE for position in positions}:
+        (expected,) = struct.unpack(CHECKSUM_FORMAT, os.pread(checksum_fd, CHECKSUM_SIZE, index * CHECKSUM_SIZE))
+        if zlib.crc32(os.pread(fd, min(BLOCK_SIZE, size - index * BLOCK_SIZE), index * BLOCK_SIZE)) != expected:
+            raise ChecksumError(f"block {index} does not match its checksum")
+
+
+def update_checksum_entries(fd, size, checksum_fd, start, end):
+    """
+    Update a checksum file after the bytes between start and end of its data were rewritten
+
+    Only the blocks overlapping the rewritten range are read again and only
+    their entries are written, so a small write to a large file stays small.
+
+    Args:
+        fd (int): File descriptor of the data, open for reading
+        size (int): Size of the data in bytes after the write
+        checksum_fd (int): File descriptor of the checksum file, open for writing
+        start (int): First rewritten byte (the old end of the data if the write left a hole)
+        end (int): End of the rewritten range
+    """
+    first = start // BLOCK_SIZE
+    checksums = [
+        zlib.crc32(os.pread(fd, BLOCK_SIZE, index * BLOCK_SIZE))
+        for index in range(first, (min(end, size) + BLOCK_SIZE - 1) // BLOCK_SIZE)
+    ]
+    os.pwrite(checksum_fd, struct.pack(f"!{len(checksums)}I", *checksums), first * CHECKSUM_SIZE)
+    os.ftruncate(checksum_fd, (size + BLOCK_SIZE - 1) // BLOCK_SIZE * CHECKSUM_SIZE)
+
+
+def read_verified_blocks(fd, size, checksums, offset=0, count=None, base=0):
+    """
+    Yield the blocks of an open file that overlap a byte range, each one verified
+
+    Args:
+        fd (int): File descriptor of the data
+        size (int): Size of the data in bytes
+        checksums (tuple): Stored CRC-32 of each block, None to read without verifying
+        offset (int): First byte of the range
+        count (int): Bytes in the range, None for everything from offset
+        base (int): Position of the first byte of the data in the file
+
+    Raises:
+        ChecksumError: If a block does not match or the block count differs
+    """
+    if checksums is not None and len(checksums) != (size + BLOCK_SIZE - 1) // BLOCK_SIZE:
+        raise ChecksumError(f"{size} bytes stored, {len(checksums)} blocks checksummed")
+    end = size if count is None else min(offset + count, size)
+    for index in range(offset // BLOCK_SIZE, (end + BLOCK_SIZE - 1) // BLOCK_SIZE):
+        # Bytes past size (written after size was taken) are not covered by checksums
+        block = os.pread(fd, min(BLOCK_SIZE, size - index * BLOCK_SIZE), base + index * BLOCK_SIZE)
+        if checksums is not None and zlib.crc32(block) != checksums[index]:
+            raise ChecksumError(f"block {index} does not match its checksum")
+        yield block
+
+
+def verify_range(fd, size, checksums, offset=0, count=None, on_block=None, base=0):
+    """
+    Verify the blocks of an open file that overlap a byte range
+
+    Args:
+        fd (int): File descriptor of the data
+        size (int): Size of the data in bytes
+        checksums (tuple): Stored CRC-32 of each block
+        offset (int): First byte of the range
+        count (int): Bytes in the range, None for everything from offset
+        on_block (callable): Called with the size of every block read, used for rate limiting
+        base (int): Position of the first byte of the data in the file
+
+    Raises:
+        ChecksumError: If a block does not match or the block count differs
+    """
+    for block in read_verified_blocks(fd, size, checksums, offset, count, base):
+        if on_block is not None:
+            on_block(len(block))
@@ -1,8 +1,34 @@
+import contextlib
+import functools
 import socket
+import shutil
 import threading
 import os
+import sys
+import tempfile
 import time
 
+import protocol
+from async_chunk_server import AsyncChunkServer
+from block_cache import BlockCache, DEFAULT_CAPACITY, DEFAULT_MAX_BLOCK_SIZE
+from checksums import (
+    BlockChecksums, ChecksumError, block_checksums, read_checksum_file, read_verified_blocks,
+    remove_checksum_file, update_checksum_entries, verify_blocks, verify_data, verify_range, write_checksum_file,
+)
+from extent_store import ExtentStore
+from lock_manager import LockManager, LockTimeoutError
+from segment_store import SegmentStore
+from connection_pool import ConnectionPool, PoolExhaustedError
+
+# Seconds between heartbeats sent to the master server, well below its failure timeout
+DEFAULT_HEARTBEAT_INTERVAL = protocol.HEARTBEAT_INTERVAL
+# Bytes per second the background scrubber reads to verify stored chunks
+DEFAULT_SCRUB_RATE = 4 * 1024 * 1024
+# Seconds between two scrubbing passes over every stored chunk
+SCRUB_PASS_INTERVAL = 10
+# Seconds a chunk push waits for a free connection to the next replica of its chain
+DOWNSTREAM_ACQUIRE_TIMEOUT = 5
+
 
 class ChunkServer:
     """
@@ -16,7 +42,10 @@ class ChunkServer:
     - Provides fault tolerance through replication
     """
 
-    def __init__(self, ip, port, chunk_server_id, master_ip, master_port):
+    def __init__(self, ip, port, chunk_server_id, master_ip, master_port, wait_for_locks=True,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL, cache_capacity=DEFAULT_CAPACITY,
+                 cache_max_block_size=DEFAULT_MAX_BLOCK_SIZE, scrub_rate=DEFAULT_SCRUB_RATE,
+                 extent_size=0, packed_file_size=0):
        
         self.ip = ip
         self.port = port
@@ -26,22 +55,83 @@ class ChunkServer:
         
         # Create a dedicated directory for this chunk server's files
         self.chunk_server_directory = f"chunk_server_{chunk_server_id}_directory"
+        # Chunks are kept in their own sub-directory, named by chunk handle
+        self.chunk_directory = os.path.join(self.chunk_server_directory, "chunks")
+        # Previous version of every written file, kept as a hard link
+        self.versions_directory = os.path.join(self.chunk_server_directory, "versions")
+        # Block checksums of every file, chunks keep theirs next to the chunk
+        self.checksum_directory = os.path.join(self.chunk_server_directory, "checksums")
         self.create_chunk_server_directory_if_not_exists()
+        # Chunks packed into memory-mapped extent files instead of one file each
+        self.extent_store = None
+        if extent_size:
+            self.extent_store = ExtentStore(os.path.join(self.chunk_server_directory, "extents"), extent_size)
+            self.extent_store.start_sync_thread()
+        # Files of at most packed_file_size bytes packed into append-only segment files
+        self.packed_file_size = packed_file_size
+        self.segment_store = None
+        if packed_file_size:
+            self.segment_store = SegmentStore(os.path.join(self.chunk_server_directory, "segments"))
+            self.segment_store.start_sync_thread()
+            self.segment_store.start_compactor_thread()
         
         # Create TCP socket for client communication
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Allow a restarted server to bind while old connections are in TIME_WAIT
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((ip, port))
         self.server_socket.listen(5)  # Allow up to 5 pending connections
 
-        # File locking mechanism for concurrent access control
-        self.file_lock = threading.Lock()
-        self.locked_files = set()  # Track currently locked files
         self.timeout = 120  # Socket timeout in seconds
+
+        # Per-file and per-chunk reader/writer locks for concurrent access control
+        self.lock_manager = LockManager()
+        # Requests for a locked file wait in line (up to the socket timeout),
+        # or fail fast with FILE_LOCKED_ERROR when waiting is disabled
+        self.lock_timeout = self.timeout if wait_for_locks else 0
+        # Content of small, recently read files and chunks, served without disk access
+        self.block_cache = BlockCache(cache_capacity, cache_max_block_size)
+        # Record appends waiting to be written: file_name -> queue (see record_append)
+        self.append_lock = threading.Lock()
+        self.append_queues = {}
+
+        # Load statistics reported to the master with every heartbeat
+        self.stats_lock = threading.Lock()
+        self.in_flight_requests = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        # Chunks stored on this server, and the changes not reported to the master yet
+        self.stored_chunks = set()
+        self.added_chunks = set()
+        self.removed_chunks = set()
+
+        # Primary leases granted by the master: ("file", file_name) or
+        # ("chunk", chunk_handle) -> time.monotonic() the lease ends
+        self.lease_lock = threading.Lock()
+        self.leases = {}
+        # Leases used since the previous heartbeat, renewed by it
+        self.used_leases = set()
+        # Leases are only trusted until the master could declare this server
+        # failed, which is one heartbeat timeout after the last acknowledged beat
+        self.master_contact_deadline = 0
+
+        # Persistent connections to the master server and other chunk servers
+        self.connection_pool = ConnectionPool(socket_timeout=self.timeout)
+        self.connection_pool.start_eviction_thread()
+        self.heartbeat_interval = heartbeat_interval
+        # Read rate of the background scrubber, 0 disables scrubbing
+        self.scrub_rate = scrub_rate
+        # Longest chunk accepted, the master sends its chunk size when this server registers
+        self.chunk_size = 0
         
         print(f"Chunk Server {chunk_server_id} listening on {ip}:{port}")
 
         # Register this chunk server with the master server
         self.register_with_master()
+        # Tell the master this chunk server is alive until the process exits
+        self.start_heartbeat_thread()
+        # Find corrupt chunks before clients read them
+        self.start_scrubber_thread()
 
     def create_chunk_server_directory_if_not_exists(self):
         """
@@ -51,6 +141,9 @@ class ChunkServer:
         """
         directory_path = os.path.join(os.getcwd(), self.chunk_server_directory)
         os.makedirs(directory_path, exist_ok=True)
+        os.makedirs(os.path.join(os.getcwd(), self.chunk_directory), exist_ok=True)
+        os.makedirs(os.path.join(os.getcwd(), self.versions_directory), exist_ok=True)
+        os.makedirs(os.path.join(os.getcwd(), self.checksum_directory), exist_ok=True)
         print(f"Chunk Server {self.chunk_server_id} directory: {directory_path}")
 
     def register_with_master(self):
@@ -60,12 +153,212 @@ class ChunkServer:
         Sends registration information to the master server so it can
         track available chunk servers and their metadata.
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-            client_socket.connect((self.master_ip, self.master_port))
-            registration_request = f"REGISTER_CHUNK_SERVER:{self.chunk_server_id}:{self.ip}:{self.port}"
-            client_socket.send(registration_request.encode())
-            response = client_socket.recv(1024).decode()
-            print(response)
+        response, fields = self.send_to_master_server(
+            protocol.REGISTER_CHUNK_SERVER, self.chunk_server_id, self.ip, self.port
+        )
+        print(f"Registration response from master: {protocol.opcode_name(response)}")
+        if response == protocol.OK and fields:
+            self.chunk_size = int(fields[0])
+
+        # Report the chunks already on disk so the master knows their locations.
+        # The full report replaces any change not sent with a heartbeat yet
+        with self.stats_lock:
+            self.stored_chunks = set(self.list_chunks())
+            self.added_chunks.clear()
+            self.removed_chunks.clear()
+            chunk_handles = list(self.stored_chunks)
+        # A master that did not know this server may have granted its leases to others
+        with self.lease_lock:
+            self.leases.clear()
+        response, _ = self.send_to_master_server(protocol.REPORT_CHUNKS, self.chunk_server_id, *chunk_handles)
+        print(f"Chunk report response from master: {protocol.opcode_name(response)}")
+
+    def start_heartbeat_thread(self):
+        """
+        Start a daemon thread sending heartbeats to the master server
+        
+        Heartbeats go over the pooled master connection, so a beat costs one
+        small frame instead of a new TCP connection. Every beat carries a binary
+        load report and the chunks added and removed since the previous beat.
+        When the master answers NOT_REGISTERED (it declared this server failed
+        or was restarted) the chunk server registers again.
+        """
+        def send_heartbeats():
+            last_beat = time.monotonic()
+            while True:
+                time.sleep(self.heartbeat_interval)
+                now = time.monotonic()
+                report, added, removed = self.collect_heartbeat(now - last_beat)
+                last_beat = now
+                with self.lease_lock:
+                    renewals, self.used_leases = self.used_leases, set()
+                try:
+                    response, fields = self.send_to_master_server(
+                        protocol.HEARTBEAT, self.chunk_server_id, protocol.pack_load_report(report),
+                        protocol.pack_chunk_handles(added), protocol.pack_chunk_handles(removed),
+                        protocol.pack_chunk_handles(key for kind, key in renewals if kind == "chunk"),
+                        *(key for kind, key in renewals if kind == "file")
+                    )
+                    if response == protocol.NOT_REGISTERED:
+                        print(f"Chunk Server {self.chunk_server_id} is not registered, registering again")
+                        self.register_with_master()
+                    elif response == protocol.OK:
+                        self.renew_leases(now, fields)
+                except (OSError, protocol.ProtocolError, PoolExhaustedError) as e:
+                    print(f"Heartbeat failed: {e}")
+                    self.restore_chunk_changes(added, removed)
+                    with self.lease_lock:
+                        self.used_leases |= renewals
+
+        threading.Thread(target=send_heartbeats, daemon=True).start()
+
+    def renew_leases(self, sent_at, fields):
+        """
+        Apply the lease renewals of a heartbeat response
+        
+        Durations count from the time the heartbeat was sent, which is never
+        later than the time the master renewed the lease.
+        
+        Args:
+            sent_at (float): time.monotonic() when the heartbeat was sent
+            fields (list): Heartbeat response fields: heartbeat timeout and lease
+                           duration in milliseconds, renewed chunk leases, renewed file leases
+        """
+        heartbeat_timeout, lease_duration = int(fields[0]) / 1000, int(fields[1]) / 1000
+        renewed = [("chunk", chunk_handle) for chunk_handle in protocol.unpack_chunk_handles(fields[2])]
+        renewed += [("file", file_name.decode()) for file_name in fields[3:]]
+        with self.lease_lock:
+            self.master_contact_deadline = max(self.master_contact_deadline, sent_at + heartbeat_timeout)
+            for key in renewed:
+                self.leases[key] = sent_at + lease_duration
+            # Drop the leases that ran out
+            self.leases = {key: expires for key, expires in self.leases.items() if expires > sent_at}
+
+    def ensure_lease(self, key):
+        """
+        Check that this chunk server is the primary of a file or chunk before mutating it
+        
+        A missing or expired lease is requested from the master. Leases in use
+        are renewed by the following heartbeats, idle leases lapse.
+        
+        Args:
+            key (tuple): ("file", file_name) or ("chunk", chunk_handle)
+        
+        Returns:
+            bool: True if this chunk server holds the lease
+        """
+        now = time.monotonic()
+        with self.lease_lock:
+            if now < min(self.leases.get(key, 0), self.master_contact_deadline):
+                self.used_leases.add(key)
+                return True
+
+        try:
+            response, fields = self.send_to_master_server(protocol.ACQUIRE_LEASE, self.chunk_server_id, *key)
+        except (OSError, protocol.ProtocolError, PoolExhaustedError) as e:
+            print(f"Could not reach the master for the lease of {key}: {e}")
+            return False
+        if response != protocol.LEASE_GRANTED:
+            print(f"Lease of {key} refused: {protocol.opcode_name(response)}")
+            return False
+
+        lease_duration, heartbeat_timeout = int(fields[0]) / 1000, int(fields[1]) / 1000
+        with self.lease_lock:
+            self.leases[key] = now + lease_duration
+            self.master_contact_deadline = max(self.master_contact_deadline, now + heartbeat_timeout)
+            self.used_leases.add(key)
+        return True
+
+    def collect_heartbeat(self, elapsed):
+        """
+        Build the load report of a heartbeat and take the pending chunk changes
+        
+        Args:
+            elapsed (float): Seconds since the previous heartbeat
+        
+        Returns:
+            tuple: (report, added_chunks, removed_chunks) where report is keyed by
+                   protocol.LOAD_REPORT_FIELDS
+        """
+        with self.stats_lock:
+            added, removed = self.added_chunks, self.removed_chunks
+            self.added_chunks, self.removed_chunks = set(), set()
+            bytes_read, bytes_written = self.bytes_read, self.bytes_written
+            self.bytes_read = self.bytes_written = 0
+            report = {
+                'chunk_count': len(self.stored_chunks),
+                'in_flight_requests': self.in_flight_requests,
+            }
+        elapsed = max(elapsed, 1e-3)
+        report['read_bytes_per_sec'] = bytes_read / elapsed
+        report['write_bytes_per_sec'] = bytes_written / elapsed
+        report['disk_free'] = shutil.disk_usage(self.chunk_server_directory).free
+        report['queue_depth'] = self.lock_manager.waiting_count()
+        return report, added, removed
+
+    def restore_chunk_changes(self, added, removed):
+        """
+        Put back chunk changes whose heartbeat was not delivered
+        
+        Changes that happened since then win, a chunk deleted after it was
+        added is not reported as added again and the other way round.
+        
+        Args:
+            added (set): Chunk handles reported as added
+            removed (set): Chunk handles reported as removed
+        """
+        with self.stats_lock:
+            self.added_chunks |= added - self.removed_chunks
+            self.removed_chunks |= removed - self.added_chunks
+
+    def chunk_stored(self, chunk_handle):
+        """
+        Record that a chunk was written, reported with the next heartbeat
+        
+        Args:
+            chunk_handle (int): Handle of the chunk
+        """
+        with self.stats_lock:
+            self.stored_chunks.add(chunk_handle)
+            self.removed_chunks.discard(chunk_handle)
+            self.added_chunks.add(chunk_handle)
+
+    def chunk_removed(self, chunk_handle):
+        """
+        Record that a chunk was deleted, reported with the next heartbeat
+        
+        Args:
+            chunk_handle (int): Handle of the chunk
+        """
+        with self.stats_lock:
+            self.stored_chunks.discard(chunk_handle)
+            self.added_chunks.discard(chunk_handle)
+            self.removed_chunks.add(chunk_handle)
+
+    def record_io(self, bytes_read=0, bytes_written=0):
+        """
+        Count bytes served and stored, reported as rates with the next heartbeat
+        
+        Args:
+            bytes_read (int): Bytes sent to clients
+            bytes_written (int): Bytes written to disk
+        """
+        with self.stats_lock:
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    @contextlib.contextmanager
+    def request_in_flight(self):
+        """
+        Count a request as in flight for the duration of a with block
+        """
+        with self.stats_lock:
+            self.in_flight_requests += 1
+        try:
+            yield
+        finally:
+            with self.stats_lock:
+                self.in_flight_requests -= 1
 
     def update_master_with_file_info(self, file_name):
         """
@@ -75,196 +368,1303 @@ class ChunkServer:
             file_name (str): Name of the file to report to master server
         """
         # Send file information to the Master Server
-        chunk_server_info = f"CHUNK_SERVER_INFO:{self.chunk_server_id},{file_name}"
-        self.send_to_master_server(chunk_server_info)
+        self.send_to_master_server(protocol.CHUNK_SERVER_INFO, self.chunk_server_id, file_name)
 
-    def send_to_master_server(self, message):
+    def send_to_master_server(self, opcode, *fields):
         """
-        Send a message to the master server
+        Send a message to the master server over a pooled connection
         
         Args:
-            message (str): Message to send to the master server
+            opcode (int): Message opcode
+            *fields: Message fields
+        
+        Returns:
+            tuple: (response_opcode, response_fields) from the master server
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as master_socket:
-            master_socket.connect((self.master_ip, self.master_port))
-            master_socket.send(message.encode())
+        return self.connection_pool.request((self.master_ip, self.master_port), opcode, *fields)
 
     def handle_client(self, client_socket, addr):
         """
         Handle incoming client requests
         
-        This method processes various file operations including:
-        - CREATE_FILE: Create a new file
-        - WRITE_FILE: Write content to an existing file
-        - READ_FILE: Read content from a file
-        - DELETE_FILE: Delete a file
+        Request frames are read until the client closes the connection. Each
+        request is answered with a response frame carrying the same request id.
         
         Args:
             client_socket: Socket connection to the client
             addr: Client address information
         """
+        print(f"Accepted connection to Chunk Server {self.chunk_server_id} from {addr[0]}:{addr[1]}")
+
+        # Set a timeout of 120 seconds for the socket operations
+        client_socket.settimeout(self.timeout)
+
         try:
-            print(f"Accepted connection to Chunk Server {self.chunk_server_id} from {addr[0]}:{addr[1]}")
-
-            # Set a timeout of 120 seconds for the socket operations
-            client_socket.settimeout(self.timeout)
-
-            request = client_socket.recv(1024).decode()
-            print(f"Request received at Chunk Server {self.chunk_server_id}: {request}")
-
-            start_time = time.time()
-
-            # Handle CREATE_FILE request
-            if request.startswith("CREATE_FILE:"):
-                _, file_name = request.split(":")
-                local_file_path = os.path.join(self.chunk_server_directory, file_name)
-                # Note: Primary and secondary replication paths would be implemented here
-                # primary_file_path = os.path.join("/path/to/primary/server/directory", file_name)
-                # secondary_file_path = os.path.join("/path/to/secondary/server/directory", file_name)
-
-                with self.file_lock:
-                    print(f"File lock acquired for CREATE_FILE operation.")
-                    
-                    # Create the file in the local chunk server directory
-                    with open(local_file_path, 'w') as local_file:
-                        local_file.write("File created")
-                    
-                    # TODO: Implement replication to primary and secondary servers
-                    # try:
-                    #     with open(primary_file_path, 'w') as primary_file:
-                    #         primary_file.write("File created")
-                    # except Exception as primary_create_error:
-                    #     print(f"Error creating file on primary server: {primary_create_error}")
-
-                    # try:
-                    #     with open(secondary_file_path, 'w') as secondary_file:
-                    #         secondary_file.write("File created")
-                    # except Exception as secondary_create_error:
-                    #     print(f"Error creating file on secondary server: {secondary_create_error}")
-
-                    print(f"File lock released after CREATE_FILE operation.")
-
-                response = "FILE_CREATED"
-
-                # Update metadata in master server
-                chunk_server_info = f"CHUNK_SERVER_INFO:{self.chunk_server_id},{file_name}"
-                self.send_to_master_server(chunk_server_info)
-
-                client_socket.send(response.encode())
-                print("File created successfully.")
-
-            # Handle WRITE_FILE request
-            elif request.startswith("WRITE_FILE:"):
-                _, file_name, content = request.split(":")
-                file_path = os.path.join(self.chunk_server_directory, file_name)
-                copy_path = f"/Users/libuser/Desktop/AOS/{file_name}"  # Local backup directory
-
-                with self.file_lock:
-                    print(f"File lock acquired for WRITE_FILE operation.")
-                    
-                    # Check if file is already locked by another client
-                    if file_name in self.locked_files:
-                        print(f"File {file_name} is already locked by another client.")
-                        client_socket.send("FILE_LOCKED_ERROR".encode())
-                        return
-
-                    # Create a backup copy of the file before modification
-                    try:
-                        with open(file_path, 'r') as original, open(copy_path, 'w') as local_copy:
-                            original_content = original.read()
-                            local_copy.write(original_content)
-                    except Exception as copy_error:
-                        print(f"Error creating local copy: {copy_error}")
-                        client_socket.send("COPY_ERROR".encode())
-                        return
-
-                    # Update the original file in the chunk server directory
-                    with open(file_path, 'w') as file:
-                        file.write(content)
-
-                    print(f"File lock released after WRITE_FILE operation.")
-                    self.locked_files.remove(file_name)
-
-                response = "FILE_WRITTEN"
-                client_socket.send(response.encode())
-                print("File written successfully.")
-
-            # Handle READ_FILE request
-            elif request.startswith("READ_FILE:"):
-                _, file_name = request.split(":")
-                file_path = os.path.join(self.chunk_server_directory, file_name)
-
-                with self.file_lock:
-                    print(f"File lock acquired for READ_FILE operation.")
-                    
-                    # Check if file is already locked by another client
-                    if file_name in self.locked_files:
-                        print(f"File {file_name} is already locked by another client.")
-                        client_socket.send("FILE_LOCKED_ERROR".encode())
-                        return
-                    
-                    # Lock the file for reading
-                    self.locked_files.add(file_name)
-                    
-                    if os.path.exists(file_path):
-                        with open(file_path, 'r') as file:
-                            file_content = file.read()
-                        response = f"FILE_CONTENT:{file_content}"
-                    else:
-                        response = "FILE_NOT_FOUND"
-                    
-                    print(f"File lock released after READ_FILE operation.")
-                    self.locked_files.remove(file_name)
-
-                client_socket.send(response.encode())
-                print("File content sent.")
-
-            # Handle DELETE_FILE request
-            elif request.startswith("DELETE_FILE:"):
-                _, file_name = request.split(":")
-                file_path = os.path.join(self.chunk_server_directory, file_name)
-
-                with self.file_lock:
-                    print(f"File lock acquired for DELETE_FILE operation.")
-                    
-                    # Check if file is already locked by another client
-                    if file_name in self.locked_files:
-                        print(f"File {file_name} is already locked by another client.")
-                        client_socket.send("FILE_LOCKED_ERROR".encode())
-                        return
-                    
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        response = "FILE_DELETED"
-                    else:
-                        response = "FILE_NOT_FOUND"
-                    
-                    print(f"File lock released after DELETE_FILE operation.")
+            while True:
+                frame = protocol.recv_frame(client_socket)
+                if frame is None:
+                    break  # Client closed the connection
+                opcode, request_id, payload = frame
+                print(f"Request received at Chunk Server {self.chunk_server_id}: {protocol.opcode_name(opcode)}")
 
-                client_socket.send(response.encode())
-                print("File deleted successfully.")
+                start_time = time.time()
 
-            else:
-                print(f"Invalid request to Chunk Server {self.chunk_server_id}")
+                with self.request_in_flight():
+                    if opcode in (protocol.READ_FILE, protocol.READ_RANGE, protocol.READ_CHUNK):
+                        # Zero-copy read: file bytes go from the page cache straight to the socket
+                        response_opcode, region = self.open_read_request(opcode, payload)
+                        self.send_file_region(client_socket, request_id, response_opcode, region)
+                    else:
+                        if opcode == protocol.PUSH_CHUNK:
+                            # Chunk data follows the request on the same connection
+                            response_opcode, response_payload = self.receive_pushed_chunk(client_socket, request_id, payload)
+                        elif opcode == protocol.WRITE_FILE_STREAM:
+                            # File content follows the request on the same connection
+                            response_opcode, response_payload = self.receive_streamed_file(client_socket, request_id, payload)
+                        else:
+                            response_opcode, response_payload = self.handle_request(opcode, payload)
+                        protocol.send_frame(client_socket, response_opcode, request_id, response_payload)
 
-            # Log performance metrics
-            end_time = time.time()
-            time_taken = end_time - start_time
-            print(f"Time taken to serve the request: {time_taken:.6f} seconds")
+                # Log performance metrics
+                end_time = time.time()
+                time_taken = end_time - start_time
+                print(f"Time taken to serve the request: {time_taken:.6f} seconds")
 
         except socket.timeout:
             # Handle socket timeout - file access took too long
             print("Timeout: File access took too long.")
-            client_socket.send("TIMEOUT_ERROR".encode())
+            try:
+                protocol.send_frame(client_socket, protocol.TIMEOUT_ERROR, 0)
+            except OSError:
+                pass
 
         except Exception as e:
             print(f"Error handling client request: {e}")
 
         finally:
-            # Reset the socket timeout to its default value
-            client_socket.settimeout(None)
-            # Note: Client socket is kept open for continued communication
-            # client_socket.close()
+            client_socket.close()
+
+    def handle_request(self, opcode, payload):
+        """
+        Process a single request frame
+        
+        This method processes various file operations including:
+        - CREATE_FILE: Create a new file
+        - WRITE_FILE: Write content to an existing file
+        - WRITE_AT: Overwrite part of a file in place
+        - RECORD_APPEND: Append a record at an offset chosen by this server
+        - DELETE_FILE: Delete a file
+        - WRITE_CHUNK / DELETE_CHUNK: Chunk operations by chunk handle
+        - COPY_CHUNK: Copy a chunk to another chunk server for the master
+        - CACHE_STATS: Counters of the block cache
+        
+        READ_FILE, READ_RANGE and READ_CHUNK are not handled here, their data
+        is sent from the stored file by open_read_request and send_file_region.
+        
+        Args:
+            opcode (int): Request opcode
+            payload (bytes): Request payload
+        
+        Returns:
+            tuple: (response_opcode, response_payload)
+        """
+        fields = protocol.unpack_fields(payload)
+
+        try:
+            return self.dispatch_request(opcode, fields)
+        except LockTimeoutError as e:
+            print(f"File is already locked by another client: {e}")
+            return protocol.FILE_LOCKED_ERROR, b""
+
+    def dispatch_request(self, opcode, fields):
+        """
+        Call the handler of a request opcode
+        
+        Args:
+            opcode (int): Request opcode
+            fields (list): Request fields
+        
+        Returns:
+            tuple: (response_opcode, response_payload)
+        """
+        if opcode == protocol.CREATE_FILE:
+            return self.create_file(fields[0].decode())
+        elif opcode == protocol.WRITE_FILE:
+            return self.write_file(fields[0].decode(), fields[1])
+        elif opcode == protocol.WRITE_AT:
+            return self.write_at(fields[0].decode(), int(fields[1]), fields[2])
+        elif opcode == protocol.RECORD_APPEND:
+            return self.record_append(fields[0].decode(), fields[1])
+        elif opcode == protocol.DELETE_FILE:
+            return self.delete_file(fields[0].decode())
+        elif opcode == protocol.WRITE_CHUNK:
+            return self.write_chunk(int(fields[0]), fields[1])
+        elif opcode == protocol.DELETE_CHUNK:
+            return self.delete_chunk(int(fields[0]))
+        elif opcode == protocol.COPY_CHUNK:
+            return self.copy_chunk(int(fields[0]), int(fields[1]), (fields[2].decode(), int(fields[3])))
+        elif opcode == protocol.CACHE_STATS:
+            return self.cache_stats()
+
+        print(f"Invalid request to Chunk Server {self.chunk_server_id}")
+        return protocol.INVALID_REQUEST, b""
+
+    def create_file(self, file_name):
+        """
+        Handle CREATE_FILE request
+        
+        Args:
+            file_name (str): Name of the file to create
+        """
+        local_file_path = os.path.join(self.chunk_server_directory, file_name)
+
+        # Only the primary of a file mutates it
+        if not self.ensure_lease(("file", file_name)):
+            return protocol.NOT_PRIMARY, b""
+
+        with self.lock_manager.write_lock(("file", file_name), self.lock_timeout):
+            print(f"File lock acquired for CREATE_FILE operation.")
+            
+            # Create the file in the local chunk server directory
+            if self.should_pack(len(b"File created")):
+                self.pack_file(file_name, b"File created", block_checksums(b"File created"))
+            else:
+                with open(local_file_path, 'wb') as local_file:
+                    local_file.write(b"File created")
+                write_checksum_file(self.checksum_path(("file", file_name)), block_checksums(b"File created"))
+                self.unpack_file(file_name)
+            self.block_cache.invalidate(("file", file_name))
+            
+            # Whole files live on this server only, chunked files are
+            # replicated through PUSH_CHUNK (see receive_pushed_chunk)
+
+            print(f"File lock released after CREATE_FILE operation.")
+
+        # Update metadata in master server
+        self.update_master_with_file_info(file_name)
+
+        print("File created successfully.")
+        return protocol.FILE_CREATED, b""
+
+    def write_file(self, file_name, content):
+        """
+        Handle WRITE_FILE request
+        
+        Args:
+            file_name (str): Name of the file to write
+            content (bytes): New file content
+        """
+        # The new content is written next to the file and swapped in by commit_file
+        temp_file, temp_path = self.open_temp_file(file_name)
+        with temp_file:
+            temp_file.write(content)
+        self.record_io(bytes_written=len(content))
+        return self.commit_file(file_name, temp_path, block_checksums(content))
+
+    def open_temp_file(self, file_name):
+        """
+        Create a uniquely named temporary file next to a file
+        
+        Writers fill their own temporary file without holding the file lock,
+        so the names must not collide between concurrent requests.
+        
+        Args:
+            file_name (str): Name of the file the temporary file will replace
+        
+        Returns:
+            tuple: (file object opened for binary writing, path)
+        """
+        fd, temp_path = tempfile.mkstemp(prefix=f"{file_name}.", suffix=".tmp", dir=self.chunk_server_directory)
+        return os.fdopen(fd, 'wb'), temp_path
+
+    def commit_file(self, file_name, temp_path, checksums):
+        """
+        Replace a file with a fully written temporary file, keeping the previous version
+        
+        The previous version is hard linked into the versions directory instead
+        of being copied, so the backup costs the same for any file size. The new
+        content is then renamed into place atomically, readers that already
+        opened the file keep sending the previous version. Content small enough
+        to be packed is appended to a segment file instead.
+        
+        Args:
+            file_name (str): Name of the file to replace
+            temp_path (str): Path of the temporary file holding the new content
+            checksums (list): Block checksums of the new content
+        
+        Returns:
+            tuple: (response_opcode, response_payload)
+        """
+        file_path = os.path.join(self.chunk_server_directory, file_name)
+
+        try:
+            # Only the primary of a file mutates it
+            if not self.ensure_lease(("file", file_name)):
+                return protocol.NOT_PRIMARY, b""
+            packed = self.should_pack(os.path.getsize(temp_path))
+
+            with self.lock_manager.write_lock(("file", file_name), self.lock_timeout):
+                print(f"File lock acquired for WRITE_FILE operation.")
+
+                # Keep the previous version of the file before it is replaced
+                try:
+                    created = not self.keep_previous_version(file_name)
+                except OSError as copy_error:
+                    print(f"Error keeping previous version: {copy_error}")
+                    return protocol.COPY_ERROR, b""
+
+                if packed:
+                    with open(temp_path, 'rb') as temp_file:
+                        self.pack_file(file_name, temp_file.read(), checksums)
+                else:
+                    write_checksum_file(self.checksum_path(("file", file_name)), checksums)
+                    os.replace(temp_path, file_path)
+                    self.unpack_file(file_name)
+                self.block_cache.invalidate(("file", file_name))
+
+                print(f"File lock released after WRITE_FILE operation.")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        if created:
+            # Files created by a write are reported like CREATE_FILE does
+            self.update_master_with_file_info(file_name)
+
+        print("File written successfully.")
+        return protocol.FILE_WRITTEN, b""
+
+    def keep_previous_version(self, file_name):
+        """
+        Keep the current content of a file in the versions directory
+        
+        Must be called with the write lock of the file held. A file of its own
+        is hard linked, a packed file is linked in the segment index; either way
+        nothing is copied.
+        
+        Args:
+            file_name (str): Name of the file about to be replaced
+        
+        Returns:
+            bool: Whether the file existed
+        """
+        version_path = os.path.join(self.versions_directory, file_name)
+        # Packed files are named by their path relative to the chunk server directory
+        version_name = os.path.relpath(version_path, self.chunk_server_directory)
+
+        if self.segment_store is not None and self.segment_store.link(file_name, version_name):
+            if os.path.exists(version_path):
+                os.remove(version_path)
+            return True
+
+        try:
+            os.link(os.path.join(self.chunk_server_directory, file_name), f"{version_path}.tmp")
+            os.replace(f"{version_path}.tmp", version_path)
+        except FileNotFoundError:
+            return False  # Nothing to keep, the file is new
+        if self.segment_store is not None:
+            self.segment_store.delete(version_name)
+        return True
+
+    def receive_streamed_file(self, client_socket, request_id, payload):
+        """
+        Handle WRITE_FILE_STREAM request
+        
+        The file content follows the request as DATA_PART frames. Every part is
+        appended to a temporary file as it arrives, so memory use is bounded by
+        the part size whatever the size of the file, and the file is only
+        replaced once the whole content was received.
+        
+        Args:
+            client_socket: Socket the file content is received on
+            request_id (int): Id of the WRITE_FILE_STREAM request
+            payload (bytes): Request payload
+                             Fields: file_name, content_length
+        """
+        upload = self.begin_streamed_file(payload)
+        try:
+            while upload['received'] < upload['length']:
+                self.write_streamed_part(upload, protocol.recv_data_part(client_socket, request_id))
+        except (OSError, protocol.ProtocolError) as e:
+            print(f"Error receiving file {upload['file_name']}: {e}")
+            self.abort_streamed_file(upload)
+            raise
+        return self.finish_streamed_file(upload)
+
+    def begin_streamed_file(self, payload):
+        """
+        Start receiving a streamed file: open its temporary file
+        
+        Args:
+            payload (bytes): WRITE_FILE_STREAM request payload
+        
+        Returns:
+            dict: State of the upload, passed to write_streamed_part and finish_streamed_file
+        """
+        fields = protocol.unpack_fields(payload)
+        file_name = fields[0].decode()
+        temp_file, temp_path = self.open_temp_file(file_name)
+        return {
+            'file_name': file_name,
+            'length': int(fields[1]),
+            'received': 0,
+            'temp_file': temp_file,
+            'temp_path': temp_path,
+            'checksums': BlockChecksums(),
+            'write_error': None,
+        }
+
+    def write_streamed_part(self, upload, part):
+        """
+        Append one part of a streamed file to its temporary file
+        
+        A failed disk write is remembered and the remaining parts are still
+        consumed, so the connection stays usable for the error response.
+        
+        Args:
+            upload (dict): Upload state from begin_streamed_file
+            part (bytes): File data received from the client
+        """
+        if upload['write_error'] is None:
+            try:
+                upload['temp_file'].write(part)
+            except OSError as e:
+                upload['write_error'] = e
+        upload['checksums'].update(part)
+        upload['received'] += len(part)
+        self.record_io(bytes_written=len(part))
+
+    def finish_streamed_file(self, upload):
+        """
+        Replace the file with the received content
+        
+        Args:
+            upload (dict): Upload state from begin_streamed_file
+        
+        Returns:
+            tuple: (response_opcode, response_payload)
+        """
+        try:
+            upload['temp_file'].close()
+        except OSError as e:
+            upload['write_error'] = upload['write_error'] or e
+
+        if upload['write_error'] is not None:
+            print(f"Error writing file {upload['file_name']}: {upload['write_error']}")
+            self.abort_streamed_file(upload)
+            return protocol.COPY_ERROR, b""
+
+        print(f"Received {upload['received']} bytes for {upload['file_name']}.")
+        try:
+            return self.commit_file(upload['file_name'], upload['temp_path'], upload['checksums'].finish())
+        except LockTimeoutError as e:
+            print(f"File is already locked by another client: {e}")
+            return protocol.FILE_LOCKED_ERROR, b""
+
+    def abort_streamed_file(self, upload):
+        """
+        Discard a streamed file that was not received completely
+        
+        Args:
+            upload (dict): Upload state from begin_streamed_file
+        """
+        upload['temp_file'].close()
+        if os.path.exists(upload['temp_path']):
+            os.remove(upload['temp_path'])
+
+    def write_at(self, file_name, offset, data):
+        """
+        Handle WRITE_AT request
+        
+        The bytes are written in place with pwrite(), so patching part of a
+        large file costs the size of the patch instead of a copy of the file,
+        and only the checksums of the blocks it touches are computed again.
+        Unlike WRITE_FILE no previous version is kept, and the write waits for
+        reads of the file that are still being sent (see open_read_request).
+        
+        Args:
+            file_name (str): Name of the file
+            offset (int): Position of the first byte written, past the end leaves a hole of zeros
+            data (bytes): Bytes to write
+        """
+        file_path = os.path.join(self.chunk_server_directory, file_name)
+        key = ("file", file_name)
+
+        # Only the primary of a file mutates it
+        if not self.ensure_lease(key):
+            return protocol.NOT_PRIMARY, b""
+
+        with self.lock_manager.write_lock(key, self.lock_timeout):
+            try:
+                if self.is_packed(file_name):
+                    self.rewrite_packed(file_name, offset, data)
+                else:
+                    fd = os.open(file_path, os.O_RDWR)
+                    try:
+                        self.write_in_place(key, fd, offset, data)
+                    finally:
+                        os.close(fd)
+            except FileNotFoundError:
+                return protocol.FILE_NOT_FOUND, b""
+            except ChecksumError as e:
+                print(f"Checksum verification of file {file_name} failed: {e}")
+                return protocol.CHECKSUM_ERROR, b""
+            self.block_cache.invalidate(key)
+        self.record_io(bytes_written=len(data))
+
+        print(f"Wrote {len(data)} bytes at offset {offset} of {file_name}.")
+        return protocol.FILE_WRITTEN, b""
+
+    def write_in_place(self, key, fd, offset, data):
+        """
+        Write bytes into an open file and update the checksums of the blocks they touch
+        
+        Must be called with the write lock of key held. Only the checksums of
+        the touched blocks are read and written, not the whole checksum file.
+        
+        Args:
+            key (tuple): ("file", file_name) or ("chunk", chunk_handle)
+            fd (int): File descriptor of the data, open for reading and writing
+            offset (int): Position of the first byte written, past the end leaves a hole of zeros
+            data (bytes): Bytes to write
+        
+        Raises:
+            ChecksumError: If a block that is partly rewritten was already corrupt
+        """
+        try:
+            checksum_fd = os.open(self.checksum_path(key), os.O_RDWR)
+        except FileNotFoundError:
+            os.pwrite(fd, data, offset)  # The data has no checksums
+            return
+        try:
+            size = os.fstat(fd).st_size
+            if data:
+                # Bytes of the first and last block that are not overwritten
+                # must be intact, their checksums are computed again
+                verify_blocks(fd, size, checksum_fd, {min(offset, size), offset + len(data) - 1})
+            os.pwrite(fd, data, offset)
+            update_checksum_entries(fd, os.fstat(fd).st_size, checksum_fd, min(offset, size), offset + len(data))
+        finally:
+            os.close(checksum_fd)
+
+    def record_append(self, file_name, record):
+        """
+        Handle RECORD_APPEND request
+        
+        The primary of the file chooses where each record goes, so producers on
+        many hosts append to the same file without reading it, without locking
+        it themselves and without overwriting each other. Appends that arrive
+        while a previous batch is being written wait in an in-memory queue; the
+        first of them writes the whole queue with one pwrite() and tells every
+        waiting append its offset, so concurrent producers share disk writes
+        instead of failing with FILE_LOCKED_ERROR.
+        
+        A file that does not exist yet is created empty by its first record.
+        
+        Args:
+            file_name (str): Name of the file
+            record (bytes): Record to append, written contiguously
+        
+        Returns:
+            tuple: (RECORD_APPENDED, offset of the record) or an error response
+        """
+        # Only the primary of a file mutates it
+        if not self.ensure_lease(("file", file_name)):
+            return protocol.NOT_PRIMARY, b""
+
+        append = {'record': record, 'response': None}
+        with self.append_lock:
+            queue = self.append_queues.get(file_name)
+            if queue is None:
+                queue = self.append_queues[file_name] = {
+                    'pending': [], 'writing': False, 'done': threading.Condition(self.append_lock),
+                }
+            queue['pending'].append(append)
+            # Wait until a batch holding this record was written, or until
+            # no batch is being written and this request writes the next one
+            queue['done'].wait_for(lambda: append['response'] is not None or not queue['writing'])
+            if append['response'] is not None:
+                return append['response']
+            batch, queue['pending'] = queue['pending'], []
+            queue['writing'] = True
+
+        try:
+            self.write_records(file_name, batch)
+        finally:
+            with self.append_lock:
+                for waiting in batch:
+                    if waiting['response'] is None:
+                        waiting['response'] = (protocol.COPY_ERROR, b"")
+                queue['writing'] = False
+                if not queue['pending']:
+                    del self.append_queues[file_name]
+                queue['done'].notify_all()
+        return append['response']
+
+    def write_records(self, file_name, batch):
+        """
+        Append a batch of queued records to the end of a file with one write
+        
+        Args:
+            file_name (str): Name of the file
+            batch (list): Queued appends, the response of each one is set
+        """
+        file_path = os.path.join(self.chunk_server_directory, file_name)
+        key = ("file", file_name)
+        data = b"".join(append['record'] for append in batch)
+
+        try:
+            with self.lock_manager.write_lock(key, self.lock_timeout):
+                if self.is_packed(file_name):
+                    offset, created = self.rewrite_packed(file_name, None, data), False
+                elif self.should_pack(len(data)) and not os.path.exists(file_path):
+                    self.pack_file(file_name, data, block_checksums(data))
+                    offset, created = 0, True
+                else:
+                    try:
+                        fd = os.open(file_path, os.O_RDWR)
+                        created = False
+                    except FileNotFoundError:
+                        fd = os.open(file_path, os.O_RDWR | os.O_CREAT)
+                        write_checksum_file(self.checksum_path(key), [])
+                        created = True
+                    try:
+                        offset = os.fstat(fd).st_size
+                        self.write_in_place(key, fd, offset, data)
+                    finally:
+                        os.close(fd)
+                self.block_cache.invalidate(key)
+        except ChecksumError as e:
+            print(f"Checksum verification of file {file_name} failed: {e}")
+            response = (protocol.CHECKSUM_ERROR, b"")
+        except LockTimeoutError as e:
+            print(f"File is already locked by another client: {e}")
+            response = (protocol.FILE_LOCKED_ERROR, b"")
+        except OSError as e:
+            print(f"Error appending to {file_name}: {e}")
+            response = (protocol.COPY_ERROR, b"")
+        else:
+            response = None
+        if response is not None:
+            for append in batch:
+                append['response'] = response
+            return
+
+        self.record_io(bytes_written=len(data))
+        if created:
+            # Files created by an append are reported like CREATE_FILE does
+            self.update_master_with_file_info(file_name)
+        for append in batch:
+            append['response'] = (protocol.RECORD_APPENDED, protocol.pack_fields(offset))
+            offset += len(append['record'])
+        print(f"Appended {len(batch)} records ({len(data)} bytes) to {file_name}.")
+
+    def should_pack(self, size):
+        """
+        Return whether a file of the given size is packed into a segment file
+        
+        Args:
+            size (int): Size of the file content in bytes
+        """
+        return self.segment_store is not None and size <= self.packed_file_size
+
+    def is_packed(self, file_name):
+        """
+        Return whether a file is stored in a segment file, must be called with the lock of the file held
+        
+        Args:
+            file_name (str): Name of the file
+        """
+        return self.segment_store is not None and file_name in self.segment_store
+
+    def pack_file(self, file_name, content, checksums):
+        """
+        Store the whole content of a file in a segment file, removing its file of its own
+        
+        Must be called with the write lock of the file held.
+        
+        Args:
+            file_name (str): Name of the file
+            content (bytes): New file content
+            checksums (list): Block checksums of content
+        """
+        self.segment_store.put(file_name, content, checksums)
+        file_path = os.path.join(self.chunk_server_directory, file_name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            remove_checksum_file(self.checksum_path(("file", file_name)))
+
+    def unpack_file(self, file_name):
+        """
+        Drop the packed content of a file that was stored in a file of its own
+        
+        Must be called with the write lock of the file held.
+        
+        Args:
+            file_name (str): Name of the file
+        """
+        if self.segment_store is not None:
+            self.segment_store.delete(file_name)
+
+    def rewrite_packed(self, file_name, offset, data):
+        """
+        Write bytes into a packed file
+        
+        Must be called with the write lock of the file held. Segment files are
+        append-only, so the patched content is appended as a whole new copy;
+        a file that grows past packed_file_size moves to a file of its own.
+        
+        Args:
+            file_name (str): Name of the file
+            offset (int): Position of the first byte written, None to append at the end
+            data (bytes): Bytes to write
+        
+        Returns:
+            int: Position the bytes were written at
+        
+        Raises:
+            ChecksumError: If the stored content was already corrupt
+        """
+        with self.segment_store.open(file_name) as region:
+            content = region.read()
+            verify_data(content, region.checksums)
+        if offset is None:
+            offset = len(content)
+        content = bytearray(content)
+        if offset > len(content):
+            content.extend(bytes(offset - len(content)))
+        content[offset:offset + len(data)] = data
+        content = bytes(content)
+
+        if self.should_pack(len(content)):
+            self.segment_store.put(file_name, content, block_checksums(content))
+            return offset
+
+        temp_file, temp_path = self.open_temp_file(file_name)
+        with temp_file:
+            temp_file.write(content)
+        write_checksum_file(self.checksum_path(("file", file_name)), block_checksums(content))
+        os.replace(temp_path, os.path.join(self.chunk_server_directory, file_name))
+        self.segment_store.delete(file_name)
+        print(f"File {file_name} grew to {len(content)} bytes and was moved out of the segment files.")
+        return offset
+
+    def delete_file(self, file_name):
+        """
+        Handle DELETE_FILE request
+        
+        Args:
+            file_name (str): Name of the file to delete
+        """
+        file_path = os.path.join(self.chunk_server_directory, file_name)
+
+        # Only the primary of a file mutates it
+        if not self.ensure_lease(("file", file_name)):
+            return protocol.NOT_PRIMARY, b""
+
+        with self.lock_manager.write_lock(("file", file_name), self.lock_timeout):
+            print(f"File lock acquired for DELETE_FILE operation.")
+            
+            if self.segment_store is not None and self.segment_store.delete(file_name):
+                # Only a tombstone is written, the compactor reclaims the space
+                self.block_cache.invalidate(("file", file_name))
+                response = (protocol.FILE_DELETED, b"")
+            elif os.path.exists(file_path):
+                os.remove(file_path)
+                remove_checksum_file(self.checksum_path(("file", file_name)))
+                self.block_cache.invalidate(("file", file_name))
+                response = (protocol.FILE_DELETED, b"")
+            else:
+                response = (protocol.FILE_NOT_FOUND, b"")
+            
+            print(f"File lock released after DELETE_FILE operation.")
+
+        print("File deleted successfully.")
+        return response
+
+    def chunk_path(self, chunk_handle):
+        """
+        Return the local path of a chunk
+        
+        Args:
+            chunk_handle (int): Handle of the chunk
+        """
+        return os.path.join(self.chunk_directory, f"chunk_{chunk_handle}")
+
+    def checksum_path(self, key):
+        """
+        Return the path of the block checksums of a file or chunk
+        
+        Args:
+            key (tuple): ("file", file_name) or ("chunk", chunk_handle)
+        """
+        if key[0] == "chunk":
+            return f"{self.chunk_path(key[1])}.crc"
+        return os.path.join(self.checksum_directory, key[1])
+
+    def open_stored(self, key):
+        """
+        Open the stored content of a file or chunk, must be called with the lock of key held
+        
+        Args:
+            key (tuple): ("file", file_name) or ("chunk", chunk_handle)
+        
+        Returns:
+            tuple: (stored_file, base, size, checksums, version) where the content
+                   starts at byte base of stored_file, which has fileno(), read()
+                   and close(), and version changes whenever the content is replaced
+        
+        Raises:
+            FileNotFoundError: If the file or chunk is not stored here
+        """
+        if key[0] == "chunk" and self.extent_store is not None:
+            region = self.extent_store.open(key[1])
+            if region is None:
+                raise FileNotFoundError(f"Chunk {key[1]} is not stored")
+            return region, region.base, region.size, region.checksums, region.version
+
+        if key[0] == "file" and self.segment_store is not None:
+            region = self.segment_store.open(key[1])
+            if region is not None:
+                return region, region.base, region.size, region.checksums, region.version
+
+        if key[0] == "chunk":
+            stored_file = open(self.chunk_path(key[1]), 'rb')
+        else:
+            stored_file = open(os.path.join(self.chunk_server_directory, key[1]), 'rb')
+        file_stat = os.fstat(stored_file.fileno())
+        return stored_file, 0, file_stat.st_size, read_checksum_file(self.checksum_path(key)), file_stat.st_ino
+
+    def list_chunks(self):
+        """
+        Return the handles of all chunks stored on this chunk server
+        """
+        if self.extent_store is not None:
+            return self.extent_store.handles()
+        return [
+            int(name[len("chunk_"):]) for name in os.listdir(self.chunk_directory)
+            if name.startswith("chunk_") and name[len("chunk_"):].isdigit()
+        ]
+
+    def write_chunk(self, chunk_handle, data):
+        """
+        Handle WRITE_CHUNK request
+        
+        Args:
+            chunk_handle (int): Handle of the chunk
+            data (bytes): Chunk content
+        """
+        chunk_path = self.chunk_path(chunk_handle)
+
+        # Only the primary of a chunk mutates it
+        if not self.ensure_lease(("chunk", chunk_handle)):
+            return protocol.NOT_PRIMARY, b""
+
+        with self.lock_manager.write_lock(("chunk", chunk_handle), self.lock_timeout):
+            if self.extent_store is not None:
+                self.extent_store.put(chunk_handle, data, block_checksums(data))
+            else:
+                # Replace the chunk atomically so in-flight reads see the old version
+                with open(f"{chunk_path}.tmp", 'wb') as chunk_file:
+                    chunk_file.write(data)
+                write_checksum_file(self.checksum_path(("chunk", chunk_handle)), block_checksums(data))
+                os.replace(f"{chunk_path}.tmp", chunk_path)
+            self.block_cache.invalidate(("chunk", chunk_handle))
+        self.chunk_stored(chunk_handle)
+        self.record_io(bytes_written=len(data))
+
+        print(f"Chunk {chunk_handle} written ({len(data)} bytes).")
+        return protocol.CHUNK_WRITTEN, b""
+
+    def copy_chunk(self, chunk_handle, rate, target):
+        """
+        Handle COPY_CHUNK request: push a chunk to another chunk server
+        
+        The master re-replicates and moves chunks by asking a replica to copy
+        them, so chunk data goes straight from one chunk server to the other.
+        The copy is sent at most rate bytes per second and every block is
+        verified before it is sent, a corrupt replica is never copied.
+        
+        Args:
+            chunk_handle (int): Handle of the chunk
+            rate (int): Bytes per second the copy may use, 0 or less for no limit
+            target (tuple): (ip, port) of the chunk server receiving the copy
+        """
+        key = ("chunk", chunk_handle)
+        with self.lock_manager.read_lock(key, self.lock_timeout):
+            try:
+                chunk_file, base, size, checksums, version = self.open_stored(key)
+            except FileNotFoundError:
+                return protocol.CHUNK_NOT_FOUND, b""
+
+        with chunk_file:
+            request_id = protocol.next_request_id()
+            try:
+                with self.connection_pool.connection(target) as target_socket:
+                    # The target receives the copy like a chain of one replica
+                    protocol.send_frame(
+                        target_socket, protocol.PUSH_CHUNK, request_id,
+                        protocol.pack_fields(chunk_handle, size)
+                    )
+                    for block in read_verified_blocks(chunk_file.fileno(), size, checksums, base=base):
+                        protocol.send_frame(target_socket, protocol.DATA_PART, request_id, block)
+                        self.record_io(bytes_read=len(block))
+                        if rate > 0:
+                            time.sleep(len(block) / rate)
+                    frame = protocol.recv_frame(target_socket)
+            except ChecksumError as e:
+                return self.handle_corruption(key, version, e), b""
+            except (OSError, protocol.ProtocolError, PoolExhaustedError) as e:
+                print(f"Error copying chunk {chunk_handle} to {target[0]}:{target[1]}: {e}")
+                return protocol.REPLICATION_ERROR, b""
+
+        if frame is None or frame[0] != protocol.CHUNK_WRITTEN:
+            return protocol.REPLICATION_ERROR, b""
+        print(f"Chunk {chunk_handle} copied to {target[0]}:{target[1]} ({size} bytes).")
+        return protocol.CHUNK_WRITTEN, b""
+
+    def receive_pushed_chunk(self, client_socket, request_id, payload):
+        """
+        Handle PUSH_CHUNK request (pipelined chain replication)
+        
+        The chunk content follows the request as DATA_PART frames. Every part is
+        forwarded to the next replica in the chain as soon as it arrives and then
+        written to a temporary file, so all replicas receive the data at the same
+        time instead of one after the other. A replica commits the chunk (renames
+        it into place) only after the rest of the chain acknowledged it, so the
+        head of the chain answers once every replica has the chunk.
+        
+        Args:
+            client_socket: Socket the chunk data is received on
+            request_id (int): Id of the PUSH_CHUNK request
+            payload (bytes): Request payload
+                             Fields: chunk_handle, chunk_length, then ip, port of every downstream replica
+        """
+        push = self.begin_pushed_chunk(request_id, payload)
+        try:
+            while push['received'] < push['chunk_length']:
+                self.write_pushed_part(push, protocol.recv_data_part(client_socket, request_id))
+        except (OSError, protocol.ProtocolError) as e:
+            print(f"Error receiving chunk {push['chunk_handle']}: {e}")
+            self.abort_pushed_chunk(push)
+            return protocol.REPLICATION_ERROR, b""
+        return self.finish_pushed_chunk(push)
+
+    def begin_pushed_chunk(self, request_id, payload):
+        """
+        Start receiving a pushed chunk: open the temporary file (or reserve the
+        extent slot) and forward the request to the next replica of the chain
+        
+        Args:
+            request_id (int): Id of the PUSH_CHUNK request
+            payload (bytes): PUSH_CHUNK request payload
+        
+        Returns:
+            dict: State of the transfer, passed to write_pushed_part and finish_pushed_chunk
+        
+        Raises:
+            ProtocolError: If the announced chunk length is larger than the chunk size
+        """
+        fields = protocol.unpack_fields(payload)
+        chunk_handle, chunk_length = int(fields[0]), int(fields[1])
+        chain = fields[2:]
+        # Checked before any space is reserved for the chunk
+        if not 0 <= chunk_length <= self.chunk_size:
+            raise protocol.ProtocolError(
+                f"Chunk {chunk_handle} of {chunk_length} bytes exceeds the chunk size of {self.chunk_size} bytes"
+            )
+        push = {
+            'chunk_handle': chunk_handle,
+            'chunk_length': chunk_length,
+            'downstream_count': len(chain) // 2,
+            'received': 0,
+            'temp_path': f"{self.chunk_path(chunk_handle)}.{request_id}.tmp",
+            'downstream': None,
+            'downstream_address': (chain[0].decode(), int(chain[1])) if chain else None,
+            'downstream_request_id': protocol.next_request_id(),
+            'checksums': BlockChecksums(),
+            'replication_error': None,
+        }
+        if self.extent_store is not None:
+            push['slot'], push['temp_file'] = self.extent_store.reserve(chunk_length), None
+        else:
+            push['slot'], push['temp_file'] = None, open(push['temp_path'], 'wb')
+
+        if chain:
+            try:
+                # Bounded wait: two chains crossing each other must not block forever
+                push['downstream'], _ = self.connection_pool.acquire(
+                    push['downstream_address'], DOWNSTREAM_ACQUIRE_TIMEOUT
+                )
+                protocol.send_frame(
+                    push['downstream'], protocol.PUSH_CHUNK, push['downstream_request_id'],
+                    protocol.pack_fields(chunk_handle, chunk_length, *chain[2:])
+                )
+            except (OSError, PoolExhaustedError) as e:
+                push['replication_error'] = e
+        return push
+
+    def write_pushed_part(self, push, part):
+        """
+        Forward one part of a pushed chunk downstream and write it locally
+        
+        Args:
+            push (dict): Transfer state from begin_pushed_chunk
+            part (bytes): Chunk data received from upstream
+        
+        Raises:
+            ProtocolError: If the part goes past the chunk length announced by PUSH_CHUNK
+        """
+        if push['received'] + len(part) > push['chunk_length']:
+            raise protocol.ProtocolError(
+                f"Chunk {push['chunk_handle']} data exceeds its announced length of {push['chunk_length']} bytes"
+            )
+        # Forward before writing locally to keep the pipeline full
+        if push['downstream'] is not None and push['replication_error'] is None:
+            try:
+                protocol.send_frame(push['downstream'], protocol.DATA_PART, push['downstream_request_id'], part)
+            except OSError as e:
+                push['replication_error'] = e
+        if push['slot'] is not None:
+            self.extent_store.write(push['slot'], push['received'], part)
+        else:
+            push['temp_file'].write(part)
+        push['checksums'].update(part)
+        push['received'] += len(part)
+        self.record_io(bytes_written=len(part))
+
+    def finish_pushed_chunk(self, push):
+        """
+        Wait for the rest of the chain to acknowledge a pushed chunk and commit it
+        
+        Args:
+            push (dict): Transfer state from begin_pushed_chunk
+        
+        Returns:
+            tuple: (response_opcode, response_payload) for the upstream replica or client
+        """
+        chunk_handle = push['chunk_handle']
+        downstream_acknowledged = False
+        try:
+            if push['temp_file'] is not None:
+                push['temp_file'].close()
+
+            # Wait for the rest of the chain before committing
+            if push['downstream'] is not None and push['replication_error'] is None:
+                frame = protocol.recv_frame(push['downstream'])
+                if frame is None or frame[0] != protocol.CHUNK_WRITTEN:
+                    push['replication_error'] = f"downstream replica answered {protocol.opcode_name(frame[0]) if frame else 'nothing'}"
+                else:
+                    downstream_acknowledged = True
+
+            if push['replication_error'] is not None:
+                print(f"Replication of chunk {chunk_handle} failed: {push['replication_error']}")
+                return protocol.REPLICATION_ERROR, b""
+
+            with self.lock_manager.write_lock(("chunk", chunk_handle), self.lock_timeout):
+                if push['slot'] is not None:
+                    self.extent_store.commit(chunk_handle, push['slot'], push['checksums'].finish())
+                    push['slot'] = None
+                else:
+                    write_checksum_file(self.checksum_path(("chunk", chunk_handle)), push['checksums'].finish())
+                    os.replace(push['temp_path'], self.chunk_path(chunk_handle))
+                self.block_cache.invalidate(("chunk", chunk_handle))
+            self.chunk_stored(chunk_handle)
+
+        except (OSError, protocol.ProtocolError, LockTimeoutError) as e:
+            print(f"Error receiving chunk {chunk_handle}: {e}")
+            return protocol.REPLICATION_ERROR, b""
+
+        finally:
+            self.abort_pushed_chunk(push, downstream_acknowledged)
+
+        print(f"Chunk {chunk_handle} committed ({push['chunk_length']} bytes, {push['downstream_count']} downstream replica(s)).")
+        return protocol.CHUNK_WRITTEN, b""
+
+    def abort_pushed_chunk(self, push, downstream_acknowledged=False):
+        """
+        Release the resources of a pushed chunk transfer
+        
+        Args:
+            push (dict): Transfer state from begin_pushed_chunk
+            downstream_acknowledged (bool): Whether the downstream exchange completed
+        """
+        if push['temp_file'] is not None:
+            push['temp_file'].close()
+        if push['slot'] is not None:
+            # Space reserved for a chunk that was never committed
+            self.extent_store.release(push['slot'])
+            push['slot'] = None
+        if push['downstream'] is not None:
+            # Only a connection whose exchange completed can be reused
+            if downstream_acknowledged:
+                self.connection_pool.release(push['downstream_address'], push['downstream'])
+            else:
+                self.connection_pool.discard(push['downstream_address'], push['downstream'])
+            push['downstream'] = None
+        if os.path.exists(push['temp_path']):
+            os.remove(push['temp_path'])
+
+    def open_read_request(self, opcode, payload):
+        """
+        Resolve a READ_FILE, READ_RANGE or READ_CHUNK request to an open file region
+        
+        Writes replace chunks and packed files atomically and never reuse an
+        extent slot that is being sent, so those are sent with sendfile()
+        after the lock is released. Whole files are written in place by
+        WRITE_AT, and sendfile() may still read the page cache after it
+        returned: they are copied to the socket with the read lock held, the
+        release function returned with the region drops it once they were sent.
+        
+        Small files and chunks are answered from the block cache. On a miss
+        they are read whole while the lock is held and cached, writers drop
+        the cached content under the write lock once the new version is in place.
+        
+        Data read from disk is verified against its block checksums, only the
+        blocks overlapping the requested range are checked. Corrupt data is
+        answered with CHECKSUM_ERROR, see handle_corruption.
+        
+        Args:
+            opcode (int): READ_FILE, READ_RANGE or READ_CHUNK
+            payload (bytes): Request payload
+                             Fields: file_name or chunk_handle, offset, length (optional
+                             except for READ_RANGE)
+        
+        Returns:
+            tuple: (response_opcode, region) where region is (file, offset, count, release)
+                   with release None when the region can be sent with sendfile(),
+                   a memoryview of cached content, or None when the response carries no data
+        """
+        fields = protocol.unpack_fields(payload)
+        if opcode != protocol.READ_CHUNK:
+            lock_key = ("file", fields[0].decode())
+            found, missing = protocol.FILE_CONTENT, protocol.FILE_NOT_FOUND
+        else:
+            lock_key = ("chunk", int(fields[0]))
+            found, missing = protocol.CHUNK_DATA, protocol.CHUNK_NOT_FOUND
+        offset = int(fields[1]) if len(fields) > 1 else 0
+        length = int(fields[2]) if len(fields) > 2 else None
+
+        block = self.block_cache.get(lock_key)
+        if block is not None:
+            offset = min(offset, len(block))
+            count = len(block) - offset if length is None else max(0, min(length, len(block) - offset))
+            return found, memoryview(block)[offset:offset + count]
+
+        try:
+            self.lock_manager.acquire_read(lock_key, self.lock_timeout)
+        except LockTimeoutError as e:
+            print(f"File is already locked by another client: {e}")
+            return protocol.FILE_LOCKED_ERROR, None
+        region_file = None
+        try:
+            # The checksums are read under the same lock as the data they cover
+            region_file, base, size, checksums, version = self.open_stored(lock_key)
+            offset = min(offset, size)
+            count = size - offset if length is None else max(0, min(length, size - offset))
+            if self.block_cache.cacheable(size):
+                with region_file:
+                    block = region_file.read()
+                if checksums is not None:
+                    verify_data(block, checksums)
+                self.block_cache.put(lock_key, block)
+            elif checksums is not None:
+                verify_range(region_file.fileno(), size, checksums, offset, count, base=base)
+        except FileNotFoundError:
+            self.lock_manager.release_read(lock_key)
+            return missing, None
+        except ChecksumError as e:
+            region_file.close()
+            # handle_corruption takes the write lock
+            self.lock_manager.release_read(lock_key)
+            return self.handle_corruption(lock_key, version, e), None
+        except BaseException:
+            if region_file is not None:
+                region_file.close()
+            self.lock_manager.release_read(lock_key)
+            raise
+
+        if block is not None:
+            self.lock_manager.release_read(lock_key)
+            return found, memoryview(block)[offset:offset + count]
+        if lock_key[0] == "file" and not self.is_packed(lock_key[1]):
+            return found, (region_file, base + offset, count, functools.partial(self.lock_manager.release_read, lock_key))
+        self.lock_manager.release_read(lock_key)
+        return found, (region_file, base + offset, count, None)
+
+    def handle_corruption(self, key, version, error):
+        """
+        Take a file or chunk that failed checksum verification out of service
+        
+        A corrupt chunk is renamed to chunk_<handle>.corrupt (or dropped from
+        the extent store), dropped from the chunks reported to the master and
+        reported with REPORT_CORRUPT_CHUNK,
+        so the master stops handing out this replica and re-replicates the
+        chunk from a healthy one. Files are stored on this server only, they
+        are left in place and every read of them fails.
+        
+        Args:
+            key (tuple): ("file", file_name) or ("chunk", chunk_handle)
+            version (int): Version of the data that was verified, see open_stored
+            error (ChecksumError): Verification failure
+        
+        Returns:
+            int: CHECKSUM_ERROR response opcode
+        """
+        print(f"Checksum verification of {key[0]} {key[1]} failed: {error}")
+        if key[0] != "chunk":
+            return protocol.CHECKSUM_ERROR
+
+        chunk_handle = key[1]
+        chunk_path = self.chunk_path(chunk_handle)
+        try:
+            with self.lock_manager.write_lock(key, self.lock_timeout):
+                # A write may have replaced the chunk since it was verified
+                if self.extent_store is not None:
+                    if self.extent_store.version(chunk_handle) != version:
+                        return protocol.CHECKSUM_ERROR
+                    self.extent_store.delete(chunk_handle)
+                else:
+                    if os.stat(chunk_path).st_ino != version:
+                        return protocol.CHECKSUM_ERROR
+                    os.replace(chunk_path, f"{chunk_path}.corrupt")
+                    remove_checksum_file(self.checksum_path(key))
+                self.block_cache.invalidate(key)
+        except (FileNotFoundError, LockTimeoutError):
+            return protocol.CHECKSUM_ERROR
+        self.chunk_removed(chunk_handle)
+        with self.lease_lock:
+            self.leases.pop(key, None)
+
+        try:
+            self.send_to_master_server(protocol.REPORT_CORRUPT_CHUNK, self.chunk_server_id, chunk_handle)
+        except (OSError, protocol.ProtocolError, PoolExhaustedError) as e:
+            # The removal still reaches the master with the next heartbeat
+            print(f"Error reporting corrupt chunk {chunk_handle}: {e}")
+        return protocol.CHECKSUM_ERROR
+
+    def send_file_region(self, client_socket, request_id, response_opcode, region):
+        """
+        Send a file region as the raw payload of a response frame using sendfile()
+        
+        Memory use is constant per request, the kernel copies the bytes from the
+        page cache to the socket. Content from the block cache is sent as is.
+        
+        Args:
+            client_socket: Socket connection to the client
+            request_id (int): Id of the request being answered
+            response_opcode (int): Response opcode
+            region (tuple): (file, offset, count, release) from open_read_request, a memoryview, or None
+        """
+        if region is None:
+            protocol.send_frame(client_socket, response_opcode, request_id)
+            return
+
+        if isinstance(region, memoryview):
+            protocol.send_frame(client_socket, response_opcode, request_id, region)
+            self.record_io(bytes_read=len(region))
+            return
+
+        region_file, offset, count, release = region
+        try:
+            with region_file:
+                client_socket.sendall(protocol.pack_header(response_opcode, request_id, count))
+                if release is None:
+                    if count:
+                        client_socket.sendfile(region_file, offset, count)
+                else:
+                    # Written in place: the bytes must be copied out before the lock is released
+                    for position in range(offset, offset + count, protocol.DATA_PART_SIZE):
+                        part_size = min(protocol.DATA_PART_SIZE, offset + count - position)
+                        client_socket.sendall(os.pread(region_file.fileno(), part_size, position))
+        finally:
+            if release is not None:
+                release()
+        self.record_io(bytes_read=count)
+
+    def delete_chunk(self, chunk_handle):
+        """
+        Handle DELETE_CHUNK request
+        
+        Args:
+            chunk_handle (int): Handle of the chunk
+        """
+        chunk_path = self.chunk_path(chunk_handle)
+
+        with self.lock_manager.write_lock(("chunk", chunk_handle), self.lock_timeout):
+            if self.extent_store is not None:
+                if not self.extent_store.delete(chunk_handle):
+                    return protocol.CHUNK_NOT_FOUND, b""
+            else:
+                if not os.path.exists(chunk_path):
+                    return protocol.CHUNK_NOT_FOUND, b""
+                os.remove(chunk_path)
+                remove_checksum_file(self.checksum_path(("chunk", chunk_handle)))
+            self.block_cache.invalidate(("chunk", chunk_handle))
+        self.chunk_removed(chunk_handle)
+
+        print(f"Chunk {chunk_handle} deleted.")
+        return protocol.CHUNK_DELETED, b""
+
+    def start_scrubber_thread(self):
+        """
+        Verify every stored chunk against its block checksums in the background
+        
+        Chunks are read at most scrub_rate bytes per second so scrubbing does
+        not compete with client requests, and only the chunk lock is held while
+        a chunk is opened. Passes over all chunks are SCRUB_PASS_INTERVAL
+        seconds apart.
+        """
+        if not self.scrub_rate:
+            return
+
+        def scrub_forever():
+            while True:
+                with self.stats_lock:
+                    chunk_handles = sorted(self.stored_chunks)
+                for chunk_handle in chunk_handles:
+                    try:
+                        self.scrub_chunk(chunk_handle)
+                    except OSError as e:
+                        print(f"Error scrubbing chunk {chunk_handle}: {e}")
+                time.sleep(SCRUB_PASS_INTERVAL)
+
+        threading.Thread(target=scrub_forever, daemon=True).start()
+
+    def scrub_chunk(self, chunk_handle):
+        """
+        Verify one chunk at the scrub rate
+        
+        Args:
+            chunk_handle (int): Handle of the chunk
+        """
+        key = ("chunk", chunk_handle)
+        try:
+            with self.lock_manager.read_lock(key, self.lock_timeout):
+                chunk_file, base, size, checksums, version = self.open_stored(key)
+        except (FileNotFoundError, LockTimeoutError):
+            return  # Deleted meanwhile, or busy until the next pass
+
+        with chunk_file:
+            if checksums is None:
+                return  # Written before checksums were kept
+            try:
+                verify_range(
+                    chunk_file.fileno(), size, checksums, base=base,
+                    on_block=lambda block_size: time.sleep(block_size / self.scrub_rate)
+                )
+            except ChecksumError as e:
+                self.handle_corruption(key, version, e)
+
+    def cache_stats(self):
+        """
+        Handle CACHE_STATS request
+        
+        Returns:
+            tuple: (OK, fields in protocol.CACHE_STATS_FIELDS order)
+        """
+        stats = self.block_cache.stats()
+        return protocol.OK, protocol.pack_fields(*(stats[name] for name in protocol.CACHE_STATS_FIELDS))
 
     def start(self):
         """
@@ -282,8 +1682,21 @@ class ChunkServer:
             client_handler = threading.Thread(target=self.handle_client, args=(client_socket, addr))
             client_handler.start()
 
+    def start_async(self, **options):
+        """
+        Start the chunk server in asyncio mode
+        
+        Connections are served from one event loop instead of one thread per
+        connection, see AsyncChunkServer for the available options.
+        """
+        AsyncChunkServer(self, **options).start()
+
 if __name__ == "__main__":
     # Create and start Chunk Server 1 on localhost port 6001
     # Register with master server at localhost:5011
     chunk_server = ChunkServer("127.0.0.1", 6001, 1, "127.0.0.1", 5011)
-    chunk_server.start()
+    # Pass --async to serve connections from an event loop
+    if "--async" in sys.argv:
+        chunk_server.start_async()
+    else:
+        chunk_server.start()
@@ -1,85 +1,436 @@
-import socket
+import os
+import random
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import protocol
+from connection_pool import ConnectionPool
+from location_cache import LocationCache
 
 class Client:
     def __init__(self, ip, port, client_id):
         self.ip = ip
         self.port = port
         self.client_id = client_id
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Persistent connections to the master server and chunk servers
+        self.connection_pool = ConnectionPool()
+        self.connection_pool.start_eviction_thread()
         self.master_server_address = ("127.0.0.1", 5011)
-        self.primary_server = None
+        # Seconds to wait for the master to replace the failed primary of a file,
+        # longer than the heartbeat timeout after which it declares the primary failed
+        self.failover_timeout = 5
+        # Read latency per chunk server address, as an exponentially weighted moving average
+        self.replica_latency = {}
+        self.replica_latency_lock = threading.Lock()
+        # Weight of the newest sample in the moving average
+        self.latency_smoothing = 0.2
+        # Latency charged to a chunk server that failed a read, steers reads away from it
+        self.failed_replica_latency = 10.0
+        # Address of this client as seen by the master, lets it rank local replicas first
+        self.local_ip = None
+        # Primary chunk server of each file: file name -> (address, time.monotonic() its lease ends)
+        self.file_primaries = {}
+        self.file_primaries_lock = threading.Lock()
+        # Chunk handles and replicas of recently read files, see location_cache.py
+        self.location_cache = LocationCache()
+        # A location lookup for one chunk also fetches the chunks that follow it
+        self.prefetch_chunks = 16
         self.connect_to_master_server()
 
     def connect_to_master_server(self):
         try:
-            self.client_socket.connect(self.master_server_address)
+            # Open the first pooled connection to the master server
+            with self.connection_pool.connection(self.master_server_address) as master_socket:
+                self.local_ip = master_socket.getsockname()[0]
             print(f"Client {self.client_id} connected to Master Server on {self.master_server_address[0]}:{self.master_server_address[1]}")
         except Exception as e:
             print(f"Error connecting to Master Server: {e}")
             exit(1)
 
-    def send_request(self, request):
-        try:
-            self.client_socket.send(request.encode())
-            response = self.client_socket.recv(1024).decode()
-            print(f"Response for client {self.client_id}: {response}")
-            return response
-        except Exception as e:
-            print(f"Error sending/receiving data: {e}")
-            exit(1)
+    def find_file_primary(self, file_name):
+        # Every file has its own primary, granted a lease by the master
+        with self.file_primaries_lock:
+            cached = self.file_primaries.get(file_name)
+        if cached is not None and time.monotonic() < cached[1]:
+            return cached[0]
+
+        response, primary_data = self.send_to_master(protocol.FIND_PRIMARY_SERVER, file_name)
+        if response != protocol.PRIMARY_SERVER_INFO:
+            print(f"No primary server for {file_name}: {protocol.opcode_name(response)}")
+            return None
+        primary_ip, primary_port, lease_ms = primary_data
+        address = (primary_ip.decode(), int(primary_port))
+        with self.file_primaries_lock:
+            self.file_primaries[file_name] = (address, time.monotonic() + int(lease_ms) / 1000)
+        return address
+
+    def forget_file_primary(self, file_name):
+        with self.file_primaries_lock:
+            self.file_primaries.pop(file_name, None)
+
+    def send_file_request(self, opcode, file_name, *fields):
+        # The request goes to the file's primary. When that server lost the
+        # lease or failed, ask the master again until it names another primary
+        deadline = time.monotonic() + self.failover_timeout
+        while True:
+            address = self.find_file_primary(file_name)
+            if address is None:
+                return protocol.NO_PRIMARY_SERVER, []
+            try:
+                response, response_fields = self.connection_pool.request(
+                    address, opcode, file_name, *fields, idempotent=opcode in protocol.READ_ONLY_REQUESTS
+                )
+                if response != protocol.NOT_PRIMARY:
+                    print(f"Response for client {self.client_id}: {protocol.opcode_name(response)}")
+                    return response, response_fields
+                print(f"Chunk Server {address[0]}:{address[1]} is no longer the primary of {file_name}")
+            except (OSError, protocol.ProtocolError) as e:
+                print(f"Primary Server {address[0]}:{address[1]} of {file_name} failed: {e}")
+                if time.monotonic() >= deadline:
+                    raise
+            self.forget_file_primary(file_name)
+            if time.monotonic() >= deadline:
+                return protocol.NOT_PRIMARY, []
+            time.sleep(0.1)
+
+    def send_to_master(self, opcode, *fields):
+        # Only requests that change nothing are sent again after a lost response
+        return self.connection_pool.request(
+            self.master_server_address, opcode, *fields, idempotent=opcode in protocol.READ_ONLY_REQUESTS
+        )
+
+    def send_to_chunk_server(self, address, opcode, *fields):
+        return self.connection_pool.request(
+            address, opcode, *fields, idempotent=opcode in protocol.READ_ONLY_REQUESTS
+        )
+
+    def write_chunked_file(self, file_name, data):
+        self.location_cache.invalidate(file_name)
+        # The master splits the file into chunks and places every chunk on its replicas
+        response, fields = self.send_to_master(protocol.ALLOCATE_CHUNKS, file_name, len(data))
+        if response != protocol.CHUNK_LOCATIONS:
+            print(f"Could not allocate chunks for {file_name}: {protocol.opcode_name(response)}")
+            return False
+
+        chunk_size, chunks = protocol.unpack_chunk_locations(fields)
+        view = memoryview(data)
+        for index, (chunk_handle, replicas) in enumerate(chunks):
+            chunk_data = view[index * chunk_size:(index + 1) * chunk_size]
+            response = self.push_chunk(chunk_handle, chunk_data, replicas)
+            if response != protocol.CHUNK_WRITTEN:
+                print(f"Failed to write chunk {chunk_handle}: {protocol.opcode_name(response)}")
+                return False
+
+        print(f"Client {self.client_id} wrote {file_name} as {len(chunks)} chunk(s)")
+        return True
+
+    def push_chunk(self, chunk_handle, chunk_data, replicas):
+        # The data is pushed to the first replica only, every replica forwards
+        # it to the next one while it is still receiving (chain replication)
+        chain = []
+        for _, ip, port in replicas[1:]:
+            chain.extend((ip, port))
+        _, ip, port = replicas[0]
+        with self.connection_pool.connection((ip, port)) as chunk_server_socket:
+            request_id = protocol.next_request_id()
+            protocol.send_frame(
+                chunk_server_socket, protocol.PUSH_CHUNK, request_id,
+                protocol.pack_fields(chunk_handle, len(chunk_data), *chain)
+            )
+            protocol.send_data_parts(chunk_server_socket, request_id, chunk_data)
+            frame = protocol.recv_frame(chunk_server_socket)
+        return frame[0] if frame is not None else protocol.REPLICATION_ERROR
+
+    def stream_file(self, file_name, local_path):
+        # The file is sent in DATA_PART frames straight from disk, memory use
+        # does not depend on its size
+        address = self.find_file_primary(file_name)
+        if address is None:
+            return protocol.NO_PRIMARY_SERVER
+        with open(local_path, 'rb') as local_file:
+            length = os.fstat(local_file.fileno()).st_size
+            with self.connection_pool.connection(address) as chunk_server_socket:
+                request_id = protocol.next_request_id()
+                protocol.send_frame(
+                    chunk_server_socket, protocol.WRITE_FILE_STREAM, request_id,
+                    protocol.pack_fields(file_name, length)
+                )
+                protocol.send_file_parts(chunk_server_socket, request_id, local_file, length)
+                frame = protocol.recv_frame(chunk_server_socket)
+        response = frame[0] if frame is not None else protocol.TIMEOUT_ERROR
+        if response == protocol.NOT_PRIMARY:
+            self.forget_file_primary(file_name)
+        print(f"Response for client {self.client_id}: {protocol.opcode_name(response)}")
+        return response
+
+    def locate_chunks(self, file_name, first_chunk=0, count=None):
+        # Returns (chunk_size, chunk_count, [(chunk_handle, replicas), ...]) for
+        # count chunks (all if None), from the cache while the locations are fresh
+        cached = self.location_cache.lookup(file_name, first_chunk, count)
+        if cached is not None:
+            return cached
+
+        # A miss fetches at least prefetch_chunks chunks, so reading on does not
+        # ask the master again. Replicas come back ranked, local and least loaded first
+        wanted = 0 if count is None else max(count, self.prefetch_chunks)
+        response, fields = self.send_to_master(
+            protocol.GET_CHUNK_LOCATIONS, file_name, self.local_ip or "", first_chunk, wanted
+        )
+        if response != protocol.CHUNK_LOCATIONS:
+            print(f"Could not locate {file_name}: {protocol.opcode_name(response)}")
+            return None
+        chunk_size, chunks, first_chunk, chunk_count, ttl_ms = protocol.unpack_chunk_range(fields)
+        self.location_cache.store(
+            file_name, chunk_size, chunk_count, first_chunk, chunks, None if ttl_ms is None else ttl_ms / 1000
+        )
+        return chunk_size, chunk_count, chunks if count is None else chunks[:count]
+
+    def read_chunked_file(self, file_name):
+        # Chunks are read in order, one master lookup covers prefetch_chunks chunks
+        parts = []
+        index, chunk_count = 0, 1
+        while index < chunk_count:
+            located = self.locate_chunks(file_name, index, 1)
+            if located is None:
+                return None
+            _, chunk_count, chunks = located
+            try:
+                parts.append(self.read_located_chunk(file_name, index, *chunks[0]))
+            except IOError as e:
+                print(e)
+                return None
+            index += 1
+
+        return b"".join(parts)
 
-    def receive_messages(self):
+    def read_located_chunk(self, file_name, index, chunk_handle, replicas, chunk_range=(), first_replica=None):
+        # Cached locations may be stale (chunk moved, file recreated): drop them
+        # and retry once with the master's current locations
         try:
-            while True:
-                message = self.client_socket.recv(1024).decode()
-                print(f"Message from server: File Blocked! you are in the Queue")
-        except Exception as e:
-            print(f"Error receiving messages: {e}")
-
-    def find_primary_server(self):
-        request = "FIND_PRIMARY_SERVER"
-        response = self.send_request(request)
-        print(response)
-        if response.startswith("PRIMARY_SERVER_INFO:"):
-            
-            primary_info = response.split(":")[1]
-            primary_data = primary_info.split(",")
-            
-            if len(primary_data) == 2:
-               
-                primary_ip, primary_port = primary_data
-                try:
-                    self.primary_server = (primary_ip, int(primary_port))
-                    print(f"Client {self.client_id} found primary server at {self.primary_server[0]}:{self.primary_server[1]}")
-                    return True
-                except ValueError as ve:
-                    print(f"Error parsing primary server address: {ve}")
+            return self.read_chunk_from_replicas(chunk_handle, replicas, (file_name, index), chunk_range, first_replica)
+        except IOError:
+            self.location_cache.invalidate_chunk(file_name, index, chunk_handle)
+            located = self.locate_chunks(file_name, index, 1)
+            if located is None or not located[2]:
+                raise
+            chunk_handle, replicas = located[2][0]
+            return self.read_chunk_from_replicas(chunk_handle, replicas, (file_name, index), chunk_range, first_replica)
+
+    def read_chunked_range(self, file_name, offset, length):
+        # Only the chunks overlapping the range are looked up and read, and
+        # each of them only from the first to the last byte wanted
+        located = self.locate_chunks(file_name, 0, 1)
+        if located is None:
+            return None
+        chunk_size = located[0]
+        first_chunk = offset // chunk_size
+        end = offset + length
+        located = self.locate_chunks(file_name, first_chunk, max(1, -(-end // chunk_size) - first_chunk))
+        if located is None:
+            return None
+        parts = []
+        for index, (chunk_handle, replicas) in enumerate(located[2], first_chunk):
+            chunk_start = index * chunk_size
+            chunk_offset = max(offset, chunk_start) - chunk_start
+            chunk_length = min(end, chunk_start + chunk_size) - chunk_start - chunk_offset
+            try:
+                parts.append(self.read_located_chunk(
+                    file_name, index, chunk_handle, replicas, (chunk_offset, chunk_length)
+                ))
+            except IOError as e:
+                print(e)
+                return None
+        return b"".join(parts)
+
+    def record_latency(self, address, seconds):
+        with self.replica_latency_lock:
+            previous = self.replica_latency.get(address)
+            if previous is None:
+                self.replica_latency[address] = seconds
             else:
-                print(f"Invalid PRIMARY_SERVER_INFO format: {primary_info}")
+                self.replica_latency[address] = self.latency_smoothing * seconds + (1 - self.latency_smoothing) * previous
+
+    def replica_cost(self, replicas, rank):
+        # Measured latency weighted by the master's ranking, replicas never read
+        # from cost nothing so they get tried
+        _, ip, port = replicas[rank]
+        with self.replica_latency_lock:
+            latency = self.replica_latency.get((ip, port), 0.0)
+        return latency * (1 + rank / len(replicas)), rank
+
+    def choose_replica(self, replicas):
+        # Power of two choices: compare two random replicas and keep the cheaper
+        # one, which spreads reads over all replicas without herding every
+        # client onto the one that currently looks best. The master leaves out
+        # failed chunk servers, a chunk whose replicas are all down has none
+        if not replicas:
+            raise IOError("no live replica")
+        if len(replicas) == 1:
+            return 0
+        first, second = random.sample(range(len(replicas)), 2)
+        return min(first, second, key=lambda rank: self.replica_cost(replicas, rank))
+
+    def read_chunk_from_replicas(self, chunk_handle, replicas, cached_as=None, chunk_range=(), first_replica=None):
+        # Start with the chosen replica (first_replica, an index wrapped around
+        # the replicas, if given), fall back to the others in ranked order.
+        # chunk_range is an optional (offset, length) within the chunk
+        if first_replica is None or not replicas:
+            chosen = self.choose_replica(replicas)
         else:
-            print(f"Unexpected response: {response}")
+            chosen = first_replica % len(replicas)
+        for chunk_server_id, ip, port in [replicas[chosen]] + replicas[:chosen] + replicas[chosen + 1:]:
+            start_time = time.monotonic()
+            try:
+                response, chunk_fields = self.send_to_chunk_server(
+                    (ip, port), protocol.READ_CHUNK, chunk_handle, *chunk_range
+                )
+            except (OSError, protocol.ProtocolError) as e:
+                print(f"Chunk Server {chunk_server_id} unreachable: {e}")
+                self.record_latency((ip, port), self.failed_replica_latency)
+                continue
+            if response == protocol.CHUNK_DATA:
+                self.record_latency((ip, port), time.monotonic() - start_time)
+                return chunk_fields[0]
+            if response == protocol.CHECKSUM_ERROR:
+                # The replica is corrupt, the chunk server reported it to the master
+                print(f"Chunk Server {chunk_server_id} has a corrupt copy of chunk {chunk_handle}")
+            elif response == protocol.CHUNK_NOT_FOUND and cached_as is not None:
+                # The cached replica list (file name, chunk index) is stale, look it up again next time
+                self.location_cache.invalidate_chunk(*cached_as, chunk_handle)
+        raise IOError(f"No replica of chunk {chunk_handle} could be read")
 
-        return False
+    def parallel_read_file(self, file_name, max_workers=8, range_size=8 * 1024 * 1024):
+        # Resolve every chunk location with a single master lookup (or none if cached)
+        located = self.locate_chunks(file_name)
+        if located is None:
+            return None
+        chunk_size, _, chunks = located
 
-    def connect_to_primary_server(self):
-        if self.primary_server:
+        if any(not replicas for _, replicas in chunks):
+            print(f"Some chunks of {file_name} have no live replica")
+            return None
+
+        # Chunks are split into ranges of range_size bytes handed round-robin to
+        # the replicas of the chunk, so even a single chunk is fetched from all
+        # of its chunk servers at the same time. The length of the last chunk
+        # is not known, its ranges past the end come back empty
+        ranges = [
+            (index, chunk_handle, replicas, (offset, min(range_size, chunk_size - offset)), number)
+            for index, (chunk_handle, replicas) in enumerate(chunks)
+            for number, offset in enumerate(range(0, chunk_size, range_size))
+        ]
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(ranges)))) as executor:
+            futures = [
+                executor.submit(
+                    self.read_located_chunk, file_name, index, chunk_handle, replicas, chunk_range, first_replica
+                )
+                for index, chunk_handle, replicas, chunk_range, first_replica in ranges
+            ]
             try:
-                self.client_socket.close()  # Close connection to the master server
-                self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.client_socket.connect(self.primary_server)
-                print(f"Client {self.client_id} connected to Primary Server on {self.primary_server[0]}:{self.primary_server[1]}")
-                return True
-            except Exception as e:
-                print(f"Error connecting to Primary Server: {e}")
+                # Results are collected in file order to reassemble the file
+                parts = [future.result() for future in futures]
+            except IOError as e:
+                print(f"Error reading {file_name}: {e}")
+                return None
+
+        return b"".join(parts)
+
+    def delete_chunked_file(self, file_name):
+        self.location_cache.invalidate(file_name)
+        response, fields = self.send_to_master(protocol.REMOVE_FILE, file_name)
+        if response != protocol.CHUNK_LOCATIONS:
+            print(f"Could not remove {file_name}: {protocol.opcode_name(response)}")
+            return False
+
+        _, chunks = protocol.unpack_chunk_locations(fields)
+        for chunk_handle, replicas in chunks:
+            for chunk_server_id, ip, port in replicas:
+                try:
+                    self.send_to_chunk_server((ip, port), protocol.DELETE_CHUNK, chunk_handle)
+                except OSError as e:
+                    print(f"Chunk Server {chunk_server_id} unreachable, chunk {chunk_handle} left behind: {e}")
+        return True
+
+    def read_file_range(self, file_name, offset, length):
+        # Only the requested bytes are sent, whatever the size of the file
+        response, fields = self.send_file_request(protocol.READ_RANGE, file_name, offset, length)
+        if response != protocol.FILE_CONTENT:
+            return None
+        return fields[0]
+
+    def write_file_at(self, file_name, offset, data):
+        # The bytes are written in place, the rest of the file is not sent again
+        response, _ = self.send_file_request(protocol.WRITE_AT, file_name, offset, data)
+        return response == protocol.FILE_WRITTEN
+
+    def append_record(self, file_name, record):
+        # The primary picks the offset, concurrent producers never overwrite each
+        # other. A retry after a failed connection may append the record twice
+        response, fields = self.send_file_request(protocol.RECORD_APPEND, file_name, record)
+        if response != protocol.RECORD_APPENDED:
+            print(f"Could not append to {file_name}: {protocol.opcode_name(response)}")
+            return None
+        return int(fields[0])
+
+    def make_directory_path(self, path):
+        response, _ = self.send_to_master(protocol.MAKE_DIRECTORY, path)
+        if response != protocol.OK:
+            print(f"Could not create directory {path}: {protocol.opcode_name(response)}")
+            return False
+        return True
 
-        return False
+    def list_directory_path(self, path):
+        # Directory names end with "/"
+        response, fields = self.send_to_master(protocol.LIST_DIRECTORY, path)
+        if response != protocol.DIRECTORY_LISTING:
+            print(f"Could not list {path}: {protocol.opcode_name(response)}")
+            return None
+        return [field.decode() for field in fields]
+
+    def rename_path(self, source, target):
+        self.location_cache.invalidate_prefix(source)
+        self.location_cache.invalidate_prefix(target)
+        response, _ = self.send_to_master(protocol.RENAME, source, target)
+        if response != protocol.OK:
+            print(f"Could not rename {source} to {target}: {protocol.opcode_name(response)}")
+            return False
+        return True
+
+    def upload_file(self):
+        try:
+            local_path = input("Enter local file path: ")
+            file_name = input("Enter file name: ")
+            with open(local_path, 'rb') as local_file:
+                data = local_file.read()
+            self.write_chunked_file(file_name, data)
+        except Exception as e:
+            print(f"Error uploading file: {e}")
+
+    def stream_upload_file(self):
+        try:
+            local_path = input("Enter local file path: ")
+            file_name = input("Enter file name: ")
+            self.stream_file(file_name, local_path)
+        except Exception as e:
+            print(f"Error streaming file: {e}")
+
+    def download_file(self):
+        try:
+            file_name = input("Enter file name: ")
+            local_path = input("Enter local file path: ")
+            data = self.parallel_read_file(file_name)
+            if data is not None:
+                with open(local_path, 'wb') as local_file:
+                    local_file.write(data)
+                print(f"Client {self.client_id} downloaded {file_name} ({len(data)} bytes)")
+        except Exception as e:
+            print(f"Error downloading file: {e}")
 
     def create_file(self):
         try:
             file_name = input("Enter file name: ")
-            request = f"CREATE_FILE:{file_name}"
-            self.send_request(request)
+            self.send_file_request(protocol.CREATE_FILE, file_name)
         except Exception as e:
             print(f"Error creating file: {e}")
             exit(1)
@@ -88,8 +439,7 @@ class Client:
         try:
             file_name = input("Enter file name: ")
             content = input("Enter content: ")
-            request = f"WRITE_FILE:{file_name}:{content}"
-            self.send_request(request)
+            self.send_file_request(protocol.WRITE_FILE, file_name, content)
         except Exception as e:
             print(f"Error writing file: {e}")
             exit(1)
@@ -97,57 +447,131 @@ class Client:
     def read_file(self):
         try:
             file_name = input("Enter file name: ")
-            request = f"READ_FILE:{file_name}"
-            self.send_request(request)
+            response, fields = self.send_file_request(protocol.READ_FILE, file_name)
+            if response == protocol.FILE_CONTENT:
+                print(fields[0].decode(errors="replace"))
         except Exception as e:
             print(f"Error reading file: {e}")
             exit(1)
 
+    def read_range(self):
+        try:
+            file_name = input("Enter file name: ")
+            offset = int(input("Enter offset: "))
+            length = int(input("Enter length: "))
+            data = self.read_file_range(file_name, offset, length)
+            if data is not None:
+                print(data.decode(errors="replace"))
+        except Exception as e:
+            print(f"Error reading file range: {e}")
+
+    def write_at(self):
+        try:
+            file_name = input("Enter file name: ")
+            offset = int(input("Enter offset: "))
+            content = input("Enter content: ")
+            if self.write_file_at(file_name, offset, content.encode()):
+                print(f"Wrote {len(content.encode())} bytes at offset {offset} of {file_name}")
+        except Exception as e:
+            print(f"Error writing file range: {e}")
+
+    def append(self):
+        try:
+            file_name = input("Enter file name: ")
+            content = input("Enter record: ")
+            offset = self.append_record(file_name, content.encode() + b"\n")
+            if offset is not None:
+                print(f"Record appended at offset {offset} of {file_name}")
+        except Exception as e:
+            print(f"Error appending record: {e}")
+
     def delete_file(self):
         try:
             file_name = input("Enter file name: ")
-            request = f"DELETE_FILE:{file_name}"
-            self.send_request(request)
+            self.send_file_request(protocol.DELETE_FILE, file_name)
         except Exception as e:
             print(f"Error deleting file: {e}")
             exit(1)
 
+    def make_directory(self):
+        try:
+            path = input("Enter directory path: ")
+            if self.make_directory_path(path):
+                print(f"Directory {path} created")
+        except Exception as e:
+            print(f"Error creating directory: {e}")
+
+    def list_directory(self):
+        try:
+            path = input("Enter directory path: ")
+            names = self.list_directory_path(path)
+            if names is not None:
+                print("\n".join(names) if names else "(empty)")
+        except Exception as e:
+            print(f"Error listing directory: {e}")
+
+    def rename(self):
+        try:
+            source = input("Enter current path: ")
+            target = input("Enter new path: ")
+            if self.rename_path(source, target):
+                print(f"Renamed {source} to {target}")
+        except Exception as e:
+            print(f"Error renaming: {e}")
+
     def handle_operations(self):
         try:
             print(f"Client {self.client_id} connected to Master Server.")
-            if self.find_primary_server():
-                if self.connect_to_primary_server():
-                    message_thread = threading.Thread(target=self.receive_messages)
-                    message_thread.start()
-
-                    while True:
-                        print("\nOperations:")
-                        print("1. Create File")
-                        print("2. Write to File")
-                        print("3. Read File")
-                        print("4. Delete File")
-                        print("5. Exit")
-
-                        choice = input("Enter your choice (1-5): ")
-
-                        if choice == "1":
-                            self.create_file()
-                        elif choice == "2":
-                            self.write_file()
-                        elif choice == "3":
-                            self.read_file()
-                        elif choice == "4":
-                            self.delete_file()
-                        elif choice == "5":
-                            print(f"Client {self.client_id} exiting...")
-                            break
-                        else:
-                            print("Invalid choice. Please enter a number between 1 and 5.")
+            while True:
+                print("\nOperations:")
+                print("1. Create File")
+                print("2. Write to File")
+                print("3. Read File")
+                print("4. Delete File")
+                print("5. Upload Local File (chunked)")
+                print("6. Download File (chunked)")
+                print("7. Upload Local File (streamed to primary)")
+                print("8. Make Directory")
+                print("9. List Directory")
+                print("10. Rename File or Directory")
+                print("11. Read File Range")
+                print("12. Write to File at Offset")
+                print("13. Append Record")
+                print("14. Exit")
+
+                choice = input("Enter your choice (1-14): ")
+
+                if choice == "1":
+                    self.create_file()
+                elif choice == "2":
+                    self.write_file()
+                elif choice == "3":
+                    self.read_file()
+                elif choice == "4":
+                    self.delete_file()
+                elif choice == "5":
+                    self.upload_file()
+                elif choice == "6":
+                    self.download_file()
+                elif choice == "7":
+                    self.stream_upload_file()
+                elif choice == "8":
+                    self.make_directory()
+                elif choice == "9":
+                    self.list_directory()
+                elif choice == "10":
+                    self.rename()
+                elif choice == "11":
+                    self.read_range()
+                elif choice == "12":
+                    self.write_at()
+                elif choice == "13":
+                    self.append()
+                elif choice == "14":
+                    print(f"Client {self.client_id} exiting...")
+                    break
                 else:
-                    print("Failed to connect to the primary server.")
-            else:
-                print("Failed to find the primary server.")
-                
+                    print("Invalid choice. Please enter a number between 1 and 14.")
         except Exception as e:
             print(f"Error in handle_operations: {e}")
             exit(1)
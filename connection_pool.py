@@ -0,0 +1,282 @@
+"""
+Connection Pool for Distributed File System
+
+Keeps long-lived connections to peers (master server and chunk servers) so that
+requests reuse an open TCP connection instead of paying a connect/teardown for
+every message. Clients, chunk servers and the replication manager of the master
+each keep a pool of their own.
+"""
+
+import collections
+import contextlib
+import select
+import socket
+import threading
+import time
+
+import protocol
+
+# Maximum number of connections (idle and in use) kept per destination
+DEFAULT_MAX_CONNECTIONS_PER_PEER = 8
+# Idle connections older than this many seconds are closed instead of reused
+DEFAULT_MAX_IDLE_TIME = 60
+# Seconds to wait when establishing a new connection
+DEFAULT_CONNECT_TIMEOUT = 5
+
+
+class PoolExhaustedError(Exception):
+    """
+    Raised when no connection to a destination became available in time
+    """
+
+
+class ConnectionPool:
+    """
+    Pool of persistent connections keyed by peer address
+
+    This class:
+    - Keeps idle keepalive connections per (ip, port) destination
+    - Bounds the number of connections per destination
+    - Health checks idle connections before handing them out
+    - Evicts connections that were idle for longer than max_idle_time
+    """
+
+    def __init__(self, max_connections_per_peer=DEFAULT_MAX_CONNECTIONS_PER_PEER,
+                 max_idle_time=DEFAULT_MAX_IDLE_TIME, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 socket_timeout=None):
+        """
+        Initialize the connection pool
+
+        Args:
+            max_connections_per_peer (int): Maximum open connections per destination
+            max_idle_time (float): Seconds an idle connection may be kept
+            connect_timeout (float): Seconds to wait for a new connection
+            socket_timeout (float): Timeout set on pooled sockets, None for blocking
+        """
+        self.max_connections_per_peer = max_connections_per_peer
+        self.max_idle_time = max_idle_time
+        self.connect_timeout = connect_timeout
+        self.socket_timeout = socket_timeout
+        self.condition = threading.Condition()
+        # Idle connections per destination: {address: deque([(socket, last_used), ...])}
+        self.idle_connections = collections.defaultdict(collections.deque)
+        # Number of open connections (idle and in use) per destination
+        self.open_connections = collections.defaultdict(int)
+
+    def create_connection(self, address):
+        """
+        Open a new keepalive connection to a destination
+
+        Args:
+            address (tuple): (ip, port) of the peer
+        """
+        sock = socket.create_connection(address, timeout=self.connect_timeout)
+        sock.settimeout(self.socket_timeout)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Frames are small and latency sensitive
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    @staticmethod
+    def is_healthy(sock):
+        """
+        Check that an idle connection is still usable
+
+        An idle connection must not be readable: readable means the peer closed
+        it (recv returns b"") or sent unexpected data, both make it unusable.
+
+        Args:
+            sock: Idle socket to check
+        """
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def acquire(self, address, timeout=None):
+        """
+        Get a connection to a destination, reusing an idle one when possible
+
+        Args:
+            address (tuple): (ip, port) of the peer
+            timeout (float): Seconds to wait for a free slot, None to wait forever
+
+        Returns:
+            tuple: (socket, reused) where reused tells whether the connection was pooled
+        """
+        address = (address[0], int(address[1]))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        stale = []
+
+        with self.condition:
+            while True:
+                idle = self.idle_connections[address]
+                # Newest connections are reused first, older ones age out
+                while idle:
+                    sock, last_used = idle.pop()
+                    if time.monotonic() - last_used <= self.max_idle_time and self.is_healthy(sock):
+                        break
+                    stale.append(sock)
+                    self.open_connections[address] -= 1
+                else:
+                    sock = None
+
+                if sock is not None:
+                    reused = True
+                    break
+                if self.open_connections[address] < self.max_connections_per_peer:
+                    # Reserve the slot, the connection is opened outside the lock
+                    self.open_connections[address] += 1
+                    reused = False
+                    break
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise PoolExhaustedError(f"No connection to {address[0]}:{address[1]} available")
+                self.condition.wait(remaining)
+
+        for stale_sock in stale:
+            stale_sock.close()
+
+        if not reused:
+            try:
+                sock = self.create_connection(address)
+            except BaseException:
+                with self.condition:
+                    self.open_connections[address] -= 1
+                    self.condition.notify()
+                raise
+
+        return sock, reused
+
+    def release(self, address, sock):
+        """
+        Return a healthy connection to the pool
+
+        Args:
+            address (tuple): (ip, port) the connection belongs to
+            sock: Socket obtained from acquire
+        """
+        address = (address[0], int(address[1]))
+        with self.condition:
+            self.idle_connections[address].append((sock, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self, address, sock):
+        """
+        Close a connection that is broken or in an unknown state
+
+        Args:
+            address (tuple): (ip, port) the connection belongs to
+            sock: Socket obtained from acquire
+        """
+        address = (address[0], int(address[1]))
+        sock.close()
+        with self.condition:
+            self.open_connections[address] -= 1
+            self.condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self, address, timeout=None):
+        """
+        Context manager returning a pooled connection
+
+        The connection goes back to the pool when the block completes and is
+        closed if the block raises, since its framing state is then unknown.
+
+        Args:
+            address (tuple): (ip, port) of the peer
+            timeout (float): Seconds to wait for a free slot
+        """
+        sock, _ = self.acquire(address, timeout)
+        try:
+            yield sock
+        except BaseException:
+            self.discard(address, sock)
+            raise
+        self.release(address, sock)
+
+    def request(self, address, opcode, *fields, idempotent=False):
+        """
+        Send a request over a pooled connection and wait for its response
+
+        A request that could not be sent on a reused connection is retried once
+        on a new connection, since the peer may have closed it while it was idle.
+        Once the request was sent the peer may have carried it out, so a failure
+        while waiting for the response is only retried for idempotent requests;
+        sending a WRITE_AT or RECORD_APPEND again would apply it twice.
+
+        Args:
+            address (tuple): (ip, port) of the peer
+            opcode (int): Request opcode
+            *fields: Request fields
+            idempotent (bool): Whether the request may be carried out more than once
+
+        Returns:
+            tuple: (response_opcode, response_fields)
+        """
+        for attempt in range(2):
+            sock, reused = self.acquire(address)
+            request_id = protocol.next_request_id()
+            sent = False
+            try:
+                protocol.send_frame(sock, opcode, request_id, protocol.pack_fields(*fields))
+                sent = True
+                response = protocol.recv_response(sock, request_id)
+            except (OSError, protocol.ProtocolError):
+                self.discard(address, sock)
+                if reused and attempt == 0 and (idempotent or not sent):
+                    continue
+                raise
+            except BaseException:
+                self.discard(address, sock)
+                raise
+            self.release(address, sock)
+            return response
+
+    def evict_idle(self):
+        """
+        Close every idle connection older than max_idle_time
+        """
+        expired = []
+        now = time.monotonic()
+        with self.condition:
+            for address, idle in self.idle_connections.items():
+                while idle and now - idle[0][1] > self.max_idle_time:
+                    expired.append(idle.popleft()[0])
+                    self.open_connections[address] -= 1
+            self.condition.notify_all()
+        for sock in expired:
+            sock.close()
+
+    def start_eviction_thread(self, interval=None):
+        """
+        Start a daemon thread that periodically closes expired idle connections
+
+        Args:
+            interval (float): Seconds between eviction passes, defaults to half of max_idle_time
+        """
+        interval = interval if interval is not None else self.max_idle_time / 2
+
+        def evict_forever():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+
+        threading.Thread(target=evict_forever, daemon=True).start()
+
+    def close_all(self):
+        """
+        Close every idle connection in the pool
+        """
+        with self.condition:
+            idle_connections = [
+                (address, sock) for address, idle in self.idle_connections.items() for sock, _ in idle
+            ]
+            for address, idle in self.idle_connections.items():
+                self.open_connections[address] -= len(idle)
+                idle.clear()
+            self.condition.notify_all()
+        for _, sock in idle_connections:
+            sock.close()
@@ -0,0 +1,526 @@
+"""
+Memory-Mapped Extent Storage for Chunk Servers
+
+Keeping every chunk in its own file costs an open(), a close() and an inode
+per chunk, which dominates when a chunk server stores millions of small
+chunks. The extent store packs chunks into a few large preallocated extent
+files instead, each one memory mapped once for the life of the process:
+
+    extents/extent_<n>   preallocated data files, chunks at SLOT_ALIGNMENT boundaries
+    extents/index        append-only log of index records, replayed at startup
+
+    +---------+--------------------+-----------+--------+--------+----------------+-------------+
+    | op (u8) | chunk handle (u64) | extent id | offset | length | checksum count | checksums   |
+    |         |                    | (u32)     | (u64)  | (u64)  | (u32)          | (u32 each)  |
+    +---------+--------------------+-----------+--------+--------+----------------+-------------+
+
+Writes copy the chunk into the mapping and append one index record, reads
+copy out of the mapping or sendfile() from the extent file. Nothing is
+flushed per request: a background thread msyncs the dirty range of every
+extent and then fsyncs the index every sync_interval seconds, so one flush
+covers all the writes of that interval. A chunk whose index record reached
+the disk before its data did fails its block checksums after a crash and is
+re-replicated like any other corrupt chunk.
+
+Space of replaced and deleted chunks is reused for later chunks of the same
+or a smaller size, neighbouring free space is merged into one piece. A slot
+is only reused once no reader has it open, so a chunk being sent keeps the
+content it had when it was opened.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Size of every extent file, chunks larger than this get an extent of their own
+DEFAULT_EXTENT_SIZE = 256 * 1024 * 1024
+# Seconds between two flushes of the dirty extent ranges and the index
+DEFAULT_SYNC_INTERVAL = 0.05
+# Chunks start at multiples of this many bytes
+SLOT_ALIGNMENT = 512
+# Index records beyond twice the live chunks (and at least this many) trigger a rewrite of the index
+COMPACT_MIN_RECORDS = 100000
+
+# Index record header and operations
+RECORD_HEADER = struct.Struct("!BQIQQI")
+PUT = 1
+DELETE = 2
+
+
+class Extent:
+    """
+    One preallocated, memory-mapped extent file
+    """
+
+    __slots__ = ('extent_id', 'fd', 'size', 'map')
+
+    def __init__(self, extent_id, path, size):
+        self.extent_id = extent_id
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < size:
+            # Allocate the blocks now so writes into the mapping never hit a full disk
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.fd, 0, size)
+            else:
+                os.ftruncate(self.fd, size)
+        self.size = os.fstat(self.fd).st_size
+        self.map = mmap.mmap(self.fd, self.size)
+
+
+class Slot:
+    """
+    Space of one chunk in an extent
+    """
+
+    __slots__ = ('extent', 'offset', 'length', 'capacity', 'checksums', 'version', 'pins', 'retired')
+
+    def __init__(self, extent, offset, length, capacity):
+        self.extent = extent
+        self.offset = offset
+        self.length = length
+        self.capacity = capacity
+        self.checksums = None
+        self.version = None
+        # Readers that have the chunk open, and whether it was replaced or deleted meanwhile
+        self.pins = 0
+        self.retired = False
+
+
+class ExtentRegion:
+    """
+    A chunk opened for reading, its slot is not reused until the region is closed
+
+    Used like the file returned by open(): the content starts at byte base of
+    the extent file behind fileno(), so it can be sent with sendfile().
+    """
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+        self.base = slot.offset
+        self.size = slot.length
+        self.checksums = slot.checksums
+        self.version = slot.version
+        self.closed = False
+
+    def fileno(self):
+        return self.slot.extent.fd
+
+    def read(self):
+        """
+        Return a copy of the whole chunk, taken straight from the mapping
+        """
+        return self.slot.extent.map[self.base:self.base + self.size]
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.store.unpin(self.slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ExtentStore:
+    """
+    Chunk handle -> slot in a memory-mapped extent file
+
+    This class:
+    - Allocates aligned slots in preallocated extents, reusing freed space
+    - Copies chunk content into the mapping without opening any file
+    - Logs every put and delete to the index and replays it at startup
+    - Flushes the dirty extent ranges and the index in batches
+    - Keeps the slots of open chunks until their readers are done
+    """
+
+    def __init__(self, directory, extent_size=DEFAULT_EXTENT_SIZE, sync_interval=DEFAULT_SYNC_INTERVAL):
+        """
+        Open the extent store, replaying its index
+
+        Args:
+            directory (str): Directory holding the extent files and the index
+            extent_size (int): Size of every new extent file in bytes
+            sync_interval (float): Seconds between two flushes to disk
+        """
+        self.directory = directory
+        self.extent_size = extent_size
+        self.sync_interval = sync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        # Extent id -> Extent, the last one is filled from next_offset on
+        self.extents = {}
+        self.next_offset = 0
+        # Chunk handle -> Slot
+        self.index = {}
+        # Free space: capacity -> {(extent_id, offset): None} (newest last), and the sorted capacities
+        self.free_slots = {}
+        self.free_capacities = []
+        # Free space by (extent_id, start) -> capacity and (extent_id, end) -> start, to merge neighbours
+        self.free_starts = {}
+        self.free_ends = {}
+        self.next_version = 1
+        # Extent id -> [low, high) byte range written since the last flush
+        self.dirty = {}
+        self.index_dirty = False
+        self.index_records = 0
+
+        for name in os.listdir(directory):
+            if name.startswith("extent_") and name[len("extent_"):].isdigit():
+                extent_id = int(name[len("extent_"):])
+                self.extents[extent_id] = Extent(extent_id, os.path.join(directory, name), extent_size)
+        self.index_path = os.path.join(directory, "index")
+        self.replay_index()
+        self.index_fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def replay_index(self):
+        """
+        Rebuild the chunk index and the free space from the index file
+        """
+        try:
+            with open(self.index_path, 'rb') as index_file:
+                data = index_file.read()
+        except FileNotFoundError:
+            data = b""
+
+        position = 0
+        while position + RECORD_HEADER.size <= len(data):
+            op, chunk_handle, extent_id, offset, length, count = RECORD_HEADER.unpack_from(data, position)
+            end = position + RECORD_HEADER.size + count * 4
+            if end > len(data):
+                break  # Torn last record
+            if op == PUT and extent_id in self.extents:
+                slot = Slot(self.extents[extent_id], offset, length, self.slot_capacity(length))
+                slot.checksums = struct.unpack_from(f"!{count}I", data, position + RECORD_HEADER.size)
+                slot.version = self.take_version()
+                self.index[chunk_handle] = slot
+            else:
+                self.index.pop(chunk_handle, None)
+            self.index_records += 1
+            position = end
+        if position < len(data):
+            with open(self.index_path, 'r+b') as index_file:
+                index_file.truncate(position)
+
+        # Every gap between live chunks is free, new chunks go after the last one
+        used = {}
+        for slot in self.index.values():
+            used.setdefault(slot.extent.extent_id, []).append((slot.offset, slot.capacity))
+        for extent_id, extent in sorted(self.extents.items()):
+            end = 0
+            for offset, capacity in sorted(used.get(extent_id, [])):
+                if offset > end:
+                    self.add_free(extent_id, end, offset - end)
+                end = max(end, offset + capacity)
+            if extent_id == max(self.extents):
+                self.next_offset = end
+            elif end < extent.size:
+                self.add_free(extent_id, end, extent.size - end)
+        print(f"Extent store opened: {len(self.index)} chunks in {len(self.extents)} extent(s).")
+
+    @staticmethod
+    def slot_capacity(length):
+        """
+        Return the space allocated for a chunk of a given length
+        """
+        return max(1, -(-length // SLOT_ALIGNMENT)) * SLOT_ALIGNMENT
+
+    def take_version(self):
+        """
+        Return a new version number, must be called with lock held
+        """
+        version = self.next_version
+        self.next_version += 1
+        return version
+
+    def add_free(self, extent_id, offset, capacity):
+        """
+        Return space to the free lists, must be called with lock held
+
+        Free space right before or after it is merged in, so deleting and
+        replacing chunks does not split the extents into ever smaller pieces.
+        Space ending where the last extent is filled from goes back to it.
+        """
+        before = self.free_ends.get((extent_id, offset))
+        if before is not None:
+            self.remove_free(extent_id, before, offset - before)
+            capacity += offset - before
+            offset = before
+        after = self.free_starts.get((extent_id, offset + capacity))
+        if after is not None:
+            self.remove_free(extent_id, offset + capacity, after)
+            capacity += after
+        if self.extents and extent_id == max(self.extents) and offset + capacity == self.next_offset:
+            self.next_offset = offset
+            return
+
+        slots = self.free_slots.get(capacity)
+        if slots is None:
+            slots = self.free_slots[capacity] = {}
+            bisect.insort(self.free_capacities, capacity)
+        slots[(extent_id, offset)] = None
+        self.free_starts[(extent_id, offset)] = capacity
+        self.free_ends[(extent_id, offset + capacity)] = offset
+
+    def remove_free(self, extent_id, offset, capacity):
+        """
+        Take space off the free lists, must be called with lock held
+        """
+        slots = self.free_slots[capacity]
+        del slots[(extent_id, offset)]
+        if not slots:
+            del self.free_slots[capacity]
+            del self.free_capacities[bisect.bisect_left(self.free_capacities, capacity)]
+        del self.free_starts[(extent_id, offset)]
+        del self.free_ends[(extent_id, offset + capacity)]
+
+    def allocate(self, capacity):
+        """
+        Find space for a chunk, must be called with lock held
+
+        The smallest free slot that fits is used and its remainder stays free,
+        otherwise the space after the last chunk, otherwise a new extent.
+
+        Returns:
+            tuple: (Extent, offset)
+        """
+        index = bisect.bisect_left(self.free_capacities, capacity)
+        if index < len(self.free_capacities):
+            free_capacity = self.free_capacities[index]
+            # The most recently freed slot of that size
+            extent_id, offset = next(reversed(self.free_slots[free_capacity]))
+            self.remove_free(extent_id, offset, free_capacity)
+            if free_capacity > capacity:
+                self.add_free(extent_id, offset + capacity, free_capacity - capacity)
+            return self.extents[extent_id], offset
+
+        extent = self.extents[max(self.extents)] if self.extents else None
+        if extent is None or self.next_offset + capacity > extent.size:
+            if extent is not None and self.next_offset < extent.size:
+                self.add_free(extent.extent_id, self.next_offset, extent.size - self.next_offset)
+            extent_id = max(self.extents) + 1 if self.extents else 0
+            extent = self.extents[extent_id] = Extent(
+                extent_id, os.path.join(self.directory, f"extent_{extent_id}"), max(self.extent_size, capacity)
+            )
+            self.next_offset = 0
+        offset = self.next_offset
+        self.next_offset += capacity
+        return extent, offset
+
+    def reserve(self, length):
+        """
+        Allocate the slot of a chunk that is about to be written
+
+        Args:
+            length (int): Size of the chunk in bytes
+
+        Returns:
+            Slot: Space to fill with write() and then commit() or release()
+        """
+        capacity = self.slot_capacity(length)
+        with self.lock:
+            extent, offset = self.allocate(capacity)
+        return Slot(extent, offset, length, capacity)
+
+    def write(self, slot, position, data):
+        """
+        Copy part of a chunk into its reserved slot
+
+        Args:
+            slot (Slot): Slot from reserve()
+            position (int): Position of data in the chunk
+            data (bytes): Chunk content
+        """
+        if position + len(data) > slot.length:
+            raise ValueError(f"{position + len(data)} bytes written into a slot of {slot.length}")
+        start = slot.offset + position
+        slot.extent.map[start:start + len(data)] = data
+
+    def commit(self, chunk_handle, slot, checksums):
+        """
+        Make a fully written slot the content of a chunk, replacing the previous one
+
+        Must be called with the write lock of the chunk held.
+
+        Args:
+            chunk_handle (int): Handle of the chunk
+            slot (Slot): Slot from reserve(), filled with write()
+            checksums (list): Block checksums of the content
+        """
+        with self.lock:
+            slot.checksums = tuple(checksums)
+            slot.version = self.take_version()
+            self.log_record(PUT, chunk_handle, slot)
+            dirty = self.dirty.setdefault(slot.extent.extent_id, [slot.offset, slot.offset + slot.length])
+            dirty[0] = min(dirty[0], slot.offset)
+            dirty[1] = max(dirty[1], slot.offset + slot.length)
+            previous = self.index.get(chunk_handle)
+            self.index[chunk_handle] = slot
+            if previous is not None:
+                self.retire(previous)
+
+    def release(self, slot):
+        """
+        Free a reserved slot that was never committed
+
+        Args:
+            slot (Slot): Slot from reserve()
+        """
+        with self.lock:
+            self.add_free(slot.extent.extent_id, slot.offset, slot.capacity)
+
+    def put(self, chunk_handle, data, checksums):
+        """
+        Store the whole content of a chunk, must be called with the write lock of the chunk held
+
+        Args:
+            chunk_handle (int): Handle of the chunk
+            data (bytes): Chunk content
+            checksums (list): Block checksums of data
+        """
+        slot = self.reserve(len(data))
+        self.write(slot, 0, data)
+        self.commit(chunk_handle, slot, checksums)
+
+    def open(self, chunk_handle):
+        """
+        Open a chunk for reading, must be called with the lock of the chunk held
+
+        Args:
+            chunk_handle (int): Handle of the chunk
+
+        Returns:
+            ExtentRegion: Open chunk, or None if the chunk is not stored
+        """
+        with self.lock:
+            slot = self.index.get(chunk_handle)
+            if slot is None:
+                return None
+            slot.pins += 1
+        return ExtentRegion(self, slot)
+
+    def unpin(self, slot):
+        """
+        Close a chunk opened with open(), freeing its slot if it was retired meanwhile
+        """
+        with self.lock:
+            slot.pins -= 1
+            if slot.retired and not slot.pins:
+                self.add_free(slot.extent.extent_id, slot.offset, slot.capacity)
+
+    def retire(self, slot):
+        """
+        Free the slot of a replaced or deleted chunk once nobody reads it, must be called with lock held
+        """
+        slot.retired = True
+        if not slot.pins:
+            self.add_free(slot.extent.extent_id, slot.offset, slot.capacity)
+
+    def version(self, chunk_handle):
+        """
+        Return the version of a chunk, which changes whenever its content is replaced
+
+        Args:
+            chunk_handle (int): Handle of the chunk
+
+        Returns:
+            int: Version number, or None if the chunk is not stored
+        """
+        with self.lock:
+            slot = self.index.get(chunk_handle)
+            return slot.version if slot is not None else None
+
+    def delete(self, chunk_handle):
+        """
+        Delete a chunk, must be called with the write lock of the chunk held
+
+        Args:
+            chunk_handle (int): Handle of the chunk
+
+        Returns:
+            bool: Whether the chunk was stored
+        """
+        with self.lock:
+            slot = self.index.pop(chunk_handle, None)
+            if slot is None:
+                return False
+            self.log_record(DELETE, chunk_handle)
+            self.retire(slot)
+        return True
+
+    def handles(self):
+        """
+        Return the handles of all stored chunks
+        """
+        with self.lock:
+            return list(self.index)
+
+    def log_record(self, op, chunk_handle, slot=None):
+        """
+        Append a record to the index, must be called with lock held
+        """
+        if slot is None:
+            record = RECORD_HEADER.pack(op, chunk_handle, 0, 0, 0, 0)
+        else:
+            record = RECORD_HEADER.pack(
+                op, chunk_handle, slot.extent.extent_id, slot.offset, slot.length, len(slot.checksums)
+            ) + struct.pack(f"!{len(slot.checksums)}I", *slot.checksums)
+        os.write(self.index_fd, record)
+        self.index_records += 1
+        self.index_dirty = True
+
+    def sync(self):
+        """
+        Flush the extent ranges written since the last sync, then the index
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            index_dirty, self.index_dirty = self.index_dirty, False
+        for extent_id, (low, high) in dirty.items():
+            # msync() needs a start aligned to the allocation granularity
+            start = low - low % mmap.ALLOCATIONGRANULARITY
+            self.extents[extent_id].map.flush(start, high - start)
+        if index_dirty:
+            os.fsync(self.index_fd)
+
+        if self.index_records > max(2 * len(self.index), COMPACT_MIN_RECORDS):
+            self.compact_index()
+
+    def compact_index(self):
+        """
+        Rewrite the index with one record per live chunk
+        """
+        with self.lock:
+            with open(f"{self.index_path}.tmp", 'wb') as index_file:
+                for chunk_handle, slot in self.index.items():
+                    index_file.write(RECORD_HEADER.pack(
+                        PUT, chunk_handle, slot.extent.extent_id, slot.offset, slot.length, len(slot.checksums)
+                    ))
+                    index_file.write(struct.pack(f"!{len(slot.checksums)}I", *slot.checksums))
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            os.replace(f"{self.index_path}.tmp", self.index_path)
+            os.close(self.index_fd)
+            self.index_fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND)
+            self.index_records = len(self.index)
+        print(f"Extent index compacted to {len(self.index)} records.")
+
+    def start_sync_thread(self):
+        """
+        Flush written chunks to disk every sync_interval seconds until the process exits
+        """
+        def sync_forever():
+            while True:
+                time.sleep(self.sync_interval)
+                try:
+                    self.sync()
+                except OSError as e:
+                    print(f"Error syncing extent store: {e}")
+
+        threading.Thread(target=sync_forever, daemon=True).start()
@@ -0,0 +1,171 @@
+"""
+Chunk Location Cache for Clients
+
+Clients remember the chunk handles and replica locations the master returned,
+so repeated reads of a file do not ask the master again. Every chunk location
+expires after the time the master allows, the least recently used files are
+evicted once the cache holds too many chunks, and a file is dropped as soon as
+a chunk server shows that its cached locations are stale.
+"""
+
+import collections
+import threading
+import time
+
+# Chunk locations kept before the least recently used files are evicted
+DEFAULT_MAX_CHUNKS = 100000
+# Seconds locations are kept when the master did not say how long they are valid
+DEFAULT_TTL = 30
+
+
+class FileLocations:
+    """
+    Cached locations of the chunks of one file
+    """
+
+    __slots__ = ('chunk_size', 'chunk_count', 'chunks')
+
+    def __init__(self, chunk_size, chunk_count):
+        self.chunk_size = chunk_size
+        self.chunk_count = chunk_count
+        # Chunk index -> (chunk_handle, replicas, time.monotonic() the entry expires)
+        self.chunks = {}
+
+
+class LocationCache:
+    """
+    LRU cache: file name -> chunk index -> (chunk handle, replicas)
+
+    This class:
+    - Returns cached chunk locations until they expire
+    - Evicts the least recently used files beyond max_chunks locations
+    - Drops the locations of a file on request (stale or changed file)
+    - Counts hits and misses
+    """
+
+    def __init__(self, max_chunks=DEFAULT_MAX_CHUNKS, default_ttl=DEFAULT_TTL):
+        """
+        Initialize the cache
+
+        Args:
+            max_chunks (int): Chunk locations kept before evicting files
+            default_ttl (float): Seconds locations are valid if the master sent no time
+        """
+        self.max_chunks = max_chunks
+        self.default_ttl = default_ttl
+        self.lock = threading.Lock()
+        # File name -> FileLocations, least recently used first
+        self.files = collections.OrderedDict()
+        self.cached_chunks = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, file_name, first_chunk=0, count=None):
+        """
+        Return cached locations of a range of chunks
+
+        Args:
+            file_name (str): Name of the file
+            first_chunk (int): Index of the first chunk
+            count (int): Number of chunks, None for every chunk from first_chunk
+
+        Returns:
+            tuple: (chunk_size, chunk_count, [(chunk_handle, replicas), ...]) or
+                   None unless every chunk of the range is cached and fresh
+        """
+        now = time.monotonic()
+        with self.lock:
+            locations = self.files.get(file_name)
+            if locations is not None:
+                end = locations.chunk_count if count is None else min(first_chunk + count, locations.chunk_count)
+                chunks = []
+                for index in range(first_chunk, end):
+                    cached = locations.chunks.get(index)
+                    if cached is None or cached[2] <= now:
+                        break
+                    chunks.append(cached[:2])
+                else:
+                    self.files.move_to_end(file_name)
+                    self.hits += 1
+                    return locations.chunk_size, locations.chunk_count, chunks
+            self.misses += 1
+            return None
+
+    def store(self, file_name, chunk_size, chunk_count, first_chunk, chunks, ttl=None):
+        """
+        Cache the locations of a range of chunks returned by the master
+
+        Args:
+            file_name (str): Name of the file
+            chunk_size (int): Chunk size of the file
+            chunk_count (int): Number of chunks of the whole file
+            first_chunk (int): Index of the first chunk in chunks
+            chunks (list): (chunk_handle, replicas) tuples
+            ttl (float): Seconds the locations are valid, None for default_ttl
+        """
+        expires = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        with self.lock:
+            locations = self.files.get(file_name)
+            if locations is None or locations.chunk_count != chunk_count or locations.chunk_size != chunk_size:
+                # A file that changed size was recreated, its old chunks are stale
+                self.remove(file_name)
+                locations = self.files[file_name] = FileLocations(chunk_size, chunk_count)
+            self.files.move_to_end(file_name)
+            for index, (chunk_handle, replicas) in enumerate(chunks, first_chunk):
+                if index not in locations.chunks:
+                    self.cached_chunks += 1
+                locations.chunks[index] = (chunk_handle, replicas, expires)
+
+            # Evict the least recently used files, never the one just stored
+            while self.cached_chunks > self.max_chunks and len(self.files) > 1:
+                self.remove(next(iter(self.files)))
+
+    def invalidate(self, file_name):
+        """
+        Drop the cached locations of a file
+
+        Args:
+            file_name (str): Name of the file
+        """
+        with self.lock:
+            self.remove(file_name)
+
+    def invalidate_chunk(self, file_name, index, chunk_handle):
+        """
+        Drop the cached locations of a file after a chunk turned out to be stale
+
+        Nothing is dropped if the chunk was already looked up again, so readers
+        that hit the same stale chunk concurrently do not discard each other's
+        fresh locations.
+
+        Args:
+            file_name (str): Name of the file
+            index (int): Index of the chunk in the file
+            chunk_handle (int): Chunk handle that was found stale
+        """
+        with self.lock:
+            locations = self.files.get(file_name)
+            if locations is not None:
+                cached = locations.chunks.get(index)
+                if cached is None or cached[0] == chunk_handle:
+                    self.remove(file_name)
+
+    def invalidate_prefix(self, path):
+        """
+        Drop the cached locations of a path and of every file below it
+
+        Args:
+            path (str): File or directory path
+        """
+        prefix = path.rstrip("/") + "/"
+        with self.lock:
+            for file_name in [name for name in self.files if name == path or name.startswith(prefix)]:
+                self.remove(file_name)
+
+    def remove(self, file_name):
+        """
+        Remove a file from the cache, must be called with lock held
+        """
+        locations = self.files.pop(file_name, None)
+        if locations is not None:
+            self.cached_chunks -= len(locations.chunks)
@@ -0,0 +1,236 @@
+"""
+Lock Manager for Distributed File System
+
+Provides one reader/writer lock per key (a file name or a chunk handle) instead
+of a single global lock, so operations on unrelated files never wait for each
+other and concurrent reads of the same file share the lock.
+"""
+
+import contextlib
+import threading
+
+
+class LockTimeoutError(Exception):
+    """
+    Raised when a lock could not be acquired within the allowed time
+    """
+
+
+class ReadWriteLock:
+    """
+    Reader/writer lock
+
+    Any number of readers may hold the lock together, a writer holds it alone.
+    Waiting writers block new readers so writers are not starved.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_read(self, timeout=None):
+        """
+        Acquire the lock for reading
+
+        Args:
+            timeout (float): Seconds to wait, 0 to fail fast, None to wait forever
+
+        Returns:
+            bool: True if the lock was acquired
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: not self.writer and not self.waiting_writers, timeout):
+                return False
+            self.readers += 1
+            return True
+
+    def release_read(self):
+        """
+        Release a read lock
+        """
+        with self.condition:
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all()
+
+    def acquire_write(self, timeout=None):
+        """
+        Acquire the lock for writing
+
+        Args:
+            timeout (float): Seconds to wait, 0 to fail fast, None to wait forever
+
+        Returns:
+            bool: True if the lock was acquired
+        """
+        with self.condition:
+            self.waiting_writers += 1
+            try:
+                if not self.condition.wait_for(lambda: not self.writer and self.readers == 0, timeout):
+                    return False
+            finally:
+                self.waiting_writers -= 1
+                if not self.waiting_writers:
+                    # Readers held back by this writer may proceed if it gave up
+                    self.condition.notify_all()
+            self.writer = True
+            return True
+
+    def release_write(self):
+        """
+        Release a write lock
+        """
+        with self.condition:
+            self.writer = False
+            self.condition.notify_all()
+
+
+class LockManager:
+    """
+    Table of reader/writer locks keyed by file name or chunk handle
+
+    Lock entries are created on first use and removed as soon as no thread holds
+    or waits for them, so the table only grows with the number of files that are
+    being accessed right now.
+    """
+
+    def __init__(self):
+        self.table_lock = threading.Lock()
+        # {key: [ReadWriteLock, number of threads holding or waiting for it]}
+        self.locks = {}
+        # Number of threads blocked in acquire, reported as the request queue depth
+        self.waiting = 0
+
+    def reference(self, key):
+        """
+        Get the lock of a key and register the caller as a user of it
+
+        The caller is counted as waiting until it calls stop_waiting.
+
+        Args:
+            key: File name, chunk handle or any hashable identifier
+        """
+        with self.table_lock:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [ReadWriteLock(), 0]
+            entry[1] += 1
+            self.waiting += 1
+            return entry[0]
+
+    def stop_waiting(self):
+        """
+        Stop counting a caller of reference as waiting, once it got or gave up the lock
+        """
+        with self.table_lock:
+            self.waiting -= 1
+
+    def dereference(self, key):
+        """
+        Unregister a user of a key, removing the lock once it is idle
+
+        Args:
+            key: Key passed to reference
+        """
+        with self.table_lock:
+            entry = self.locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    def acquire_read(self, key, timeout=None):
+        """
+        Acquire the read lock of a key until release_read is called
+
+        Used when the lock must outlive the call that took it, for example
+        while a response is sent after the request handler returned.
+
+        Args:
+            key: File name, chunk handle or any hashable identifier
+            timeout (float): Seconds to wait, 0 to fail fast, None to wait forever
+
+        Raises:
+            LockTimeoutError: If the lock was not acquired in time
+        """
+        lock = self.reference(key)
+        acquired = False
+        try:
+            acquired = lock.acquire_read(timeout)
+        finally:
+            self.stop_waiting()
+            if not acquired:
+                self.dereference(key)
+        if not acquired:
+            raise LockTimeoutError(f"Timed out waiting for read lock on {key}")
+
+    def release_read(self, key):
+        """
+        Release a read lock taken with acquire_read, from any thread
+
+        Args:
+            key: Key passed to acquire_read
+        """
+        with self.table_lock:
+            lock = self.locks[key][0]
+        lock.release_read()
+        self.dereference(key)
+
+    @contextlib.contextmanager
+    def read_lock(self, key, timeout=None):
+        """
+        Hold the read lock of a key for the duration of a with block
+
+        Args:
+            key: File name, chunk handle or any hashable identifier
+            timeout (float): Seconds to wait, 0 to fail fast, None to wait forever
+
+        Raises:
+            LockTimeoutError: If the lock was not acquired in time
+        """
+        self.acquire_read(key, timeout)
+        try:
+            yield
+        finally:
+            self.release_read(key)
+
+    @contextlib.contextmanager
+    def write_lock(self, key, timeout=None):
+        """
+        Hold the write lock of a key for the duration of a with block
+
+        Args:
+            key: File name, chunk handle or any hashable identifier
+            timeout (float): Seconds to wait, 0 to fail fast, None to wait forever
+
+        Raises:
+            LockTimeoutError: If the lock was not acquired in time
+        """
+        lock = self.reference(key)
+        try:
+            try:
+                if not lock.acquire_write(timeout):
+                    raise LockTimeoutError(f"Timed out waiting for write lock on {key}")
+            finally:
+                self.stop_waiting()
+            try:
+                yield
+            finally:
+                lock.release_write()
+        finally:
+            self.dereference(key)
+
+    def active_locks(self):
+        """
+        Return the number of keys that currently have a lock entry
+        """
+        with self.table_lock:
+            return len(self.locks)
+
+    def waiting_count(self):
+        """
+        Return the number of threads currently waiting for a lock
+        """
+        with self.table_lock:
+            return self.waiting
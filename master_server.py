@@ -1,8 +1,48 @@
 import socket
 import threading
-import random
 import json
+import os
+import random
+import sys
+import time
 
+import protocol
+from async_master_server import AsyncMasterServer
+from namespace import (
+    Namespace, NamespaceError, InvalidPathError, PathNotFoundError, PathExistsError, NotDirectoryError, FileEntry,
+    ChunkRecord, encode_record,
+)
+from operation_log import OperationLog, OperationLogError, write_snapshot
+from replication_manager import ReplicationManager, DEFAULT_REPLICATION_DELAY, DEFAULT_COPY_BANDWIDTH
+
+# Files are split into chunks of this size
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+# Number of chunk servers each chunk is placed on
+DEFAULT_REPLICATION_FACTOR = 3
+# Pending connections queued by the kernel, bursts of client lookups must not be refused
+LISTEN_BACKLOG = 1024
+# Heartbeats a chunk server may miss before it is declared failed, a pause of a
+# few beats (garbage collection, a busy disk or worker pool) is not a failure
+MISSED_HEARTBEATS = 8
+# A chunk server is declared failed after this many seconds without a heartbeat
+DEFAULT_HEARTBEAT_TIMEOUT = MISSED_HEARTBEATS * protocol.HEARTBEAT_INTERVAL
+# Transfer rate counted as one busy request in a chunk server load score
+LOAD_BYTES_PER_REQUEST = 64 * 1024 * 1024
+# Weight of the newest heartbeat in the smoothed load score (EWMA)
+LOAD_SMOOTHING = 0.3
+# Seconds a primary lease on a file or chunk lasts unless renewed by a heartbeat
+DEFAULT_LEASE_DURATION = 10
+# Seconds clients may cache chunk locations returned for a range of chunks
+DEFAULT_LOCATION_TTL = 60
+# A metadata snapshot is taken after this many operation log records
+DEFAULT_SNAPSHOT_INTERVAL = 100000
+# Response sent for each kind of invalid namespace operation
+NAMESPACE_ERROR_RESPONSES = {
+    InvalidPathError: protocol.INVALID_REQUEST,
+    PathNotFoundError: protocol.FILE_NOT_FOUND,
+    PathExistsError: protocol.FILE_EXISTS,
+    NotDirectoryError: protocol.NOT_A_DIRECTORY,
+}
 
 class Main_Server:
     """
@@ -15,36 +55,94 @@ class Main_Server:
     - Coordinates communication between clients and chunk servers
     """
 
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, chunk_size=DEFAULT_CHUNK_SIZE,
+                 replication_factor=DEFAULT_REPLICATION_FACTOR, metadata_file="metadata.json",
+                 heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT, lease_duration=DEFAULT_LEASE_DURATION,
+                 log_file="metadata.log", snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL,
+                 location_ttl=DEFAULT_LOCATION_TTL, replication_delay=DEFAULT_REPLICATION_DELAY,
+                 copy_bandwidth=DEFAULT_COPY_BANDWIDTH):
         """
         Initialize the Master Server
         
         Args:
             ip (str): IP address to bind the server to
             port (int): Port number to listen on
+            chunk_size (int): Size in bytes of the chunks files are split into
+            replication_factor (int): Number of chunk servers each chunk is placed on
+            metadata_file (str): Path of the metadata snapshot
+            heartbeat_timeout (float): Seconds without a heartbeat before a chunk server is declared failed
+            lease_duration (float): Seconds a primary lease lasts unless renewed
+            log_file (str): Path prefix of the operation log segments
+            snapshot_interval (int): Operation log records between two snapshots
+            location_ttl (float): Seconds clients may cache chunk locations
+            replication_delay (float): Seconds before the chunks of a failed chunk server are re-replicated
+            copy_bandwidth (int): Bytes per second a chunk server may use to copy chunks for re-replication, 0 for no limit
         """
+        if chunk_size > protocol.MAX_CHUNK_SIZE:
+            raise ValueError(f"Chunk size {chunk_size} exceeds the {protocol.MAX_CHUNK_SIZE} bytes a frame can carry")
         self.ip = ip
         self.port = port
+        self.chunk_size = chunk_size
+        self.replication_factor = replication_factor
+        self.metadata_file = metadata_file
+        self.heartbeat_timeout = heartbeat_timeout
+        self.lease_duration = lease_duration
+        self.snapshot_interval = snapshot_interval
+        self.location_ttl = location_ttl
         # Thread lock for thread-safe access to metadata
         self.metadata_lock = threading.Lock()
         # Dictionary to store chunk server information
-        # Format: {chunk_server_id: {'ip': str, 'port': int, 'is_primary': bool, 'files': dict}}
+        # Format: {chunk_server_id: {'ip': str, 'port': int, 'is_primary': bool}}
         self.chunk_servers = {}
+        # Directory tree, every file maps to its ordered chunk handles and the
+        # chunk servers storing it whole. Protected by its own path locks
+        self.namespace = Namespace()
+        # Chunk handle -> ChunkRecord holding the ids of the chunk servers with a replica
+        self.chunks = {}
+        self.next_chunk_handle = 1
+        # Rotates the first chunk server used for placement
+        self.next_placement = 0
+        # Chunk server id -> time.monotonic() of its last heartbeat (not persisted)
+        self.last_heartbeat = {}
+        # Chunk server id -> time.monotonic() it was declared failed (not persisted)
+        self.failed_at = {}
+        # Chunk server id -> latest load report, keyed by protocol.LOAD_REPORT_FIELDS
+        self.load_reports = {}
+        # Chunk server id -> load score smoothed over recent heartbeats, see update_load_score
+        self.load_scores = {}
+        # Primary leases: ("file", file_name) or ("chunk", chunk_handle) ->
+        # [chunk_server_id, time.monotonic() the lease ends] (not persisted)
+        self.leases = {}
+        self.next_lease_prune = 0
         # Create TCP socket for server communication
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Allow a restarted server to bind while old connections are in TIME_WAIT
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((ip, port))
-        self.server_socket.listen(5)  # Allow up to 5 pending connections
+        self.server_socket.listen(LISTEN_BACKLOG)
         print(f"Master Server listening on {ip}:{port}")
+        # Rebuild the metadata from the last snapshot and the operation log
+        self.operation_log = OperationLog(log_file)
+        self.recover_metadata()
+        self.start_snapshot_thread()
+        # Detect failed chunk servers and move the primary role away from them
+        self.start_heartbeat_monitor()
+        # Restore lost replicas and spread chunks over all chunk servers
+        self.replication_manager = ReplicationManager(self, replication_delay, copy_bandwidth)
+        self.replication_manager.start()
 
     def update_primary(self):
         """
         Update the primary server selection
         
-        This method randomly selects a new primary server from the available chunk servers.
+        This method selects the least loaded chunk server as the new primary server.
         It ensures only one server is marked as primary at any time.
         """
-        # Randomly select a Chunk Server as primary
-        if self.chunk_servers:
+        # Select the least loaded Chunk Server as primary. The selection is made
+        # under the lock since failed chunk servers are removed concurrently
+        with self.metadata_lock:
+            if not self.chunk_servers:
+                return
             previous_primary_server_id = None
             # Find the current primary server if any exists
             if any(data['is_primary'] for data in self.chunk_servers.values()):
@@ -53,18 +151,19 @@ class Main_Server:
                     None
                 )
 
-            # Randomly select a new primary server
-            primary_server_id = random.choice(list(self.chunk_servers.keys()))
+            # Select the new primary server, ties go to the lowest id
+            primary_server_id = min(self.chunk_servers, key=lambda chunk_server_id: (
+                self.load_scores.get(chunk_server_id, 0), chunk_server_id
+            ))
 
-            with self.metadata_lock:
-                # Update previous primary server to False
-                if previous_primary_server_id is not None:
-                    self.chunk_servers[previous_primary_server_id]['is_primary'] = False
+            # Update previous primary server to False
+            if previous_primary_server_id is not None:
+                self.chunk_servers[previous_primary_server_id]['is_primary'] = False
 
-                # Update the new primary server to True
-                self.chunk_servers[primary_server_id]['is_primary'] = True
+            # Update the new primary server to True
+            self.chunk_servers[primary_server_id]['is_primary'] = True
 
-            print(f"Primary Server updated. New Primary Server: Chunk Server {primary_server_id}")
+        print(f"Primary Server updated. New Primary Server: Chunk Server {primary_server_id}")
 
     def register_chunk_server(self, chunk_server_id, chunk_server_ip, chunk_server_port):
         """
@@ -84,8 +183,9 @@ class Main_Server:
                 'ip': chunk_server_ip,
                 'port': chunk_server_port,
                 'is_primary': is_primary,
-                'files': {},  # Dictionary to store files managed by this chunk server
             }
+            self.last_heartbeat[chunk_server_id] = time.monotonic()
+            self.failed_at.pop(chunk_server_id, None)
         print(f"Chunk Server {chunk_server_id} registered.")
         self.update_primary()  # Update primary after registration
         self.print_metadata()  # Print metadata after registration
@@ -103,7 +203,7 @@ class Main_Server:
                 print(f"  IP: {data['ip']}")
                 print(f"  Port: {data['port']}")
                 print(f"  Primary: {data['is_primary']}")
-                print(f"  Files: {data['files']}")
+                print(f"  Load: {self.load_reports.get(chunk_server_id)}")
                 print("\n\n")
                 if data['is_primary']:
                     primary_server_id = chunk_server_id
@@ -116,90 +216,877 @@ class Main_Server:
 
             print("Chunk Servers Dictionary:")
             print(self.chunk_servers)
+            print(f"Files: {self.namespace.file_count}, Directories: {self.namespace.directory_count}, "
+                  f"Chunks: {len(self.chunks)}")
 
     def handle_client(self, client_socket):
         """
         Handle incoming client connections and messages
         
+        Frames are read until the peer closes the connection, so a client or
+        chunk server can send any number of requests over one connection.
+
         Args:
             client_socket: Socket connection to the client
         """
         try:
-            # Accept the connection from the Chunk Server
-            message = client_socket.recv(1024).decode()
-
-            # Route messages based on their type
-            if message == "FIND_PRIMARY_SERVER":
-                # Handle the FIND_PRIMARY_SERVER request
-                self.find_primary_server(client_socket)
-            elif message.startswith("REGISTER_CHUNK_SERVER"):
-                # Handle the REGISTER_CHUNK_SERVER request
-                # Parse message format: "REGISTER_CHUNK_SERVER:chunk_server_id:ip:port"
-                jay, chunk_server_id, chunk_server_ip, chunk_server_port = message.split(":")
-                chunk_server_id = int(chunk_server_id)
-                chunk_server_port = int(chunk_server_port)
-                self.register_chunk_server(chunk_server_id, chunk_server_ip, chunk_server_port)
-                self.update_primary()  # Update primary after registration
-                self.print_metadata()  # Print metadata after registration
-            elif message.startswith("CHUNK_SERVER_INFO"):
-                # Handle CHUNK_SERVER_INFO message from Chunk Server
-                self.handle_chunk_server_info(message)
-            else:
-                print(f"Invalid message from client: {message}")
+            while True:
+                frame = protocol.recv_frame(client_socket)
+                if frame is None:
+                    break  # Peer closed the connection
+                opcode, request_id, payload = frame
+                response_opcode, response_payload = self.handle_request(opcode, payload)
+                protocol.send_frame(client_socket, response_opcode, request_id, response_payload)
 
         except Exception as e:
             print(f"Error handling client: {e}")
 
-        # Note: Client socket is kept open for continued communication
-        # finally:
-        #     # Close the client socket
-        #     client_socket.close()
+        finally:
+            # Close the client socket
+            client_socket.close()
+
+    def handle_request(self, opcode, payload):
+        """
+        Route a single request frame to its handler
+        
+        Args:
+            opcode (int): Request opcode
+            payload (bytes): Request payload
+        
+        Returns:
+            tuple: (response_opcode, response_payload)
+        """
+        fields = protocol.unpack_fields(payload)
+        try:
+            return self.route_request(opcode, fields)
+        except NamespaceError as e:
+            print(f"Rejected {protocol.opcode_name(opcode)}: {e}")
+            return NAMESPACE_ERROR_RESPONSES[type(e)], b""
+        except OperationLogError as e:
+            # Nothing was changed, the operation was not applied
+            print(f"Failed {protocol.opcode_name(opcode)}: {e}")
+            return protocol.OPERATION_LOG_ERROR, b""
+
+    def route_request(self, opcode, fields):
+        """
+        Call the handler of a request opcode
+        
+        Args:
+            opcode (int): Request opcode
+            fields (list): Request payload fields
+        
+        Returns:
+            tuple: (response_opcode, response_payload)
+        
+        Raises:
+            NamespaceError: If the request names an invalid path
+        """
+        # Route messages based on their type
+        if opcode == protocol.FIND_PRIMARY_SERVER:
+            # Handle the FIND_PRIMARY_SERVER request
+            # Payload fields: optional file_name
+            if fields:
+                return self.find_file_primary(fields[0].decode())
+            return self.find_primary_server()
+        elif opcode == protocol.REGISTER_CHUNK_SERVER:
+            # Handle the REGISTER_CHUNK_SERVER request
+            # Payload fields: chunk_server_id, ip, port
+            chunk_server_id, chunk_server_ip, chunk_server_port = fields
+            chunk_server_id = int(chunk_server_id)
+            chunk_server_port = int(chunk_server_port)
+            self.register_chunk_server(chunk_server_id, chunk_server_ip.decode(), chunk_server_port)
+            self.update_primary()  # Update primary after registration
+            self.print_metadata()  # Print metadata after registration
+            # Chunk servers reject pushed chunks longer than the chunk size
+            return protocol.OK, protocol.pack_fields(self.chunk_size)
+        elif opcode == protocol.HEARTBEAT:
+            # Payload fields: chunk_server_id, load report, added chunks, removed chunks,
+            # chunk leases to renew, file leases to renew...
+            if len(fields) < 5:
+                return self.handle_heartbeat(int(fields[0]))
+            return self.handle_heartbeat(
+                int(fields[0]), protocol.unpack_load_report(fields[1]),
+                protocol.unpack_chunk_handles(fields[2]), protocol.unpack_chunk_handles(fields[3]),
+                [("chunk", chunk_handle) for chunk_handle in protocol.unpack_chunk_handles(fields[4])]
+                + [("file", file_name.decode()) for file_name in fields[5:]]
+            )
+        elif opcode == protocol.ACQUIRE_LEASE:
+            # Payload fields: chunk_server_id, "file" or "chunk", file_name or chunk_handle
+            kind = fields[1].decode()
+            key = int(fields[2]) if kind == "chunk" else fields[2].decode()
+            return self.acquire_lease(int(fields[0]), (kind, key))
+        elif opcode == protocol.CHUNK_SERVER_INFO:
+            # Handle CHUNK_SERVER_INFO message from Chunk Server
+            self.handle_chunk_server_info(fields)
+            return protocol.OK, b""
+        elif opcode == protocol.ALLOCATE_CHUNKS:
+            # Payload fields: file_name, file_size
+            return self.allocate_chunks(fields[0].decode(), int(fields[1]))
+        elif opcode == protocol.GET_CHUNK_LOCATIONS:
+            # Payload fields: file_name, optional client_ip (may be empty),
+            # optional first chunk index and number of chunks (0 for all)
+            client_ip = (fields[1].decode() or None) if len(fields) > 1 else None
+            if len(fields) > 3:
+                return self.get_chunk_locations(fields[0].decode(), client_ip, int(fields[2]), int(fields[3]))
+            return self.get_chunk_locations(fields[0].decode(), client_ip)
+        elif opcode == protocol.REMOVE_FILE:
+            return self.remove_file(fields[0].decode())
+        elif opcode == protocol.MAKE_DIRECTORY:
+            # Payload fields: path
+            return self.make_directory(fields[0].decode())
+        elif opcode == protocol.LIST_DIRECTORY:
+            # Payload fields: path
+            return self.list_directory(fields[0].decode())
+        elif opcode == protocol.RENAME:
+            # Payload fields: source path, target path
+            return self.rename(fields[0].decode(), fields[1].decode())
+        elif opcode == protocol.REPORT_CHUNKS:
+            # Payload fields: chunk_server_id, chunk_handle, ...
+            self.handle_chunk_report(int(fields[0]), [int(handle) for handle in fields[1:]])
+            return protocol.OK, b""
+        elif opcode == protocol.REPORT_CORRUPT_CHUNK:
+            # Payload fields: chunk_server_id, chunk_handle
+            return self.handle_corrupt_chunk(int(fields[0]), int(fields[1]))
+        else:
+            print(f"Invalid message from client: {protocol.opcode_name(opcode)}")
+            return protocol.INVALID_REQUEST, b""
+
+    def handle_heartbeat(self, chunk_server_id, load_report=None, added_chunks=(), removed_chunks=(),
+                         lease_renewals=()):
+        """
+        Record a heartbeat from a chunk server
+        
+        Chunk servers send heartbeats over their persistent master connection. A
+        beat carries the load of the server and the chunks it stored or deleted
+        since its previous beat, so chunk locations stay current without full
+        chunk reports, and the leases it used since its previous beat, which are
+        renewed. A server that was declared failed (or that registered with a
+        previous master process) is told to register again.
+        
+        Args:
+            chunk_server_id (int): Chunk server sending the heartbeat
+            load_report (dict): Load of the chunk server, keyed by protocol.LOAD_REPORT_FIELDS
+            added_chunks (list): Handles of the chunks stored since the previous beat
+            removed_chunks (list): Handles of the chunks deleted since the previous beat
+            lease_renewals (list): Lease keys the chunk server wants to keep
+        
+        Returns:
+            tuple: (response_opcode, response_payload) where the payload holds the
+                   heartbeat timeout and lease duration in milliseconds, then
+                   the renewed chunk leases and renewed file leases
+        """
+        with self.metadata_lock:
+            if chunk_server_id not in self.chunk_servers:
+                return protocol.NOT_REGISTERED, b""
+            self.last_heartbeat[chunk_server_id] = time.monotonic()
+            if load_report is not None:
+                self.load_reports[chunk_server_id] = load_report
+                self.update_load_score(chunk_server_id, load_report)
+
+            for chunk_handle in added_chunks:
+                chunk = self.chunks.get(chunk_handle)
+                # Chunks of removed files are unknown and are ignored
+                if chunk is not None:
+                    chunk.add_location(chunk_server_id)
+            for chunk_handle in removed_chunks:
+                chunk = self.chunks.get(chunk_handle)
+                if chunk is not None:
+                    chunk.remove_location(chunk_server_id)
+
+            # A lease is renewed unless another live server holds it now
+            now = time.monotonic()
+            renewed_chunks, renewed_files = [], []
+            for key in lease_renewals:
+                if self.lease_holder(key, now) in (None, chunk_server_id):
+                    self.grant_lease(key, chunk_server_id, now)
+                    (renewed_chunks if key[0] == "chunk" else renewed_files).append(key[1])
+
+        return protocol.OK, protocol.pack_fields(
+            int(self.heartbeat_timeout * 1000), int(self.lease_duration * 1000),
+            protocol.pack_chunk_handles(renewed_chunks), *renewed_files
+        )
+
+    def lease_holder(self, key, now):
+        """
+        Return the live chunk server holding an unexpired lease. Must be called with metadata_lock held.
+        
+        A failed server stops trusting its leases before the master declares it
+        failed (see ChunkServer.ensure_lease), so its leases can be granted again
+        right away.
+        
+        Args:
+            key (tuple): ("file", file_name) or ("chunk", chunk_handle)
+            now (float): Current time.monotonic()
+        
+        Returns:
+            int: Chunk server id, or None when nobody holds the lease
+        """
+        lease = self.leases.get(key)
+        if lease is not None and lease[1] > now and lease[0] in self.chunk_servers:
+            return lease[0]
+        return None
+
+    def grant_lease(self, key, chunk_server_id, now):
+        """
+        Grant or extend a lease for lease_duration seconds. Must be called with metadata_lock held.
+        
+        Args:
+            key (tuple): ("file", file_name) or ("chunk", chunk_handle)
+            chunk_server_id (int): Chunk server becoming the primary of the key
+            now (float): Current time.monotonic()
+        """
+        self.leases[key] = [chunk_server_id, now + self.lease_duration]
+
+    def acquire_lease(self, chunk_server_id, key):
+        """
+        Handle a chunk server asking for the lease of a file or chunk it was sent a mutation for
+        
+        Args:
+            chunk_server_id (int): Requesting chunk server
+            key (tuple): ("file", file_name) or ("chunk", chunk_handle)
+        
+        Returns:
+            tuple: (LEASE_GRANTED, lease and heartbeat timeout in milliseconds), or
+                   (LEASE_HELD, address of the current primary)
+        """
+        with self.metadata_lock:
+            if chunk_server_id not in self.chunk_servers:
+                return protocol.NOT_REGISTERED, b""
+            now = time.monotonic()
+            holder = self.lease_holder(key, now)
+            if holder is not None and holder != chunk_server_id:
+                data = self.chunk_servers[holder]
+                return protocol.LEASE_HELD, protocol.pack_fields(data['ip'], data['port'])
+            self.grant_lease(key, chunk_server_id, now)
+        return protocol.LEASE_GRANTED, protocol.pack_fields(
+            int(self.lease_duration * 1000), int(self.heartbeat_timeout * 1000)
+        )
 
-    def handle_chunk_server_info(self, message):
+    def find_file_primary(self, file_name):
+        """
+        Find the primary chunk server of one file, granting its lease if nobody holds it
+        
+        A file stays with the chunk server that stores it. A new file goes to the
+        least loaded chunk server, so mutations of different files spread over
+        all chunk servers instead of going through one global primary.
+        
+        Args:
+            file_name (str): Name of the file
+        
+        Returns:
+            tuple: (response_opcode, response_payload) holding the primary address
+                   and the remaining lease time in milliseconds
+        """
+        # O(depth) lookup of the chunk servers storing the file
+        try:
+            with self.namespace.read_path(file_name):
+                entry = self.namespace.lookup_file(file_name)
+                stored_on = set(entry.servers) if entry is not None else set()
+        except NamespaceError:
+            stored_on = set()
+
+        with self.metadata_lock:
+            key = ("file", file_name)
+            now = time.monotonic()
+            holder = self.lease_holder(key, now)
+            if holder is None:
+                candidates = [
+                    chunk_server_id for chunk_server_id in stored_on if chunk_server_id in self.chunk_servers
+                ] or list(self.chunk_servers)
+                if not candidates:
+                    return protocol.NO_PRIMARY_SERVER, b""
+                # Power of two choices: the less loaded of two random candidates,
+                # so new files spread evenly even while every server is idle
+                holder = min(random.sample(candidates, min(2, len(candidates))),
+                             key=lambda chunk_server_id: self.load_scores.get(chunk_server_id, 0))
+                self.grant_lease(key, holder, now)
+            data = self.chunk_servers[holder]
+            remaining = self.leases[key][1] - now
+        return protocol.PRIMARY_SERVER_INFO, protocol.pack_fields(data['ip'], data['port'], int(remaining * 1000))
+
+    def prune_leases(self, now):
+        """
+        Forget expired leases, at most once per lease duration. Must be called with metadata_lock held.
+        
+        Args:
+            now (float): Current time.monotonic()
+        """
+        if now < self.next_lease_prune:
+            return
+        self.next_lease_prune = now + self.lease_duration
+        self.leases = {key: lease for key, lease in self.leases.items() if lease[1] > now}
+
+    def update_load_score(self, chunk_server_id, load_report):
+        """
+        Fold a load report into the smoothed load score of a chunk server
+        
+        The score counts the requests the server is busy with: requests in
+        flight, requests waiting for a lock, and its transfer rate expressed in
+        requests of LOAD_BYTES_PER_REQUEST bytes per second. Reports arrive
+        every heartbeat interval, the exponentially weighted moving average
+        keeps a burst from flipping the replica ranking back and forth.
+        Must be called with metadata_lock held.
+        
+        Args:
+            chunk_server_id (int): Reporting chunk server
+            load_report (dict): Report keyed by protocol.LOAD_REPORT_FIELDS
+        """
+        score = (
+            load_report['in_flight_requests'] + load_report['queue_depth']
+            + (load_report['read_bytes_per_sec'] + load_report['write_bytes_per_sec']) / LOAD_BYTES_PER_REQUEST
+        )
+        previous = self.load_scores.get(chunk_server_id, score)
+        self.load_scores[chunk_server_id] = LOAD_SMOOTHING * score + (1 - LOAD_SMOOTHING) * previous
+
+    def rank_replicas(self, chunk_server_ids, client_ip=None):
+        """
+        Order the replicas of a chunk from most to least preferred for reading
+        
+        Replicas on the client's host come first, then replicas are ordered by
+        smoothed load score. Must be called with metadata_lock held.
+        
+        Args:
+            chunk_server_ids (list): Live chunk servers holding the chunk
+            client_ip (str): Address of the reading client, None if unknown
+        
+        Returns:
+            list: The chunk server ids, best first
+        """
+        return sorted(chunk_server_ids, key=lambda chunk_server_id: (
+            self.chunk_servers[chunk_server_id]['ip'] != client_ip,
+            self.load_scores.get(chunk_server_id, 0),
+            chunk_server_id,
+        ))
+
+    def check_heartbeats(self):
+        """
+        Remove the chunk servers whose heartbeat timed out
+        
+        Failed servers no longer receive new chunks and are left out of chunk
+        locations. Their chunks keep the failed server in their location list,
+        so the replicas count again once it registers and reports them, until
+        replication_delay seconds later the ReplicationManager replaces them.
+        When the primary failed a new primary is elected right away.
+        
+        Returns:
+            list: Ids of the chunk servers declared failed
+        """
+        now = time.monotonic()
+        with self.metadata_lock:
+            self.prune_leases(now)
+            failed = [
+                chunk_server_id for chunk_server_id in self.chunk_servers
+                if now - self.last_heartbeat.get(chunk_server_id, now) > self.heartbeat_timeout
+            ]
+            if not failed:
+                return failed
+
+            primary_failed = False
+            for chunk_server_id in failed:
+                primary_failed |= self.chunk_servers.pop(chunk_server_id)['is_primary']
+                self.last_heartbeat.pop(chunk_server_id, None)
+                self.failed_at[chunk_server_id] = now
+                self.load_reports.pop(chunk_server_id, None)
+                self.load_scores.pop(chunk_server_id, None)
+                print(f"Chunk Server {chunk_server_id} failed: no heartbeat for {self.heartbeat_timeout}s")
+
+            if primary_failed:
+                print("Primary server failed. Initiating election process.")
+                self.elect_new_primary()
+        return failed
+
+    def elect_new_primary(self):
+        """
+        Make the live chunk server with the lowest id the primary. Must be called with metadata_lock held.
+        """
+        if not self.chunk_servers:
+            print("No chunk server left to elect as primary.")
+            return
+        new_primary = min(self.chunk_servers)
+        for chunk_server_id, data in self.chunk_servers.items():
+            data['is_primary'] = chunk_server_id == new_primary
+        print(f"New primary server is Chunk Server {new_primary}")
+
+    def start_heartbeat_monitor(self, interval=None):
+        """
+        Start a daemon thread that checks chunk server heartbeats
+        
+        Args:
+            interval (float): Seconds between checks, defaults to a fifth of the
+                              heartbeat timeout so failures are detected quickly
+        """
+        interval = interval if interval is not None else self.heartbeat_timeout / 5
+
+        def monitor_forever():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check_heartbeats()
+                except Exception as e:
+                    print(f"Error checking heartbeats: {e}")
+
+        threading.Thread(target=monitor_forever, daemon=True).start()
+
+    def handle_chunk_server_info(self, fields):
         """
         Process file information sent by chunk servers
         
         Args:
-            message (str): Message containing chunk server and file information
-                          Format: "CHUNK_SERVER_INFO:chunk_server_id:file_name"
+            fields (list): Message fields sent by the chunk server
+                          Format: [chunk_server_id, file_name]
         """
         # Process information sent by Chunk Server
-        val, chunk_server_id, file_name = message.split(":")
+        chunk_server_id, file_name = fields
         chunk_server_id = int(chunk_server_id)
+        file_name = file_name.decode()
 
         if chunk_server_id in self.chunk_servers:
-            with self.metadata_lock:
-                # Update the chunk server's file list
-                self.chunk_servers[chunk_server_id]['files'][file_name] = True
-                self.save_metadata()  # Save metadata directly after updating
+            try:
+                with self.namespace.lock_paths(file_name):
+                    # Update the file's chunk server list
+                    entry = self.namespace.lookup_file(file_name)
+                    if entry is None or chunk_server_id not in entry.servers:
+                        self.log_operation(["file_info", chunk_server_id, file_name])
+            except NamespaceError as e:
+                print(f"Ignoring file info from Chunk Server {chunk_server_id}: {e}")
+                return
 
             print(f"Received file info from Chunk Server {chunk_server_id}: {file_name}")
         else:
             print(f"Invalid Chunk Server ID in file info: {chunk_server_id}")
 
-    def find_primary_server(self, client_socket):
+    def place_chunk(self):
+        """
+        Choose the chunk servers a new chunk is stored on
+        
+        Placement rotates over the registered chunk servers so consecutive chunks
+        of a file land on different servers. Servers whose last load report shows
+        less free disk than a chunk are skipped while enough others are left.
+        Must be called with metadata_lock held.
+        
+        Returns:
+            list: Chunk server ids, the first one being the first replica written
+        """
+        server_ids = sorted(self.chunk_servers)
+        with_space = [
+            chunk_server_id for chunk_server_id in server_ids
+            if self.load_reports.get(chunk_server_id, {}).get('disk_free', self.chunk_size) >= self.chunk_size
+        ]
+        if len(with_space) >= min(self.replication_factor, len(server_ids)):
+            server_ids = with_space
+        replica_count = min(self.replication_factor, len(server_ids))
+        start = self.next_placement % len(server_ids)
+        self.next_placement += 1
+        return [server_ids[(start + i) % len(server_ids)] for i in range(replica_count)]
+
+    def chunk_locations_payload(self, chunk_handles, ranked=False, client_ip=None, chunk_range=None):
+        """
+        Build the CHUNK_LOCATIONS payload for a file. Must be called with metadata_lock held.
+        
+        Args:
+            chunk_handles (list): Ordered chunk handles of the file
+            ranked (bool): Order every replica list for reading (see rank_replicas)
+                           instead of in placement order
+            client_ip (str): Address of the reading client, used for ranking
+            chunk_range (tuple): (first chunk index, chunk count of the file, cache
+                                 time in milliseconds) when chunk_handles is part of a file
+        """
+        chunks = []
+        for chunk_handle in chunk_handles:
+            chunk_server_ids = [
+                chunk_server_id for chunk_server_id in self.chunks[chunk_handle].locations
+                if chunk_server_id in self.chunk_servers
+            ]
+            if ranked:
+                chunk_server_ids = self.rank_replicas(chunk_server_ids, client_ip)
+            replicas = [
+                (chunk_server_id, self.chunk_servers[chunk_server_id]['ip'], self.chunk_servers[chunk_server_id]['port'])
+                for chunk_server_id in chunk_server_ids
+            ]
+            chunks.append((chunk_handle, replicas))
+        return protocol.pack_chunk_locations(self.chunk_size, chunks, *(chunk_range or ()))
+
+    def allocate_chunks(self, file_name, file_size):
+        """
+        Create a file in the chunk index and place its chunks
+        
+        Args:
+            file_name (str): Name of the new file
+            file_size (int): Size of the file in bytes
+        
+        Returns:
+            tuple: (response_opcode, response_payload) holding the chunk locations
+        """
+        with self.namespace.lock_paths(file_name):
+            node = self.namespace.lookup(file_name)
+            if node is not None and (not isinstance(node, FileEntry) or node.chunks is not None):
+                return protocol.FILE_EXISTS, b""
+
+            with self.metadata_lock:
+                if not self.chunk_servers:
+                    return protocol.NO_CHUNK_SERVERS, b""
+
+                # An empty file still gets one (empty) chunk
+                chunk_count = max(1, -(-file_size // self.chunk_size))
+                placements = [
+                    [chunk_handle, self.place_chunk()]
+                    for chunk_handle in range(self.next_chunk_handle, self.next_chunk_handle + chunk_count)
+                ]
+                # Reserve the handles, other allocations go on while this one is logged
+                self.next_chunk_handle += chunk_count
+
+            # The client only writes the chunks once the allocation is durable
+            self.log_operation(["allocate", file_name, placements])
+            with self.metadata_lock:
+                now = time.monotonic()
+                for chunk_handle, locations in placements:
+                    # The first replica is the chunk's primary, placement rotates it
+                    # over the chunk servers so writes do not all start on one server
+                    self.grant_lease(("chunk", chunk_handle), locations[0], now)
+                payload = self.chunk_locations_payload([chunk_handle for chunk_handle, _ in placements])
+
+        print(f"Allocated {chunk_count} chunk(s) for file {file_name}")
+        return protocol.CHUNK_LOCATIONS, payload
+
+    def get_chunk_locations(self, file_name, client_ip=None, first_chunk=None, max_chunks=0):
+        """
+        Look up the chunk list and replica locations of a file
+        
+        Replicas are ranked for reading, the client picks among them. A lookup
+        of a range of chunks also returns the chunk count of the file and how
+        long the client may cache the locations, so a client reading chunk i
+        can prefetch the locations of the chunks that follow it.
+        
+        Args:
+            file_name (str): Name of the file
+            client_ip (str): Address of the reading client, None if unknown
+            first_chunk (int): Index of the first chunk wanted, None for the whole file
+            max_chunks (int): Maximum number of chunks returned, 0 for all from first_chunk
+        """
+        with self.namespace.read_path(file_name):
+            entry = self.namespace.lookup_file(file_name)
+            if entry is None or entry.chunks is None:
+                return protocol.FILE_NOT_FOUND, b""
+            if first_chunk is None:
+                with self.metadata_lock:
+                    return protocol.CHUNK_LOCATIONS, self.chunk_locations_payload(entry.chunks, True, client_ip)
+            end = first_chunk + max_chunks if max_chunks else len(entry.chunks)
+            with self.metadata_lock:
+                return protocol.CHUNK_LOCATIONS, self.chunk_locations_payload(
+                    entry.chunks[first_chunk:end], True, client_ip,
+                    (first_chunk, len(entry.chunks), int(self.location_ttl * 1000))
+                )
+
+    def remove_file(self, file_name):
+        """
+        Remove a file from the chunk index
+        
+        The chunk locations are returned so the caller can delete the chunk replicas.
+        
+        Args:
+            file_name (str): Name of the file
+        """
+        with self.namespace.lock_paths(file_name):
+            entry = self.namespace.lookup_file(file_name)
+            if entry is None or entry.chunks is None:
+                return protocol.FILE_NOT_FOUND, b""
+            with self.metadata_lock:
+                payload = self.chunk_locations_payload(entry.chunks)
+            self.log_operation(["remove", file_name])
+        return protocol.CHUNK_LOCATIONS, payload
+
+    def make_directory(self, path):
+        """
+        Create a directory, its parent must exist
+        
+        Only the new path is write locked, so directories are created
+        concurrently anywhere in the tree.
+        
+        Args:
+            path (str): Path of the new directory
+        """
+        with self.namespace.lock_paths(path):
+            self.log_operation(["mkdir", path])
+        return protocol.OK, b""
+
+    def list_directory(self, path):
+        """
+        List the files and directories in a directory
+        
+        Args:
+            path (str): Path of the directory
+        
+        Returns:
+            tuple: (response_opcode, response_payload) with one field per entry,
+                   directory names end with "/"
+        """
+        with self.namespace.read_path(path):
+            names = self.namespace.list_directory(path)
+        return protocol.DIRECTORY_LISTING, protocol.pack_fields(*names)
+
+    def rename(self, source, target):
+        """
+        Move a file or directory to a new path
+        
+        Only metadata changes, chunks keep their handles. Files stored whole on
+        chunk servers are kept under their name there and cannot be renamed.
+        
+        Args:
+            source (str): Existing path
+            target (str): New path, must not exist
+        """
+        with self.namespace.lock_paths(source, target):
+            node = self.namespace.lookup(source)
+            if isinstance(node, FileEntry) and node.servers:
+                print(f"Cannot rename {source}, it is stored whole on chunk servers")
+                return protocol.INVALID_REQUEST, b""
+            self.log_operation(["rename", source, target])
+        return protocol.OK, b""
+
+    def handle_chunk_report(self, chunk_server_id, chunk_handles):
+        """
+        Record the chunks a chunk server reports it is storing
+        
+        Args:
+            chunk_server_id (int): Reporting chunk server
+            chunk_handles (list): Handles of the chunks stored on that server
+        """
+        with self.metadata_lock:
+            for chunk_handle in chunk_handles:
+                chunk = self.chunks.get(chunk_handle)
+                # Chunks of removed files are unknown and are ignored
+                if chunk is not None:
+                    chunk.add_location(chunk_server_id)
+        print(f"Chunk Server {chunk_server_id} reported {len(chunk_handles)} chunk(s)")
+
+    def handle_corrupt_chunk(self, chunk_server_id, chunk_handle):
         """
-        Find and send information about the primary server to the client
+        Forget a replica its chunk server found corrupt
+        
+        The replica is no longer returned in chunk locations and its chunk
+        lease is revoked, the chunk counts as under-replicated until a healthy
+        replica is copied to another chunk server.
         
         Args:
-            client_socket: Socket connection to send the response
+            chunk_server_id (int): Reporting chunk server
+            chunk_handle (int): Handle of the corrupt chunk
+        """
+        with self.metadata_lock:
+            chunk = self.chunks.get(chunk_handle)
+            if chunk is None:
+                return protocol.OK, b""
+            chunk.remove_location(chunk_server_id)
+            lease = self.leases.get(("chunk", chunk_handle))
+            if lease is not None and lease[0] == chunk_server_id:
+                del self.leases[("chunk", chunk_handle)]
+            remaining = len(chunk.locations)
+        print(f"Chunk {chunk_handle} is corrupt on Chunk Server {chunk_server_id}, {remaining} healthy replica(s) left")
+        return protocol.OK, b""
+
+    def apply_operation(self, operation):
+        """
+        Apply one metadata operation, live or replayed from the operation log.
+        Must be called with the namespace locks of its paths held and, for
+        operations changing chunks, metadata_lock (or before the server starts).
+        
+        Args:
+            operation (list): ["allocate", file_name, [[chunk_handle, locations], ...]],
+                              ["remove", file_name], ["file_info", chunk_server_id, file_name],
+                              ["mkdir", path] or ["rename", source, target]
+        
+        Raises:
+            NamespaceError: If the operation is invalid, nothing was changed
+        """
+        kind = operation[0]
+        if kind == "allocate":
+            _, file_name, placements = operation
+            entry = self.namespace.file_entry(file_name, create=True)
+            entry.set_chunks(chunk_handle for chunk_handle, _ in placements)
+            for chunk_handle, locations in placements:
+                self.chunks[chunk_handle] = ChunkRecord(locations)
+                self.next_chunk_handle = max(self.next_chunk_handle, chunk_handle + 1)
+        elif kind == "remove":
+            entry = self.namespace.file_entry(operation[1])
+            for chunk_handle in entry.chunks:
+                del self.chunks[chunk_handle]
+            entry.set_chunks(None)
+            if not entry.servers:
+                self.namespace.remove_file(operation[1])
+        elif kind == "file_info":
+            _, chunk_server_id, file_name = operation
+            self.namespace.file_entry(file_name, create=True).add_server(chunk_server_id)
+        elif kind == "mkdir":
+            self.namespace.make_directory(operation[1])
+        elif kind == "rename":
+            self.namespace.rename(operation[1], operation[2])
+        else:
+            raise ValueError(f"Unknown metadata operation {kind}")
+
+    def check_operation(self, operation):
+        """
+        Check that apply_operation would succeed, without changing anything.
+        Must be called with the namespace locks of the operation's paths held.
+        
+        Args:
+            operation (list): Operation, see apply_operation
+        
+        Raises:
+            NamespaceError: If the operation is invalid
+        """
+        kind = operation[0]
+        if kind == "allocate":
+            self.namespace.check_create_file(operation[1])
+        elif kind == "remove":
+            self.namespace.file_entry(operation[1])
+        elif kind == "file_info":
+            self.namespace.check_create_file(operation[2])
+        elif kind == "mkdir":
+            self.namespace.check_make_directory(operation[1])
+        elif kind == "rename":
+            self.namespace.check_rename(operation[1], operation[2])
+        else:
+            raise ValueError(f"Unknown metadata operation {kind}")
+
+    def log_operation(self, operation):
+        """
+        Append a metadata operation to the operation log and apply it once the
+        record is durable, so a crash never loses a change a request has seen.
+        Must be called with the namespace locks of its paths held and without
+        metadata_lock, which is taken to apply the operation.
+        
+        Only the paths of the operation stay locked while the record is written,
+        operations on other paths share the same fsync.
+        
+        Args:
+            operation (list): Operation, see apply_operation
+        
+        Raises:
+            NamespaceError: If the operation is invalid, nothing was logged
+            OperationLogError: If the record could not be written, nothing was applied
+        """
+        self.check_operation(operation)
+        self.operation_log.wait(self.operation_log.append(operation))
+        with self.metadata_lock:
+            self.apply_operation(operation)
+
+    def recover_metadata(self):
+        """
+        Load the last metadata snapshot and replay the operation log written after it
+        
+        Only the segments after the snapshot are replayed, so restart time is
+        bounded by the snapshot interval rather than the age of the master.
+        """
+        first_segment = 1
+        if os.path.exists(self.metadata_file):
+            with open(self.metadata_file) as metadata_file:
+                snapshot = json.load(metadata_file)
+            # JSON object keys are strings, chunk handles and server ids are ints
+            self.chunks = {
+                int(chunk_handle): ChunkRecord(chunk['locations'])
+                for chunk_handle, chunk in snapshot.get('chunks', {}).items()
+            }
+            self.next_chunk_handle = snapshot.get('next_chunk_handle', 1)
+            if 'namespace' in snapshot:
+                self.namespace.load_dict(snapshot['namespace'])
+            else:
+                self.load_flat_metadata(snapshot)
+            first_segment = snapshot.get('log_segment', 1)
+
+        replayed = 0
+        for operation in self.operation_log.replay(first_segment):
+            self.apply_operation(operation)
+            replayed += 1
+
+        # New records go to a fresh segment, after any torn tail of the old ones
+        segments = self.operation_log.segments()
+        self.operation_log.open(max([first_segment] + [segment + 1 for segment in segments]))
+        # A long replay makes the next snapshot due right away
+        self.operation_log.records_since_rotation = replayed
+        print(f"Recovered {self.namespace.file_count} file(s), {len(self.chunks)} chunk(s), "
+              f"replayed {replayed} operation(s)")
+
+    def load_flat_metadata(self, snapshot):
+        """
+        Build the namespace from a metadata file written before directories existed
+        
+        Args:
+            snapshot (dict): Metadata with a flat 'files' index and per-server file lists
+        """
+        for file_name, chunk_handles in snapshot.get('files', {}).items():
+            self.namespace.file_entry(file_name, create=True, parents=True).set_chunks(chunk_handles)
+        server_files = dict(snapshot.get('server_files', {}))
+        for chunk_server_id, chunk_server in snapshot.get('chunk_servers', {}).items():
+            server_files.setdefault(chunk_server_id, {}).update(chunk_server.get('files', {}))
+        for chunk_server_id, files in server_files.items():
+            for file_name in files:
+                self.namespace.file_entry(file_name, create=True, parents=True).add_server(int(chunk_server_id))
+
+    def take_snapshot(self):
+        """
+        Write a snapshot of the metadata and delete the log segments it covers
+        
+        The log is rotated while the whole namespace and the metadata lock are
+        held, so the snapshot contains exactly the operations of the old
+        segments; serializing is the only work done while holding the locks,
+        the disk write happens outside them.
+        """
+        with self.namespace.exclusive(), self.metadata_lock:
+            sequence, segment = self.operation_log.rotate()
+            state = json.dumps({
+                'namespace': self.namespace.root,
+                'chunks': self.chunks,
+                'next_chunk_handle': self.next_chunk_handle,
+                'log_segment': segment,
+            }, separators=(',', ':'), default=encode_record)
+
+        self.operation_log.wait(sequence)
+        write_snapshot(self.metadata_file, state)
+        self.operation_log.remove_segments_before(segment)
+        print(f"Metadata snapshot written, operation log continues in segment {segment}")
+
+    def start_snapshot_thread(self, interval=1):
+        """
+        Start a daemon thread taking a snapshot every snapshot_interval log records
+        
+        Args:
+            interval (float): Seconds between checks of the log size
+        """
+        def snapshot_forever():
+            while True:
+                time.sleep(interval)
+                if self.operation_log.records_since_rotation >= self.snapshot_interval:
+                    try:
+                        self.take_snapshot()
+                    except Exception as e:
+                        print(f"Error taking metadata snapshot: {e}")
+
+        threading.Thread(target=snapshot_forever, daemon=True).start()
+
+    def find_primary_server(self):
+        """
+        Find information about the primary server for a client
+        
+        Returns:
+            tuple: (response_opcode, response_payload) holding the primary server address
         """
         # Implement logic to find and send information about the primary server
         print("FIND_PRIMARY_SERVER request received. Responding with primary server info.")
         primary_server_id = None
         
         # Search for the primary server in registered chunk servers
-        for chunk_server_id, data in self.chunk_servers.items():
-            ip = data['ip']
-            port = data['port']
-            
-            if data['is_primary']:
-                primary_server_id = chunk_server_id
-                break
+        with self.metadata_lock:
+            for chunk_server_id, data in self.chunk_servers.items():
+                ip = data['ip']
+                port = data['port']
+                
+                if data['is_primary']:
+                    primary_server_id = chunk_server_id
+                    break
 
         # Send primary server information back to the client
-        primary_server_info = f"PRIMARY_SERVER_INFO:{ip},{port}" if primary_server_id is not None else "PRIMARY_SERVER_INFO:No primary server selected yet."
-        client_socket.send(primary_server_info.encode())
+        if primary_server_id is None:
+            return protocol.NO_PRIMARY_SERVER, b""
+        return protocol.PRIMARY_SERVER_INFO, protocol.pack_fields(ip, port)
 
     def start(self):
         """
@@ -218,7 +1105,20 @@ class Main_Server:
             client_handler = threading.Thread(target=self.handle_client, args=(client_socket,))
             client_handler.start()
 
+    def start_async(self, **options):
+        """
+        Start the master server in asyncio mode
+        
+        Connections are multiplexed by one event loop and metadata operations run
+        on a small fixed worker pool, see AsyncMasterServer for the options.
+        """
+        AsyncMasterServer(self, **options).start()
+
 if __name__ == "__main__":
     # Create and start the master server on localhost port 5011
     master_server = Main_Server("127.0.0.1", 5011)
-    master_server.start()
+    # Pass --async to serve connections from an event loop
+    if "--async" in sys.argv:
+        master_server.start_async()
+    else:
+        master_server.start()
@@ -0,0 +1,113 @@
+"""
+Memory Benchmark for the Master Metadata
+
+Builds the metadata of many files the way Main_Server stores it (namespace
+tree plus chunk records) and reports the bytes used per file, next to the
+flat dictionaries the master used before: file name -> list of chunk
+handles, chunk handle -> {'locations': [...]} and a {file_name: True}
+dictionary per chunk server.
+
+Usage:
+    python metadata_benchmark.py [--files N] [--files-per-directory N] [--chunks-per-file N]
+"""
+
+import argparse
+import gc
+import tracemalloc
+
+from namespace import Namespace, ChunkRecord
+
+# Chunk servers the replicas are spread over
+SERVER_COUNT = 16
+REPLICATION_FACTOR = 3
+
+
+def file_paths(file_count, files_per_directory):
+    """
+    Yield file paths laid out like a data set: /data/dNNNNNN/part-NNNNN
+
+    Args:
+        file_count (int): Number of paths
+        files_per_directory (int): Files in each directory
+    """
+    for i in range(file_count):
+        yield f"/data/d{i // files_per_directory:06d}/part-{i % files_per_directory:05d}"
+
+
+def replicas(chunk_handle):
+    """
+    Return the chunk servers of a chunk, rotating like Main_Server.place_chunk
+    """
+    return [(chunk_handle + i) % SERVER_COUNT + 1 for i in range(REPLICATION_FACTOR)]
+
+
+def build_compact(file_count, files_per_directory, chunks_per_file):
+    """
+    Build the metadata with Namespace and ChunkRecord
+    """
+    namespace = Namespace()
+    chunks = {}
+    chunk_handle = 1
+    for path in file_paths(file_count, files_per_directory):
+        entry = namespace.file_entry(path, create=True, parents=True)
+        entry.set_chunks(range(chunk_handle, chunk_handle + chunks_per_file))
+        for _ in range(chunks_per_file):
+            locations = replicas(chunk_handle)
+            chunks[chunk_handle] = ChunkRecord(locations)
+            chunk_handle += 1
+        for chunk_server_id in locations:
+            entry.add_server(chunk_server_id)
+    return namespace, chunks
+
+
+def build_flat(file_count, files_per_directory, chunks_per_file):
+    """
+    Build the same metadata with the flat dictionaries used before the namespace tree
+    """
+    files = {}
+    chunks = {}
+    server_files = {chunk_server_id: {} for chunk_server_id in range(1, SERVER_COUNT + 1)}
+    chunk_handle = 1
+    for path in file_paths(file_count, files_per_directory):
+        files[path] = list(range(chunk_handle, chunk_handle + chunks_per_file))
+        for _ in range(chunks_per_file):
+            locations = replicas(chunk_handle)
+            chunks[chunk_handle] = {'locations': locations}
+            chunk_handle += 1
+        for chunk_server_id in locations:
+            server_files[chunk_server_id][path] = True
+    return files, chunks, server_files
+
+
+def measure(build, *args):
+    """
+    Return the bytes allocated by a build function that are still alive afterwards
+    """
+    gc.collect()
+    tracemalloc.start()
+    metadata = build(*args)
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del metadata
+    return allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure master metadata memory per file")
+    parser.add_argument("--files", type=int, default=500000, help="Number of files")
+    parser.add_argument("--files-per-directory", type=int, default=1000, help="Files in each directory")
+    parser.add_argument("--chunks-per-file", type=int, default=1, help="Chunks of each file")
+    args = parser.parse_args()
+
+    print(f"{args.files} files, {args.files_per_directory} per directory, {args.chunks_per_file} chunk(s) each, "
+          f"{REPLICATION_FACTOR} replicas")
+    results = {}
+    for name, build in (("flat dictionaries", build_flat), ("namespace tree", build_compact)):
+        results[name] = measure(build, args.files, args.files_per_directory, args.chunks_per_file)
+        print(f"{name:>18}: {results[name] / 2 ** 20:9.1f} MB, {results[name] / args.files:6.0f} bytes per file")
+    print(f"Reduction: {results['flat dictionaries'] / results['namespace tree']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
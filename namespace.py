@@ -0,0 +1,537 @@
+"""
+Namespace Tree for the Master Server
+
+Files live in a tree of directories instead of flat per-server dictionaries.
+A path is resolved by walking one dictionary per component, so lookups cost
+O(depth) no matter how many files or chunk servers there are.
+
+Concurrency uses path-prefix locking: an operation takes a read lock on every
+ancestor directory of the paths it touches and a write lock on each path
+itself. Creating /a/b/x and /a/c/y only share read locks on / and /a, so
+operations in different directories never wait for each other, while renaming
+/a excludes every operation below it. Locks are taken in (depth, path) order,
+so operations on several paths cannot deadlock.
+
+Records are kept small so one master holds tens of millions of files: nodes
+and chunk records use __slots__, path components are interned so a name
+repeated in many directories is stored once, the chunk handles of a file are
+packed into an array of 64-bit integers instead of a list of int objects, and
+sets of chunk server ids are interned tuples, so the millions of chunks placed
+on the same servers share one replica list. Run metadata_benchmark.py to
+measure the bytes used per file.
+"""
+
+import contextlib
+import sys
+import threading
+from array import array
+
+from lock_manager import LockManager
+
+# Array type code of chunk handles, unsigned 64-bit
+CHUNK_HANDLE_TYPECODE = "Q"
+
+# Canonical tuples of chunk server ids, see server_ids. Only grows with the
+# number of distinct replica lists, which placement keeps small
+_server_id_tuples = {}
+
+
+class NamespaceError(Exception):
+    """
+    Base class of the errors raised for an invalid namespace operation
+    """
+
+
+class InvalidPathError(NamespaceError):
+    """
+    Raised for an empty path or a path with "." or ".." components
+    """
+
+
+class PathNotFoundError(NamespaceError):
+    """
+    Raised when a path or its parent directory does not exist
+    """
+
+
+class PathExistsError(NamespaceError):
+    """
+    Raised when the target of a create, mkdir or rename already exists
+    """
+
+
+class NotDirectoryError(NamespaceError):
+    """
+    Raised when a path component that must be a directory is a file
+    """
+
+
+def split_path(path):
+    """
+    Split a path into its components, "a/b", "/a/b" and "/a//b/" are all ("a", "b")
+
+    Args:
+        path (str): Slash separated path, the root is "/" or ""
+
+    Returns:
+        tuple: Path components, empty for the root
+
+    Raises:
+        InvalidPathError: If a component is "." or ".."
+    """
+    components = tuple(component for component in path.split("/") if component)
+    if "." in components or ".." in components:
+        raise InvalidPathError(f"Invalid path {path}")
+    return components
+
+
+def lock_key(components):
+    """
+    Return the lock key of a path, its normalized absolute form
+    """
+    return "/" + "/".join(components)
+
+
+def server_ids(chunk_server_ids):
+    """
+    Return the shared tuple holding a sequence of chunk server ids
+
+    A tuple of three ids costs 64 bytes, interning makes the cost per chunk a
+    single reference. Tuples are immutable, records replace them to change them.
+
+    Args:
+        chunk_server_ids (iterable): Chunk server ids, in order
+    """
+    chunk_server_ids = tuple(chunk_server_ids)
+    return _server_id_tuples.setdefault(chunk_server_ids, chunk_server_ids)
+
+
+class Directory:
+    """
+    Directory node: child name -> Directory or FileEntry
+    """
+
+    __slots__ = ('children',)
+
+    def __init__(self):
+        self.children = {}
+
+
+class FileEntry:
+    """
+    File node
+
+    chunks is the array of chunk handles of a chunked file, or None if the file
+    was never allocated chunks. servers is the interned tuple of the ids of the
+    chunk servers storing the file as a whole.
+    """
+
+    __slots__ = ('chunks', 'servers')
+
+    def __init__(self, chunks=None, servers=()):
+        self.set_chunks(chunks)
+        self.servers = server_ids(servers)
+
+    def set_chunks(self, chunk_handles):
+        """
+        Replace the chunk handles of the file
+
+        Args:
+            chunk_handles (iterable): Ordered chunk handles, None for no chunks
+        """
+        self.chunks = None if chunk_handles is None else array(CHUNK_HANDLE_TYPECODE, chunk_handles)
+
+    def add_server(self, chunk_server_id):
+        """
+        Record that a chunk server stores the whole file
+
+        Args:
+            chunk_server_id (int): Chunk server id
+        """
+        if chunk_server_id not in self.servers:
+            self.servers = server_ids(self.servers + (chunk_server_id,))
+
+
+class ChunkRecord:
+    """
+    Chunk record of the master: the ids of the chunk servers holding a replica
+
+    locations is an interned tuple in placement order, the first id is the
+    replica written first.
+    """
+
+    __slots__ = ('locations',)
+
+    def __init__(self, locations=()):
+        self.locations = server_ids(locations)
+
+    def add_location(self, chunk_server_id):
+        """
+        Record a replica on a chunk server
+
+        Args:
+            chunk_server_id (int): Chunk server id
+        """
+        if chunk_server_id not in self.locations:
+            self.locations = server_ids(self.locations + (chunk_server_id,))
+
+    def remove_location(self, chunk_server_id):
+        """
+        Forget the replica on a chunk server
+
+        Args:
+            chunk_server_id (int): Chunk server id
+        """
+        if chunk_server_id in self.locations:
+            self.locations = server_ids(
+                location for location in self.locations if location != chunk_server_id
+            )
+
+
+def encode_record(value):
+    """
+    json.dumps default hook turning namespace nodes and chunk records into JSON
+
+    The encoder calls it node by node, so a snapshot is serialized without
+    building a second copy of the metadata. A directory is {"children": {...}},
+    a file is {"chunks": [...] or null, "servers": [...]} and a chunk record
+    is {"locations": [...]}.
+
+    Args:
+        value: Object the JSON encoder cannot serialize itself
+    """
+    if isinstance(value, Directory):
+        return {'children': value.children}
+    if isinstance(value, FileEntry):
+        chunks = None if value.chunks is None else value.chunks.tolist()
+        return {'chunks': chunks, 'servers': sorted(value.servers)}
+    if isinstance(value, ChunkRecord):
+        return {'locations': list(value.locations)}
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+class Namespace:
+    """
+    Directory tree with a file -> chunk handles and file -> chunk servers index
+
+    This class:
+    - Resolves paths in O(depth)
+    - Locks paths with read locks on ancestors and write locks on leaves
+    - Creates, removes, lists and renames files and directories
+    - Loads the tree from the JSON written with encode_record
+
+    Mutating methods expect the caller to hold the locks of lock_paths for the
+    paths they change, lookups expect at least read_path for the path.
+    """
+
+    def __init__(self):
+        self.root = Directory()
+        self.locks = LockManager()
+        # Counters for monitoring, changed by operations holding different locks
+        self.count_lock = threading.Lock()
+        self.file_count = 0
+        self.directory_count = 0
+
+    @contextlib.contextmanager
+    def locked(self, read_components, write_components):
+        """
+        Hold read locks on some paths and write locks on others, in a global order
+
+        Args:
+            read_components (iterable): Component tuples to read lock
+            write_components (iterable): Component tuples to write lock, a path in
+                                         both sets is write locked
+        """
+        modes = {components: "read" for components in read_components}
+        modes.update((components, "write") for components in write_components)
+        with contextlib.ExitStack() as stack:
+            # Parents before children, so every operation locks in the same order
+            for components in sorted(modes, key=lambda components: (len(components), components)):
+                if modes[components] == "write":
+                    stack.enter_context(self.locks.write_lock(lock_key(components)))
+                else:
+                    stack.enter_context(self.locks.read_lock(lock_key(components)))
+            yield
+
+    def lock_paths(self, *paths):
+        """
+        Lock paths for a mutation: read locks on every ancestor, write lock on each path
+
+        Args:
+            *paths (str): Paths that are created, removed or changed
+
+        Raises:
+            InvalidPathError: If a path is invalid or is the root
+        """
+        leaves = []
+        for path in paths:
+            components = split_path(path)
+            if not components:
+                raise InvalidPathError("The root directory cannot be changed")
+            leaves.append(components)
+        ancestors = [leaf[:depth] for leaf in leaves for depth in range(len(leaf))]
+        return self.locked(ancestors, leaves)
+
+    def read_path(self, path):
+        """
+        Lock a path for a lookup: read locks on the path and every ancestor
+
+        Args:
+            path (str): Path that is looked up or listed
+        """
+        components = split_path(path)
+        return self.locked([components[:depth] for depth in range(len(components) + 1)], [])
+
+    def exclusive(self):
+        """
+        Lock the whole tree, used to take a consistent snapshot
+        """
+        return self.locked([], [()])
+
+    def lookup(self, path):
+        """
+        Return the node of a path, or None if it does not exist
+
+        Args:
+            path (str): Path to resolve
+        """
+        node = self.root
+        for component in split_path(path):
+            if not isinstance(node, Directory):
+                return None
+            node = node.children.get(component)
+            if node is None:
+                return None
+        return node
+
+    def lookup_file(self, path):
+        """
+        Return the FileEntry of a path, or None if it is missing or a directory
+
+        Args:
+            path (str): Path to resolve
+        """
+        node = self.lookup(path)
+        return node if isinstance(node, FileEntry) else None
+
+    def parent(self, components, create=False):
+        """
+        Return the directory holding a path
+
+        Args:
+            components (tuple): Components of the path
+            create (bool): Create missing parent directories, only safe
+                           without concurrent operations (recovery)
+
+        Raises:
+            PathNotFoundError: If a parent directory is missing
+            NotDirectoryError: If a parent is a file
+        """
+        node = self.root
+        for depth, component in enumerate(components[:-1]):
+            child = node.children.get(component)
+            if child is None:
+                if not create:
+                    raise PathNotFoundError(f"No such directory {lock_key(components[:depth + 1])}")
+                child = node.children[sys.intern(component)] = Directory()
+                self.count(directories=1)
+            if not isinstance(child, Directory):
+                raise NotDirectoryError(f"{lock_key(components[:depth + 1])} is not a directory")
+            node = child
+        return node
+
+    def count(self, files=0, directories=0):
+        """
+        Adjust the file and directory counters
+        """
+        with self.count_lock:
+            self.file_count += files
+            self.directory_count += directories
+
+    def file_entry(self, path, create=False, parents=False):
+        """
+        Return the FileEntry of a path, creating it if asked
+
+        Args:
+            path (str): Path of the file
+            create (bool): Create the entry if it does not exist
+            parents (bool): Also create missing parent directories
+
+        Raises:
+            PathNotFoundError: If the file (without create) or its parent is missing
+            PathExistsError: If the path is a directory
+        """
+        components = split_path(path)
+        if not components:
+            raise PathExistsError("/ is a directory")
+        directory = self.parent(components, create=parents)
+        node = directory.children.get(components[-1])
+        if node is None:
+            if not create:
+                raise PathNotFoundError(f"No such file {path}")
+            node = directory.children[sys.intern(components[-1])] = FileEntry()
+            self.count(files=1)
+        if not isinstance(node, FileEntry):
+            raise PathExistsError(f"{path} is a directory")
+        return node
+
+    def check_create_file(self, path):
+        """
+        Check that file_entry(path, create=True) would succeed, changing nothing
+
+        Args:
+            path (str): Path of the file
+
+        Raises:
+            PathNotFoundError: If the parent directory is missing
+            PathExistsError: If the path is a directory
+        """
+        components = split_path(path)
+        if not components:
+            raise PathExistsError("/ is a directory")
+        node = self.parent(components).children.get(components[-1])
+        if node is not None and not isinstance(node, FileEntry):
+            raise PathExistsError(f"{path} is a directory")
+
+    def remove_file(self, path):
+        """
+        Remove a file entry
+
+        Args:
+            path (str): Path of the file
+        """
+        components = split_path(path)
+        directory = self.parent(components)
+        node = directory.children.get(components[-1]) if components else None
+        if not isinstance(node, FileEntry):
+            raise PathNotFoundError(f"No such file {path}")
+        del directory.children[components[-1]]
+        self.count(files=-1)
+
+    def check_make_directory(self, path):
+        """
+        Check that a directory can be created, changing nothing
+
+        Args:
+            path (str): Path of the new directory
+
+        Returns:
+            tuple: (parent Directory, name of the new directory)
+
+        Raises:
+            PathExistsError: If the path already exists
+        """
+        components = split_path(path)
+        if not components:
+            raise PathExistsError("/ already exists")
+        directory = self.parent(components)
+        if components[-1] in directory.children:
+            raise PathExistsError(f"{path} already exists")
+        return directory, components[-1]
+
+    def make_directory(self, path):
+        """
+        Create a directory
+
+        Args:
+            path (str): Path of the new directory
+
+        Raises:
+            PathExistsError: If the path already exists
+        """
+        directory, name = self.check_make_directory(path)
+        directory.children[sys.intern(name)] = Directory()
+        self.count(directories=1)
+
+    def list_directory(self, path):
+        """
+        List a directory
+
+        Args:
+            path (str): Path of the directory
+
+        Returns:
+            list: Sorted child names, directory names end with "/"
+
+        Raises:
+            PathNotFoundError: If the directory does not exist
+            NotDirectoryError: If the path is a file
+        """
+        node = self.lookup(path)
+        if node is None:
+            raise PathNotFoundError(f"No such directory {path}")
+        if not isinstance(node, Directory):
+            raise NotDirectoryError(f"{path} is not a directory")
+        # Files may be created next to the listing, items() is copied at once
+        return sorted(
+            name + "/" if isinstance(child, Directory) else name
+            for name, child in list(node.children.items())
+        )
+
+    def check_rename(self, source, target):
+        """
+        Check that a path can be moved, changing nothing
+
+        Args:
+            source (str): Existing path
+            target (str): New path, its parent must exist and it must not
+
+        Returns:
+            tuple: (source Directory, source name, target Directory, target name)
+
+        Raises:
+            PathNotFoundError: If the source or the target parent is missing
+            PathExistsError: If the target exists
+            InvalidPathError: If a directory would be moved below itself
+        """
+        source_components = split_path(source)
+        target_components = split_path(target)
+        if not source_components or not target_components:
+            raise InvalidPathError("The root directory cannot be renamed")
+        if target_components[:len(source_components)] == source_components:
+            raise InvalidPathError(f"Cannot move {source} below itself")
+        source_directory = self.parent(source_components)
+        if source_components[-1] not in source_directory.children:
+            raise PathNotFoundError(f"No such file or directory {source}")
+        target_directory = self.parent(target_components)
+        if target_components[-1] in target_directory.children:
+            raise PathExistsError(f"{target} already exists")
+        return source_directory, source_components[-1], target_directory, target_components[-1]
+
+    def rename(self, source, target):
+        """
+        Move a file or directory (with everything below it) to a new path
+
+        Args:
+            source (str): Existing path
+            target (str): New path, its parent must exist and it must not
+
+        Raises:
+            PathNotFoundError: If the source or the target parent is missing
+            PathExistsError: If the target exists
+            InvalidPathError: If a directory would be moved below itself
+        """
+        source_directory, source_name, target_directory, target_name = self.check_rename(source, target)
+        target_directory.children[sys.intern(target_name)] = source_directory.children.pop(source_name)
+
+    def load_dict(self, data):
+        """
+        Replace the tree with one serialized through encode_record
+
+        Args:
+            data (dict): Decoded JSON of the root directory
+        """
+        self.root = Directory()
+        self.file_count = self.directory_count = 0
+        stack = [(self.root, data)]
+        while stack:
+            directory, node_data = stack.pop()
+            for name, child_data in node_data['children'].items():
+                name = sys.intern(name)
+                if 'children' in child_data:
+                    child = directory.children[name] = Directory()
+                    self.directory_count += 1
+                    stack.append((child, child_data))
+                else:
+                    directory.children[name] = FileEntry(child_data['chunks'], child_data['servers'])
+                    self.file_count += 1
@@ -0,0 +1,251 @@
+"""
+Operation Log for the Master Server
+
+Metadata mutations are appended to a log instead of rewriting the whole
+metadata file. Records from concurrent requests are written and fsynced
+together by one writer thread (group commit), so the cost of a mutation does
+not depend on the size of the namespace and many mutations share one fsync.
+
+The log is split into numbered segment files. A snapshot of the metadata
+records the first segment that is not part of it, so on startup the master
+loads the snapshot and replays only the segments written after it.
+
+Every record is framed as:
+
+    +-----------------+----------------+-------------------------+
+    | length (uint32) | crc32 (uint32) | compact JSON (length B) |
+    +-----------------+----------------+-------------------------+
+
+A record cut short by a crash fails its length or checksum and ends replay.
+"""
+
+import json
+import os
+import struct
+import threading
+import zlib
+
+# Record header: payload length, crc32 of the payload
+RECORD_HEADER_FORMAT = "!II"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+
+# Queue entry telling the writer thread to continue in a new segment
+_ROTATE = object()
+
+
+class OperationLogError(Exception):
+    """
+    Raised when log records could not be made durable
+    """
+
+
+class OperationLog:
+    """
+    Append-only, group committed log of metadata operations
+
+    This class:
+    - Appends records in the order append is called
+    - Makes a batch of records durable with a single fsync
+    - Rotates to a new segment when a snapshot is taken
+    - Replays the records of the segments that follow a snapshot
+    """
+
+    def __init__(self, path):
+        """
+        Initialize the operation log
+
+        Args:
+            path (str): Path prefix of the segment files (segments are path.1, path.2, ...)
+        """
+        self.path = path
+        self.condition = threading.Condition()
+        # Encoded records and rotation markers waiting for the writer thread
+        self.queue = []
+        # Sequence number of the last record appended and of the last durable one
+        self.appended = 0
+        self.durable = 0
+        self.error = None
+        self.segment = None
+        self.segment_file = None
+        # Records appended since the last rotation, used to schedule snapshots
+        self.records_since_rotation = 0
+
+    def segment_path(self, segment):
+        """
+        Return the path of a segment file
+
+        Args:
+            segment (int): Segment number
+        """
+        return f"{self.path}.{segment}"
+
+    def segments(self):
+        """
+        Return the numbers of the segment files on disk in ascending order
+        """
+        directory, prefix = os.path.split(os.path.abspath(self.path))
+        numbers = []
+        for name in os.listdir(directory):
+            suffix = name[len(prefix) + 1:]
+            if name.startswith(prefix + ".") and suffix.isdigit():
+                numbers.append(int(suffix))
+        return sorted(numbers)
+
+    def replay(self, first_segment):
+        """
+        Yield the records of every segment from first_segment on, oldest first
+
+        Args:
+            first_segment (int): First segment not covered by the snapshot
+        """
+        for segment in self.segments():
+            if segment < first_segment:
+                continue
+            with open(self.segment_path(segment), 'rb') as segment_file:
+                data = segment_file.read()
+            position = 0
+            while position < len(data):
+                if len(data) - position < RECORD_HEADER_SIZE:
+                    print(f"Ignoring truncated record header at the end of segment {segment}")
+                    break
+                length, checksum = struct.unpack_from(RECORD_HEADER_FORMAT, data, position)
+                payload = data[position + RECORD_HEADER_SIZE:position + RECORD_HEADER_SIZE + length]
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    print(f"Ignoring torn record at the end of segment {segment}")
+                    break
+                yield json.loads(payload)
+                position += RECORD_HEADER_SIZE + length
+
+    def open(self, segment):
+        """
+        Start appending to a new segment and start the writer thread
+
+        Args:
+            segment (int): Number of the segment, higher than any replayed one
+        """
+        self.segment = segment
+        self.segment_file = open(self.segment_path(segment), 'ab')
+        threading.Thread(target=self.write_forever, daemon=True).start()
+
+    def append(self, record):
+        """
+        Queue a record, returning without waiting for the disk
+
+        Call this while holding the locks that order conflicting mutations and
+        wait for the returned sequence number before applying the mutation.
+        Mutations holding other locks meanwhile share the same fsync.
+
+        Args:
+            record (list): JSON serializable operation
+
+        Returns:
+            int: Sequence number to pass to wait
+        """
+        payload = json.dumps(record, separators=(',', ':')).encode()
+        encoded = struct.pack(RECORD_HEADER_FORMAT, len(payload), zlib.crc32(payload)) + payload
+        with self.condition:
+            self.appended += 1
+            self.records_since_rotation += 1
+            self.queue.append(encoded)
+            self.condition.notify_all()
+            return self.appended
+
+    def rotate(self):
+        """
+        Continue the log in a new segment, records appended later go there
+
+        Returns:
+            tuple: (sequence number to wait for, number of the new segment)
+        """
+        with self.condition:
+            self.appended += 1
+            self.segment += 1
+            self.records_since_rotation = 0
+            self.queue.append(_ROTATE)
+            self.condition.notify_all()
+            return self.appended, self.segment
+
+    def wait(self, sequence):
+        """
+        Block until a record (and every record before it) is durable
+
+        Args:
+            sequence (int): Sequence number returned by append or rotate
+
+        Raises:
+            OperationLogError: If the log could not be written
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.durable >= sequence or self.error is not None)
+            if self.durable < sequence:
+                raise OperationLogError(f"Operation log write failed: {self.error}")
+
+    def write_forever(self):
+        """
+        Writer thread: write every queued record and fsync once per batch
+
+        While one batch is being fsynced the next one accumulates, so the number
+        of fsyncs adapts to the load instead of growing with it.
+        """
+        segment = self.segment
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue)
+                batch, self.queue = self.queue, []
+                last = self.appended
+
+            try:
+                for entry in batch:
+                    if entry is _ROTATE:
+                        self.segment_file.flush()
+                        os.fsync(self.segment_file.fileno())
+                        self.segment_file.close()
+                        segment += 1
+                        self.segment_file = open(self.segment_path(segment), 'ab')
+                    else:
+                        self.segment_file.write(entry)
+                self.segment_file.flush()
+                os.fsync(self.segment_file.fileno())
+            except OSError as e:
+                print(f"Error writing operation log: {e}")
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                self.durable = last
+                self.condition.notify_all()
+
+    def remove_segments_before(self, segment):
+        """
+        Delete the segments fully covered by a durable snapshot
+
+        Args:
+            segment (int): First segment that is kept
+        """
+        for number in self.segments():
+            if number < segment:
+                os.remove(self.segment_path(number))
+
+
+def write_snapshot(path, state):
+    """
+    Atomically replace a snapshot file and make it durable
+
+    Args:
+        path (str): Snapshot path
+        state (str): Serialized metadata
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as snapshot_file:
+        snapshot_file.write(state)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temp_path, path)
+    # The rename itself is durable once the directory is synced
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
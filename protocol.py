@@ -0,0 +1,578 @@
+"""
+Wire Protocol for Distributed File System
+
+Every message exchanged between the master server, chunk servers and clients
+is a single frame made of a fixed-size header followed by a raw byte payload:
+
+    +-----------------+--------------------+------------------------+
+    | opcode (uint16) | request id (uint32)| payload length (uint64)|
+    +-----------------+--------------------+------------------------+
+    | payload (payload length bytes)                                |
+    +---------------------------------------------------------------+
+
+Structured payloads are encoded as a sequence of length-prefixed fields so
+that file names and file content can contain any byte (including ':').
+"""
+
+import asyncio
+import itertools
+import struct
+
+# Frame header: opcode, request id, payload length (network byte order)
+HEADER_FORMAT = "!HIQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# Each payload field is prefixed with its length
+FIELD_LENGTH_FORMAT = "!I"
+FIELD_LENGTH_SIZE = struct.calcsize(FIELD_LENGTH_FORMAT)
+# Largest chunk size the master may use, a frame carries at most one chunk
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+# Room left in a frame for the file name, offsets and other fields sent with the data
+MAX_FIELD_OVERHEAD = 64 * 1024
+# Upper bound on a single frame payload, protects against corrupt or hostile headers
+MAX_PAYLOAD_SIZE = MAX_CHUNK_SIZE + MAX_FIELD_OVERHEAD
+# Payloads smaller than this are sent together with the header in one call
+SMALL_PAYLOAD_SIZE = 64 * 1024
+# Streamed data is split into DATA_PART frames of at most this size
+DATA_PART_SIZE = 1024 * 1024
+# Seconds between two heartbeats of a chunk server, the master failure timeout is a multiple of it
+HEARTBEAT_INTERVAL = 0.25
+# Chunk server load report carried by heartbeats, see pack_load_report
+LOAD_REPORT_FIELDS = (
+    'disk_free', 'chunk_count', 'in_flight_requests',
+    'read_bytes_per_sec', 'write_bytes_per_sec', 'queue_depth',
+)
+LOAD_REPORT_FORMAT = "!QIIQQI"
+# Chunk handles in inventory deltas are packed as unsigned 64-bit integers
+CHUNK_HANDLE_FORMAT = "!Q"
+CHUNK_HANDLE_SIZE = struct.calcsize(CHUNK_HANDLE_FORMAT)
+# Chunk server block cache counters returned by CACHE_STATS, in this order
+CACHE_STATS_FIELDS = ('hits', 'misses', 'evictions', 'cached_blocks', 'cached_bytes', 'capacity')
+
+# Requests handled by the master server
+FIND_PRIMARY_SERVER = 0x0001
+REGISTER_CHUNK_SERVER = 0x0002
+CHUNK_SERVER_INFO = 0x0003
+ALLOCATE_CHUNKS = 0x0004
+GET_CHUNK_LOCATIONS = 0x0005
+REMOVE_FILE = 0x0006
+REPORT_CHUNKS = 0x0007
+HEARTBEAT = 0x0008
+ACQUIRE_LEASE = 0x0009
+MAKE_DIRECTORY = 0x000A
+LIST_DIRECTORY = 0x000B
+RENAME = 0x000C
+REPORT_CORRUPT_CHUNK = 0x000D
+
+# Requests handled by chunk servers
+CREATE_FILE = 0x0101
+WRITE_FILE = 0x0102
+READ_FILE = 0x0103
+DELETE_FILE = 0x0104
+WRITE_CHUNK = 0x0105
+READ_CHUNK = 0x0106
+DELETE_CHUNK = 0x0107
+PUSH_CHUNK = 0x0108
+DATA_PART = 0x0109
+WRITE_FILE_STREAM = 0x010A
+CACHE_STATS = 0x010B
+COPY_CHUNK = 0x010C
+READ_RANGE = 0x010D
+WRITE_AT = 0x010E
+RECORD_APPEND = 0x010F
+
+# Responses
+OK = 0x8000
+PRIMARY_SERVER_INFO = 0x8001
+NO_PRIMARY_SERVER = 0x8002
+NOT_REGISTERED = 0x8003
+LEASE_GRANTED = 0x8004
+LEASE_HELD = 0x8005
+DIRECTORY_LISTING = 0x8006
+OPERATION_LOG_ERROR = 0x8007
+FILE_CREATED = 0x8101
+FILE_WRITTEN = 0x8102
+FILE_CONTENT = 0x8103
+FILE_DELETED = 0x8104
+FILE_NOT_FOUND = 0x8105
+FILE_LOCKED_ERROR = 0x8106
+COPY_ERROR = 0x8107
+TIMEOUT_ERROR = 0x8108
+INVALID_REQUEST = 0x8109
+CHUNK_LOCATIONS = 0x810A
+CHUNK_WRITTEN = 0x810B
+CHUNK_DATA = 0x810C
+CHUNK_DELETED = 0x810D
+CHUNK_NOT_FOUND = 0x810E
+FILE_EXISTS = 0x810F
+NO_CHUNK_SERVERS = 0x8110
+REPLICATION_ERROR = 0x8111
+NOT_PRIMARY = 0x8112
+NOT_A_DIRECTORY = 0x8113
+CHECKSUM_ERROR = 0x8114
+RECORD_APPENDED = 0x8115
+
+# Requests that change nothing, safe to send again when a response was lost
+READ_ONLY_REQUESTS = {
+    FIND_PRIMARY_SERVER, GET_CHUNK_LOCATIONS, LIST_DIRECTORY, READ_FILE, READ_RANGE, READ_CHUNK, CACHE_STATS,
+}
+
+# Responses whose payload is raw data rather than a field sequence
+RAW_PAYLOAD_OPCODES = {FILE_CONTENT, CHUNK_DATA}
+
+OPCODE_NAMES = {
+    value: name for name, value in list(globals().items())
+    if name.isupper() and isinstance(value, int) and not name.endswith(("_SIZE", "_FORMAT"))
+}
+
+# Request ids only need to be unique per connection, a process wide counter is enough
+_request_ids = itertools.count(1)
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a peer sends a malformed frame or closes the connection mid-frame
+    """
+
+
+def opcode_name(opcode):
+    """
+    Return a human readable name for an opcode, used for logging
+
+    Args:
+        opcode (int): Opcode from a frame header
+    """
+    return OPCODE_NAMES.get(opcode, f"UNKNOWN_OPCODE_{opcode:#06x}")
+
+
+def next_request_id():
+    """
+    Allocate a new request id for an outgoing request frame
+    """
+    return next(_request_ids) & 0xFFFFFFFF
+
+
+def recv_exactly(sock, size):
+    """
+    Read exactly size bytes from a socket
+
+    The buffer grows with the data that actually arrived, so a header
+    announcing a large payload does not allocate it up front.
+
+    Args:
+        sock: Connected socket to read from
+        size (int): Number of bytes to read
+
+    Returns:
+        bytearray: The received bytes (returned without an extra copy)
+
+    Raises:
+        ProtocolError: If the peer closes the connection before size bytes arrive
+    """
+    buffer = bytearray(min(size, DATA_PART_SIZE))
+    received = 0
+    while received < size:
+        if received == len(buffer):
+            # Double the buffer, at most to the announced size
+            buffer.extend(bytes(min(len(buffer), size - len(buffer))))
+        with memoryview(buffer) as view:
+            count = sock.recv_into(view[received:], len(buffer) - received)
+        if count == 0:
+            raise ProtocolError(f"Connection closed after {received} of {size} bytes")
+        received += count
+    return buffer
+
+
+def pack_header(opcode, request_id, payload_length):
+    """
+    Build a frame header
+
+    Args:
+        opcode (int): Message opcode
+        request_id (int): Id used to match responses to requests
+        payload_length (int): Number of payload bytes following the header
+    """
+    return struct.pack(HEADER_FORMAT, opcode, request_id, payload_length)
+
+
+def unpack_header(header):
+    """
+    Parse a frame header
+
+    Args:
+        header (bytes): HEADER_SIZE bytes read from the wire
+
+    Returns:
+        tuple: (opcode, request_id, payload_length)
+    """
+    opcode, request_id, payload_length = struct.unpack(HEADER_FORMAT, header)
+    if payload_length > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"Payload length {payload_length} exceeds limit")
+    return opcode, request_id, payload_length
+
+
+def send_frame(sock, opcode, request_id, payload=b""):
+    """
+    Send a single frame
+
+    Args:
+        sock: Connected socket to send on
+        opcode (int): Message opcode
+        request_id (int): Id used to match responses to requests
+        payload (bytes): Raw payload bytes
+    """
+    header = pack_header(opcode, request_id, len(payload))
+    if len(payload) < SMALL_PAYLOAD_SIZE:
+        sock.sendall(header + payload)
+    else:
+        # Avoid concatenating (and copying) large payloads
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+def recv_frame(sock):
+    """
+    Receive a single frame
+
+    Args:
+        sock: Connected socket to read from
+
+    Returns:
+        tuple: (opcode, request_id, payload), or None if the peer closed the
+               connection cleanly between frames
+    """
+    first = sock.recv(HEADER_SIZE)
+    if not first:
+        return None
+    header = first
+    if len(header) < HEADER_SIZE:
+        header += recv_exactly(sock, HEADER_SIZE - len(header))
+    opcode, request_id, payload_length = unpack_header(header)
+    payload = recv_exactly(sock, payload_length) if payload_length else b""
+    return opcode, request_id, payload
+
+
+async def read_frame(reader):
+    """
+    Receive a single frame from an asyncio stream
+
+    Args:
+        reader (asyncio.StreamReader): Stream to read from
+
+    Returns:
+        tuple: (opcode, request_id, payload), or None if the peer closed the
+               connection cleanly between frames
+    """
+    try:
+        header = await reader.readexactly(HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError("Connection closed in the middle of a frame header")
+    opcode, request_id, payload_length = unpack_header(header)
+    try:
+        # The stream buffers what arrives, nothing is allocated for the announced length
+        payload = await reader.readexactly(payload_length) if payload_length else b""
+    except asyncio.IncompleteReadError as e:
+        raise ProtocolError(f"Connection closed after {len(e.partial)} of {payload_length} bytes")
+    return opcode, request_id, payload
+
+
+def write_frame(writer, opcode, request_id, payload=b""):
+    """
+    Queue a single frame on an asyncio stream, callers await writer.drain()
+
+    Args:
+        writer (asyncio.StreamWriter): Stream to write to
+        opcode (int): Message opcode
+        request_id (int): Id used to match responses to requests
+        payload (bytes): Raw payload bytes
+    """
+    writer.write(pack_header(opcode, request_id, len(payload)))
+    if payload:
+        writer.write(payload)
+
+
+def pack_fields(*fields):
+    """
+    Encode a sequence of fields into a payload
+
+    Args:
+        *fields: str, bytes or int values, each stored as a length-prefixed field
+
+    Returns:
+        bytes: Encoded payload
+    """
+    parts = []
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode()
+        elif isinstance(field, int):
+            field = str(field).encode()
+        parts.append(struct.pack(FIELD_LENGTH_FORMAT, len(field)))
+        parts.append(field)
+    return b"".join(parts)
+
+
+def unpack_fields(payload):
+    """
+    Decode a payload produced by pack_fields
+
+    Args:
+        payload (bytes): Encoded payload
+
+    Returns:
+        list: Raw bytes of every field, in order
+    """
+    fields = []
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(payload):
+        if offset + FIELD_LENGTH_SIZE > len(payload):
+            raise ProtocolError("Truncated field length")
+        (length,) = struct.unpack_from(FIELD_LENGTH_FORMAT, payload, offset)
+        offset += FIELD_LENGTH_SIZE
+        if offset + length > len(payload):
+            raise ProtocolError("Truncated field")
+        fields.append(bytes(view[offset:offset + length]))
+        offset += length
+    return fields
+
+
+def send_request(sock, opcode, *fields):
+    """
+    Send a request frame with a field payload and wait for its response
+
+    Args:
+        sock: Connected socket to the server
+        opcode (int): Request opcode
+        *fields: Request fields passed to pack_fields
+
+    Returns:
+        tuple: (response_opcode, response_fields), a raw data response is
+               returned as a single field holding the whole payload
+    """
+    request_id = next_request_id()
+    send_frame(sock, opcode, request_id, pack_fields(*fields))
+    return recv_response(sock, request_id)
+
+
+def recv_response(sock, request_id):
+    """
+    Wait for the response to a request that was sent
+
+    Args:
+        sock: Connected socket the request was sent on
+        request_id (int): Id of the request
+
+    Returns:
+        tuple: (response_opcode, response_fields), a raw data response is
+               returned as a single field holding the whole payload
+    """
+    frame = recv_frame(sock)
+    if frame is None:
+        raise ProtocolError("Connection closed while waiting for response")
+    response_opcode, response_id, payload = frame
+    if response_id != request_id:
+        raise ProtocolError(f"Response id {response_id} does not match request id {request_id}")
+    if response_opcode in RAW_PAYLOAD_OPCODES:
+        return response_opcode, [payload]
+    return response_opcode, unpack_fields(payload)
+
+
+def send_data_parts(sock, request_id, data, part_size=DATA_PART_SIZE):
+    """
+    Stream data as a sequence of DATA_PART frames
+
+    Args:
+        sock: Connected socket to send on
+        request_id (int): Id of the request the data belongs to
+        data (bytes): Data to send
+        part_size (int): Maximum payload size of a single part
+    """
+    view = memoryview(data)
+    for offset in range(0, len(view), part_size):
+        send_frame(sock, DATA_PART, request_id, view[offset:offset + part_size])
+
+
+def send_file_parts(sock, request_id, source_file, length, part_size=DATA_PART_SIZE):
+    """
+    Stream length bytes of an open file as DATA_PART frames using sendfile()
+
+    Only one frame header is in memory at a time, the file content goes from
+    the page cache to the socket without being copied into Python.
+
+    Args:
+        sock: Connected socket to send on
+        request_id (int): Id of the request the data belongs to
+        source_file: File opened in binary mode, read from its current position
+        length (int): Number of bytes to send
+        part_size (int): Maximum payload size of a single part
+    """
+    offset = source_file.tell()
+    end = offset + length
+    while offset < end:
+        count = min(part_size, end - offset)
+        sock.sendall(pack_header(DATA_PART, request_id, count))
+        sent = sock.sendfile(source_file, offset, count)
+        if sent != count:
+            raise ProtocolError(f"File ended after {offset + sent} of {end} bytes")
+        offset += count
+
+
+def recv_data_part(sock, request_id):
+    """
+    Receive the next DATA_PART frame of a request
+
+    Args:
+        sock: Connected socket to read from
+        request_id (int): Id of the request the data belongs to
+
+    Returns:
+        bytearray: Payload of the part
+    """
+    frame = recv_frame(sock)
+    if frame is None:
+        raise ProtocolError("Connection closed while receiving data")
+    opcode, part_request_id, payload = frame
+    if opcode != DATA_PART or part_request_id != request_id:
+        raise ProtocolError(f"Expected DATA_PART for request {request_id}, got {opcode_name(opcode)}")
+    return payload
+
+
+def pack_chunk_locations(chunk_size, chunks, first_chunk=None, chunk_count=None, ttl_ms=None):
+    """
+    Encode the chunk list of a file
+
+    A lookup of part of a file appends the position of the chunks within the
+    file, the number of chunks of the whole file and how long the locations
+    may be cached.
+
+    Args:
+        chunk_size (int): Chunk size used to split the file
+        chunks (list): Ordered (chunk_handle, replicas) tuples, where replicas
+                       is a list of (chunk_server_id, ip, port) tuples
+        first_chunk (int): Index of the first chunk in the file, None for the whole file
+        chunk_count (int): Number of chunks of the whole file
+        ttl_ms (int): Milliseconds the locations may be cached
+
+    Returns:
+        bytes: Encoded payload
+    """
+    fields = [chunk_size, len(chunks)]
+    for chunk_handle, replicas in chunks:
+        fields.extend((chunk_handle, len(replicas)))
+        for replica in replicas:
+            fields.extend(replica)
+    if first_chunk is not None:
+        fields.extend((first_chunk, chunk_count, ttl_ms))
+    return pack_fields(*fields)
+
+
+def unpack_chunk_locations(fields):
+    """
+    Decode the fields produced by pack_chunk_locations
+
+    Args:
+        fields (list): Fields returned by unpack_fields
+
+    Returns:
+        tuple: (chunk_size, chunks) with the same layout as pack_chunk_locations
+    """
+    chunk_size, chunks, _ = unpack_chunk_records(fields)
+    return chunk_size, chunks
+
+
+def unpack_chunk_range(fields):
+    """
+    Decode the fields produced by pack_chunk_locations for part of a file
+
+    Args:
+        fields (list): Fields returned by unpack_fields
+
+    Returns:
+        tuple: (chunk_size, chunks, first_chunk, chunk_count, ttl_ms), ttl_ms
+               is None and the chunks are the whole file if the master did not
+               send a range
+    """
+    chunk_size, chunks, position = unpack_chunk_records(fields)
+    if len(fields) < position + 3:
+        return chunk_size, chunks, 0, len(chunks), None
+    first_chunk, chunk_count, ttl_ms = (int(field) for field in fields[position:position + 3])
+    return chunk_size, chunks, first_chunk, chunk_count, ttl_ms
+
+
+def unpack_chunk_records(fields):
+    """
+    Decode the chunk records of a CHUNK_LOCATIONS payload
+
+    Returns:
+        tuple: (chunk_size, chunks, position of the first field after the records)
+    """
+    chunk_size, chunk_count = int(fields[0]), int(fields[1])
+    chunks = []
+    position = 2
+    for _ in range(chunk_count):
+        chunk_handle, replica_count = int(fields[position]), int(fields[position + 1])
+        position += 2
+        replicas = []
+        for _ in range(replica_count):
+            chunk_server_id, ip, port = fields[position:position + 3]
+            replicas.append((int(chunk_server_id), ip.decode(), int(port)))
+            position += 3
+        chunks.append((chunk_handle, replicas))
+    return chunk_size, chunks, position
+
+
+def pack_load_report(report):
+    """
+    Encode a chunk server load report as a fixed size binary record
+
+    Args:
+        report (dict): Values keyed by the names in LOAD_REPORT_FIELDS
+
+    Returns:
+        bytes: Encoded report (36 bytes)
+    """
+    return struct.pack(LOAD_REPORT_FORMAT, *(int(report[name]) for name in LOAD_REPORT_FIELDS))
+
+
+def unpack_load_report(data):
+    """
+    Decode a record produced by pack_load_report
+
+    Args:
+        data (bytes): Encoded report
+
+    Returns:
+        dict: Values keyed by the names in LOAD_REPORT_FIELDS
+    """
+    return dict(zip(LOAD_REPORT_FIELDS, struct.unpack(LOAD_REPORT_FORMAT, data)))
+
+
+def pack_chunk_handles(chunk_handles):
+    """
+    Encode a list of chunk handles as one binary field
+
+    Args:
+        chunk_handles (iterable): Chunk handles
+
+    Returns:
+        bytes: CHUNK_HANDLE_SIZE bytes per handle
+    """
+    chunk_handles = list(chunk_handles)
+    return struct.pack(f"!{len(chunk_handles)}Q", *chunk_handles)
+
+
+def unpack_chunk_handles(data):
+    """
+    Decode a field produced by pack_chunk_handles
+
+    Args:
+        data (bytes): Encoded chunk handles
+
+    Returns:
+        list: Chunk handles
+    """
+    if len(data) % CHUNK_HANDLE_SIZE:
+        raise ProtocolError(f"Chunk handle list of {len(data)} bytes is truncated")
+    return list(struct.unpack(f"!{len(data) // CHUNK_HANDLE_SIZE}Q", data))
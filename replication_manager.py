@@ -0,0 +1,412 @@
+"""
+Re-replication and Rebalancing for the Master Server
+
+A background thread of the master periodically checks the replicas of every
+chunk and asks chunk servers to copy chunks to each other:
+
+- Chunks with fewer live replicas than the replication factor are copied to
+  another chunk server, the chunks with the fewest replicas left first
+- Chunks are moved from the chunk server storing the most chunks to the one
+  storing the fewest, so new or emptied servers fill up
+- Replicas beyond the replication factor (a failed server came back after
+  its chunks were re-replicated) are deleted from the fullest servers
+
+The master only sends COPY_CHUNK and DELETE_CHUNK requests, chunk data goes
+straight from one chunk server to another. Every chunk server takes part in
+at most max_copies_per_server copies at a time, each limited to an equal
+share of copy_bandwidth, so recovery traffic cannot starve client requests.
+"""
+
+import collections
+import threading
+import time
+
+import protocol
+from connection_pool import ConnectionPool, PoolExhaustedError
+
+# Seconds a failed chunk server's replicas still count before they are re-replicated,
+# a server that restarts within this time keeps its chunks
+DEFAULT_REPLICATION_DELAY = 30
+# Bytes per second one chunk server may send or receive for copies
+DEFAULT_COPY_BANDWIDTH = 16 * 1024 * 1024
+# Copies a chunk server sends or receives at the same time
+DEFAULT_MAX_COPIES_PER_SERVER = 2
+# Seconds between two checks of every chunk
+REPLICATION_INTERVAL = 1
+# Chunks checked per metadata lock acquisition, client requests run in between
+SCAN_BATCH = 10000
+# Chunks are moved while the fullest server stores this fraction of the
+# average chunk count more than the emptiest one (and at least REBALANCE_MIN_CHUNKS more)
+REBALANCE_THRESHOLD = 0.1
+REBALANCE_MIN_CHUNKS = 2
+
+
+class ReplicationManager:
+    """
+    Background re-replication and rebalancing of the chunks of a Main_Server
+
+    This class:
+    - Finds under-replicated, over-replicated and movable chunks
+    - Copies chunks between chunk servers, fewest replicas first
+    - Limits the concurrent copies and copy bandwidth of every chunk server
+    - Updates the chunk locations once a copy is done
+    """
+
+    def __init__(self, master, replication_delay=DEFAULT_REPLICATION_DELAY, copy_bandwidth=DEFAULT_COPY_BANDWIDTH,
+                 max_copies_per_server=DEFAULT_MAX_COPIES_PER_SERVER):
+        """
+        Initialize the replication manager
+
+        Args:
+            master (Main_Server): Master server whose chunks are managed
+            replication_delay (float): Seconds before the replicas of a failed chunk server are replaced
+            copy_bandwidth (int): Bytes per second a chunk server may use for copies, 0 for no limit
+            max_copies_per_server (int): Copies a chunk server takes part in at the same time
+        """
+        self.master = master
+        self.replication_delay = replication_delay
+        self.max_copies_per_server = max_copies_per_server
+        # Each copy gets an equal share, so a server never exceeds copy_bandwidth
+        self.copy_rate = max(1, copy_bandwidth // max_copies_per_server) if copy_bandwidth > 0 else 0
+        # Chunk server id -> copies it sends or receives, and the chunks being
+        # copied. Protected by master.metadata_lock
+        self.active_copies = collections.Counter()
+        self.copying = set()
+        # Replicas on servers not seen since the master started count as failed from then
+        self.started = time.monotonic()
+        # COPY_CHUNK is answered once the whole chunk was sent at copy_rate
+        copy_time = master.chunk_size / self.copy_rate if self.copy_rate else 0
+        self.connection_pool = ConnectionPool(socket_timeout=copy_time + 60)
+
+    def start(self):
+        """
+        Start a daemon thread checking the chunks every REPLICATION_INTERVAL seconds
+        """
+        def replicate_forever():
+            while True:
+                time.sleep(REPLICATION_INTERVAL)
+                try:
+                    self.run_once()
+                except Exception as e:
+                    print(f"Error checking chunk replicas: {e}")
+
+        threading.Thread(target=replicate_forever, daemon=True).start()
+
+    def run_once(self):
+        """
+        Check every chunk once and start the copies and deletions it needs
+
+        Returns:
+            int: Number of copies and deletions started
+        """
+        under_replicated, over_replicated, movable = self.scan()
+        copies, deletions = self.schedule(under_replicated, over_replicated, movable)
+        for copy in copies:
+            threading.Thread(target=self.copy_chunk, args=copy, daemon=True).start()
+        for deletion in deletions:
+            threading.Thread(target=self.delete_replica, args=deletion, daemon=True).start()
+        return len(copies) + len(deletions)
+
+    def counts_as_replica(self, chunk_server_id, now):
+        """
+        Return whether a replica location still counts. Must be called with metadata_lock held.
+
+        Args:
+            chunk_server_id (int): Chunk server of the replica
+            now (float): Current time.monotonic()
+        """
+        if chunk_server_id in self.master.chunk_servers:
+            return True
+        return now - self.master.failed_at.get(chunk_server_id, self.started) < self.replication_delay
+
+    def chunk_counts(self):
+        """
+        Return the reported chunk count of every live chunk server. Must be called with metadata_lock held.
+        """
+        return {
+            chunk_server_id: self.master.load_reports.get(chunk_server_id, {}).get('chunk_count', 0)
+            for chunk_server_id in self.master.chunk_servers
+        }
+
+    def scan(self):
+        """
+        Find the chunks with too few or too many replicas, and chunks to rebalance
+
+        Chunks are checked SCAN_BATCH at a time, the metadata lock is released
+        in between. Only a few chunks that can move from the fullest to the
+        emptiest chunk server are kept, schedule_moves checks them again.
+
+        Returns:
+            tuple: ([(replica count, chunk_handle), ...] of under-replicated chunks,
+                    [chunk_handle, ...] of chunks with more live replicas than needed,
+                    [chunk_handle, ...] of chunks that can be moved)
+        """
+        master = self.master
+        with master.metadata_lock:
+            chunk_handles = list(master.chunks)
+            rebalance = self.rebalance_pair(self.chunk_counts())
+
+        under_replicated, over_replicated, movable = [], [], []
+        for start in range(0, len(chunk_handles), SCAN_BATCH):
+            with master.metadata_lock:
+                now = time.monotonic()
+                for chunk_handle in chunk_handles[start:start + SCAN_BATCH]:
+                    chunk = master.chunks.get(chunk_handle)
+                    if chunk is None or chunk_handle in self.copying:
+                        continue
+                    if (rebalance is not None and len(movable) < self.max_copies_per_server
+                            and rebalance[0] in chunk.locations and rebalance[1] not in chunk.locations
+                            and not self.is_mutating(chunk_handle, now)):
+                        movable.append(chunk_handle)
+                    live = sum(1 for chunk_server_id in chunk.locations if chunk_server_id in master.chunk_servers)
+                    replicas = sum(1 for chunk_server_id in chunk.locations if self.counts_as_replica(chunk_server_id, now))
+                    # Chunks without a live replica cannot be copied until one comes back
+                    if live and replicas < master.replication_factor:
+                        under_replicated.append((replicas, chunk_handle))
+                    elif live > master.replication_factor:
+                        over_replicated.append(chunk_handle)
+        return under_replicated, over_replicated, movable
+
+    def schedule(self, under_replicated, over_replicated, movable):
+        """
+        Choose the copies and deletions to start now
+
+        Args:
+            under_replicated (list): (replica count, chunk_handle) tuples from scan
+            over_replicated (list): Chunk handles from scan
+            movable (list): Chunk handles from scan that can be rebalanced
+
+        Returns:
+            tuple: (copy_chunk argument tuples, delete_replica argument tuples)
+        """
+        master = self.master
+        copies, deletions = [], []
+        with master.metadata_lock:
+            now = time.monotonic()
+            # Chunk count of every live server, updated as copies are planned
+            chunk_counts = self.chunk_counts()
+
+            # Chunks that lost the most replicas are copied first
+            for _, chunk_handle in sorted(under_replicated):
+                chunk = master.chunks.get(chunk_handle)
+                if chunk is None or self.is_mutating(chunk_handle, now):
+                    continue
+                source = self.choose_source(chunk.locations)
+                target = self.choose_target(chunk.locations, chunk_counts)
+                if source is not None and target is not None:
+                    copies.append(self.reserve_copy(chunk_handle, source, target, False, chunk_counts))
+
+            for chunk_handle in over_replicated:
+                chunk = master.chunks.get(chunk_handle)
+                if chunk is None or chunk_handle in self.copying or self.is_mutating(chunk_handle, now):
+                    continue
+                live = [chunk_server_id for chunk_server_id in chunk.locations if chunk_server_id in master.chunk_servers]
+                victim = max(live, key=lambda chunk_server_id: (chunk_counts[chunk_server_id], chunk_server_id))
+                chunk.remove_location(victim)
+                chunk_counts[victim] -= 1
+                deletions.append((chunk_handle, victim, self.address(victim)))
+
+            # Only rebalance once redundancy is restored and earlier moves are done
+            if not copies and not deletions and not self.copying:
+                copies = self.schedule_moves(movable, chunk_counts, now)
+        return copies, deletions
+
+    def rebalance_pair(self, chunk_counts):
+        """
+        Return the chunk servers to move chunks between. Must be called with metadata_lock held.
+
+        Args:
+            chunk_counts (dict): Chunk count of every live chunk server
+
+        Returns:
+            tuple: (fullest, emptiest) chunk server ids, or None while the chunks are balanced
+        """
+        master = self.master
+        reported = [chunk_server_id for chunk_server_id in chunk_counts if chunk_server_id in master.load_reports]
+        if len(reported) < 2:
+            return None
+        fullest = max(reported, key=lambda chunk_server_id: (chunk_counts[chunk_server_id], chunk_server_id))
+        emptiest = min(reported, key=lambda chunk_server_id: (chunk_counts[chunk_server_id], chunk_server_id))
+        average = sum(chunk_counts[chunk_server_id] for chunk_server_id in reported) / len(reported)
+        threshold = max(REBALANCE_MIN_CHUNKS, REBALANCE_THRESHOLD * average)
+        if chunk_counts[fullest] - chunk_counts[emptiest] <= threshold:
+            return None
+        if master.load_reports[emptiest].get('disk_free', master.chunk_size) < master.chunk_size:
+            return None
+        return fullest, emptiest
+
+    def schedule_moves(self, movable, chunk_counts, now):
+        """
+        Choose chunks to move from the fullest chunk server to the emptiest one.
+        Must be called with metadata_lock held.
+
+        Args:
+            movable (list): Chunk handles found by scan, checked again here
+            chunk_counts (dict): Chunk count of every live chunk server
+            now (float): Current time.monotonic()
+
+        Returns:
+            list: copy_chunk argument tuples
+        """
+        rebalance = self.rebalance_pair(chunk_counts)
+        if rebalance is None:
+            return []
+        fullest, emptiest = rebalance
+
+        moves = []
+        for chunk_handle in movable[:self.max_copies_per_server]:
+            chunk = self.master.chunks.get(chunk_handle)
+            if (chunk is not None and fullest in chunk.locations and emptiest not in chunk.locations
+                    and not self.is_mutating(chunk_handle, now)):
+                moves.append(self.reserve_copy(chunk_handle, fullest, emptiest, True, chunk_counts))
+        return moves
+
+    def is_mutating(self, chunk_handle, now):
+        """
+        Return whether a chunk has a primary, a copy would miss its writes.
+        Must be called with metadata_lock held.
+
+        Args:
+            chunk_handle (int): Handle of the chunk
+            now (float): Current time.monotonic()
+        """
+        return self.master.lease_holder(("chunk", chunk_handle), now) is not None
+
+    def has_free_slot(self, chunk_server_id):
+        """
+        Return whether a live chunk server can take part in another copy.
+        Must be called with metadata_lock held.
+        """
+        return (chunk_server_id in self.master.chunk_servers
+                and self.active_copies[chunk_server_id] < self.max_copies_per_server)
+
+    def choose_source(self, locations):
+        """
+        Choose the least loaded live replica with a free copy slot. Must be called with metadata_lock held.
+
+        Args:
+            locations (tuple): Chunk server ids storing the chunk
+
+        Returns:
+            int: Chunk server id, or None if every replica is busy or failed
+        """
+        candidates = [chunk_server_id for chunk_server_id in locations if self.has_free_slot(chunk_server_id)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda chunk_server_id: (self.master.load_scores.get(chunk_server_id, 0), chunk_server_id))
+
+    def choose_target(self, locations, chunk_counts):
+        """
+        Choose the live chunk server with the fewest chunks that can receive a copy.
+        Must be called with metadata_lock held.
+
+        Args:
+            locations (tuple): Chunk server ids storing the chunk, failed ones included
+            chunk_counts (dict): Chunk count of every live chunk server
+
+        Returns:
+            int: Chunk server id, or None if no server has room and a free copy slot
+        """
+        master = self.master
+        candidates = [
+            chunk_server_id for chunk_server_id in master.chunk_servers
+            if chunk_server_id not in locations and self.has_free_slot(chunk_server_id)
+            and master.load_reports.get(chunk_server_id, {}).get('disk_free', master.chunk_size) >= master.chunk_size
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda chunk_server_id: (chunk_counts[chunk_server_id], chunk_server_id))
+
+    def reserve_copy(self, chunk_handle, source, target, move, chunk_counts):
+        """
+        Take the copy slots of a planned copy. Must be called with metadata_lock held.
+
+        Args:
+            chunk_handle (int): Handle of the chunk
+            source (int): Chunk server sending the copy
+            target (int): Chunk server receiving the copy
+            move (bool): Whether the source replica is deleted once the copy is done
+            chunk_counts (dict): Chunk count of every live chunk server, updated
+
+        Returns:
+            tuple: copy_chunk arguments
+        """
+        self.copying.add(chunk_handle)
+        self.active_copies[source] += 1
+        self.active_copies[target] += 1
+        chunk_counts[target] += 1
+        if move:
+            chunk_counts[source] -= 1
+        return chunk_handle, source, target, self.address(source), self.address(target), move
+
+    def address(self, chunk_server_id):
+        """
+        Return the (ip, port) of a live chunk server. Must be called with metadata_lock held.
+        """
+        data = self.master.chunk_servers[chunk_server_id]
+        return data['ip'], data['port']
+
+    def copy_chunk(self, chunk_handle, source, target, source_address, target_address, move):
+        """
+        Ask a chunk server to copy a chunk to another one and record the new replica
+
+        A chunk that got a primary while it was copied may have been written
+        meanwhile, the copy is then deleted and made again later.
+
+        Args:
+            chunk_handle (int): Handle of the chunk
+            source (int): Chunk server sending the copy
+            target (int): Chunk server receiving the copy
+            source_address (tuple): (ip, port) of the source
+            target_address (tuple): (ip, port) of the target
+            move (bool): Whether the source replica is deleted once the copy is done
+        """
+        reason = "Moving" if move else "Re-replicating"
+        print(f"{reason} chunk {chunk_handle} from Chunk Server {source} to Chunk Server {target}")
+        started = time.monotonic()
+        try:
+            response, _ = self.connection_pool.request(
+                source_address, protocol.COPY_CHUNK, chunk_handle, self.copy_rate, *target_address
+            )
+        except (OSError, protocol.ProtocolError, PoolExhaustedError) as e:
+            print(f"Error copying chunk {chunk_handle} from Chunk Server {source}: {e}")
+            response = None
+
+        master = self.master
+        with master.metadata_lock:
+            self.copying.discard(chunk_handle)
+            self.active_copies[source] -= 1
+            self.active_copies[target] -= 1
+            chunk = master.chunks.get(chunk_handle)
+            lease = master.leases.get(("chunk", chunk_handle))
+            stale = chunk is None or (lease is not None and lease[1] > started)
+            if response == protocol.CHUNK_WRITTEN and not stale:
+                chunk.add_location(target)
+                if move:
+                    chunk.remove_location(source)
+
+        if response != protocol.CHUNK_WRITTEN:
+            print(f"Copy of chunk {chunk_handle} to Chunk Server {target} failed: "
+                  f"{protocol.opcode_name(response) if response is not None else 'no response'}")
+        elif stale:
+            # Removed or written while it was copied
+            self.delete_replica(chunk_handle, target, target_address)
+        else:
+            print(f"Chunk {chunk_handle} copied to Chunk Server {target}")
+            if move:
+                self.delete_replica(chunk_handle, source, source_address)
+
+    def delete_replica(self, chunk_handle, chunk_server_id, address):
+        """
+        Ask a chunk server to delete its replica of a chunk
+
+        Args:
+            chunk_handle (int): Handle of the chunk
+            chunk_server_id (int): Chunk server storing the replica
+            address (tuple): (ip, port) of that chunk server
+        """
+        try:
+            response, _ = self.connection_pool.request(address, protocol.DELETE_CHUNK, chunk_handle)
+            print(f"Deleted chunk {chunk_handle} from Chunk Server {chunk_server_id}: {protocol.opcode_name(response)}")
+        except (OSError, protocol.ProtocolError, PoolExhaustedError) as e:
+            print(f"Error deleting chunk {chunk_handle} from Chunk Server {chunk_server_id}: {e}")
@@ -0,0 +1,468 @@
+"""
+Packed Small-File Storage for Chunk Servers
+
+Storing every small file as a file of its own spends an inode, a directory
+entry and a path lookup per file, which dominates with millions of tiny
+files. The segment store packs them into large append-only segment files
+(the Haystack layout) and keeps an in-memory index of where every file is:
+
+    segments/segment_<n>   file contents ("needles") appended back to back
+    segments/index         append-only log of index records, replayed at startup
+
+    +---------+---------------+------------+--------+--------+----------------+------+-------------+
+    | op (u8) | name length   | segment id | offset | length | checksum count | name | checksums   |
+    |         | (u16)         | (u32)      | (u64)  | (u64)  | (u32)          |      | (u32 each)  |
+    +---------+---------------+------------+--------+--------+----------------+------+-------------+
+
+A write appends the content to the active segment and one record to the
+index; a read is a single pread() or sendfile() at a known offset, no path
+is looked up. Needles are never changed in place: a rewritten file gets a
+new needle and a deleted file a DELETE record (tombstone), the old needle
+becomes dead space. A background compactor copies the live needles out of
+segments that are mostly dead and removes those segments.
+
+Segments and the index are fsynced in batches every sync_interval seconds,
+and a compacted segment is only removed once the copies of its needles are
+on disk. Readers keep their own descriptor of the segment, so a segment
+removed by the compactor stays readable until they are done.
+"""
+
+import os
+import struct
+import threading
+import time
+
+# Size a segment grows to before the next needle starts a new one
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+# Seconds between two flushes of the written segments and the index
+DEFAULT_SYNC_INTERVAL = 0.05
+# Fraction of a segment that must be dead before it is compacted
+DEFAULT_COMPACT_RATIO = 0.5
+# Seconds between two compaction passes
+COMPACTION_INTERVAL = 10
+# Index records beyond twice the live files (and at least this many) trigger a rewrite of the index
+COMPACT_MIN_RECORDS = 100000
+
+# Index record header and operations
+RECORD_HEADER = struct.Struct("!BHIQQI")
+PUT = 1
+DELETE = 2
+
+
+class Segment:
+    """
+    One append-only segment file
+    """
+
+    __slots__ = ('segment_id', 'path', 'fd', 'size')
+
+    def __init__(self, segment_id, path):
+        self.segment_id = segment_id
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+
+
+class Needle:
+    """
+    Location and block checksums of one stored content
+    """
+
+    __slots__ = ('segment_id', 'offset', 'length', 'checksums', 'version')
+
+    def __init__(self, segment_id, offset, length, checksums, version):
+        self.segment_id = segment_id
+        self.offset = offset
+        self.length = length
+        self.checksums = checksums
+        self.version = version
+
+
+class SegmentRegion:
+    """
+    A packed file opened for reading
+
+    Used like the file returned by open(): the content starts at byte base of
+    the segment behind fileno(), so it can be sent with sendfile().
+    """
+
+    def __init__(self, fd, needle):
+        self.fd = fd
+        self.base = needle.offset
+        self.size = needle.length
+        self.checksums = needle.checksums
+        self.version = needle.version
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """
+        Return the whole content with one pread()
+        """
+        return os.pread(self.fd, self.size, self.base)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SegmentStore:
+    """
+    File name -> needle in an append-only segment file
+
+    This class:
+    - Appends file contents to the active segment and rolls over to a new one
+    - Logs every put and delete (tombstone) to the index and replays it at startup
+    - Lets several names share a needle, used to keep previous versions without copying
+    - Flushes the written segments and the index in batches
+    - Compacts segments whose needles are mostly dead
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, sync_interval=DEFAULT_SYNC_INTERVAL,
+                 compact_ratio=DEFAULT_COMPACT_RATIO):
+        """
+        Open the segment store, replaying its index
+
+        Args:
+            directory (str): Directory holding the segments and the index
+            segment_size (int): Size a segment grows to before a new one is started
+            sync_interval (float): Seconds between two flushes to disk
+            compact_ratio (float): Fraction of dead bytes at which a segment is compacted
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.compact_ratio = compact_ratio
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        # Only one flush at a time, segments are not removed during a flush
+        self.sync_lock = threading.Lock()
+        # Segment id -> Segment, needles are appended to the one with the highest id
+        self.segments = {}
+        # File name -> Needle
+        self.index = {}
+        # Segment id -> names whose needle is in that segment, and the bytes of those needles
+        self.segment_names = {}
+        self.live_bytes = {}
+        self.next_version = 1
+        self.dirty_segments = set()
+        self.index_dirty = False
+        self.index_records = 0
+
+        for name in os.listdir(directory):
+            if name.startswith("segment_") and name[len("segment_"):].isdigit():
+                segment_id = int(name[len("segment_"):])
+                self.segments[segment_id] = Segment(segment_id, os.path.join(directory, name))
+        self.index_path = os.path.join(directory, "index")
+        self.replay_index()
+        self.index_fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def replay_index(self):
+        """
+        Rebuild the in-memory index from the index file
+        """
+        try:
+            with open(self.index_path, 'rb') as index_file:
+                data = index_file.read()
+        except FileNotFoundError:
+            data = b""
+
+        index = {}
+        position = 0
+        while position + RECORD_HEADER.size <= len(data):
+            op, name_length, segment_id, offset, length, count = RECORD_HEADER.unpack_from(data, position)
+            name_start = position + RECORD_HEADER.size
+            end = name_start + name_length + count * 4
+            if end > len(data):
+                break  # Torn last record
+            name = data[name_start:name_start + name_length].decode()
+            if op == PUT and segment_id in self.segments:
+                checksums = struct.unpack_from(f"!{count}I", data, name_start + name_length)
+                index[name] = Needle(segment_id, offset, length, checksums, 0)
+            else:
+                index.pop(name, None)
+            self.index_records += 1
+            position = end
+        if position < len(data):
+            with open(self.index_path, 'r+b') as index_file:
+                index_file.truncate(position)
+
+        for segment_id in self.segments:
+            self.segment_names[segment_id] = set()
+            self.live_bytes[segment_id] = 0
+        for name, needle in index.items():
+            needle.version = self.take_version()
+            self.index[name] = needle
+            self.add_name(name, needle)
+        print(f"Segment store opened: {len(self.index)} files in {len(self.segments)} segment(s).")
+
+    def take_version(self):
+        """
+        Return a new version number, must be called with lock held
+        """
+        version = self.next_version
+        self.next_version += 1
+        return version
+
+    def add_name(self, name, needle):
+        """
+        Count a name as a reference to its needle, must be called with lock held
+
+        A needle shared by several names counts once per name, which can only
+        delay the compaction of its segment.
+        """
+        self.segment_names[needle.segment_id].add(name)
+        self.live_bytes[needle.segment_id] += needle.length
+
+    def remove_name(self, name, needle):
+        """
+        Drop the reference of a name to its needle, must be called with lock held
+        """
+        self.segment_names[needle.segment_id].discard(name)
+        self.live_bytes[needle.segment_id] -= needle.length
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.index
+
+    def append_needle(self, data):
+        """
+        Append content to the active segment, must be called with lock held
+
+        Returns:
+            tuple: (segment_id, offset) of the content
+        """
+        segment = self.segments[max(self.segments)] if self.segments else None
+        if segment is None or (segment.size and segment.size + len(data) > self.segment_size):
+            segment_id = max(self.segments) + 1 if self.segments else 0
+            segment = self.segments[segment_id] = Segment(
+                segment_id, os.path.join(self.directory, f"segment_{segment_id}")
+            )
+            self.segment_names[segment_id] = set()
+            self.live_bytes[segment_id] = 0
+        offset = segment.size
+        os.pwrite(segment.fd, data, offset)
+        segment.size += len(data)
+        self.dirty_segments.add(segment.segment_id)
+        return segment.segment_id, offset
+
+    def set_needle(self, name, needle):
+        """
+        Point a name at a needle and log it, must be called with lock held
+        """
+        previous = self.index.get(name)
+        if previous is not None:
+            self.remove_name(name, previous)
+        self.index[name] = needle
+        self.add_name(name, needle)
+        self.log_record(PUT, name, needle)
+
+    def put(self, name, data, checksums):
+        """
+        Store the whole content of a file, replacing the previous one
+
+        Must be called with the write lock of the file held.
+
+        Args:
+            name (str): Name of the file
+            data (bytes): File content
+            checksums (list): Block checksums of data
+        """
+        with self.lock:
+            segment_id, offset = self.append_needle(data)
+            self.set_needle(name, Needle(segment_id, offset, len(data), tuple(checksums), self.take_version()))
+
+    def link(self, name, new_name):
+        """
+        Make new_name refer to the current content of name without copying it
+
+        Args:
+            name (str): Name of a stored file
+            new_name (str): Name that gets the same content, replaced if it exists
+
+        Returns:
+            bool: Whether name was stored
+        """
+        with self.lock:
+            needle = self.index.get(name)
+            if needle is None:
+                return False
+            self.set_needle(new_name, needle)
+        return True
+
+    def delete(self, name):
+        """
+        Delete a file by logging a tombstone, its needle becomes dead space
+
+        Args:
+            name (str): Name of the file
+
+        Returns:
+            bool: Whether the file was stored
+        """
+        with self.lock:
+            needle = self.index.pop(name, None)
+            if needle is None:
+                return False
+            self.remove_name(name, needle)
+            self.log_record(DELETE, name)
+        return True
+
+    def open(self, name):
+        """
+        Open a file for reading, must be called with the lock of the file held
+
+        Args:
+            name (str): Name of the file
+
+        Returns:
+            SegmentRegion: Open file, or None if the file is not stored
+        """
+        with self.lock:
+            needle = self.index.get(name)
+            if needle is None:
+                return None
+            # A descriptor of its own keeps the segment readable if it is compacted away
+            return SegmentRegion(os.dup(self.segments[needle.segment_id].fd), needle)
+
+    def log_record(self, op, name, needle=None):
+        """
+        Append a record to the index, must be called with lock held
+        """
+        encoded = name.encode()
+        if needle is None:
+            record = RECORD_HEADER.pack(op, len(encoded), 0, 0, 0, 0) + encoded
+        else:
+            record = RECORD_HEADER.pack(
+                op, len(encoded), needle.segment_id, needle.offset, needle.length, len(needle.checksums)
+            ) + encoded + struct.pack(f"!{len(needle.checksums)}I", *needle.checksums)
+        os.write(self.index_fd, record)
+        self.index_records += 1
+        self.index_dirty = True
+
+    def sync(self):
+        """
+        Flush the segments written since the last sync, then the index
+        """
+        with self.sync_lock:
+            with self.lock:
+                dirty, self.dirty_segments = self.dirty_segments, set()
+                index_dirty, self.index_dirty = self.index_dirty, False
+            for segment_id in dirty:
+                os.fsync(self.segments[segment_id].fd)
+            if index_dirty:
+                os.fsync(self.index_fd)
+
+            if self.index_records > max(2 * len(self.index), COMPACT_MIN_RECORDS):
+                self.compact_index()
+
+    def compact_index(self):
+        """
+        Rewrite the index with one record per live file, must be called with sync_lock held
+        """
+        with self.lock:
+            with open(f"{self.index_path}.tmp", 'wb') as index_file:
+                for name, needle in self.index.items():
+                    encoded = name.encode()
+                    index_file.write(RECORD_HEADER.pack(
+                        PUT, len(encoded), needle.segment_id, needle.offset, needle.length, len(needle.checksums)
+                    ))
+                    index_file.write(encoded)
+                    index_file.write(struct.pack(f"!{len(needle.checksums)}I", *needle.checksums))
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            os.replace(f"{self.index_path}.tmp", self.index_path)
+            os.close(self.index_fd)
+            self.index_fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND)
+            self.index_records = len(self.index)
+        print(f"Segment index compacted to {len(self.index)} records.")
+
+    def compaction_candidates(self):
+        """
+        Return the ids of the full segments whose dead bytes reached compact_ratio
+        """
+        with self.lock:
+            active = max(self.segments) if self.segments else None
+            return [
+                segment_id for segment_id, segment in self.segments.items()
+                if segment_id != active and self.live_bytes[segment_id] <= (1 - self.compact_ratio) * segment.size
+            ]
+
+    def compact_segment(self, segment_id):
+        """
+        Copy the live needles of a segment to the active segment and remove it
+
+        Args:
+            segment_id (int): Id of a segment that is not the active one
+        """
+        segment = self.segments[segment_id]
+        with self.lock:
+            needles = {}
+            for name in self.segment_names[segment_id]:
+                needles.setdefault(id(self.index[name]), (self.index[name], []))[1].append(name)
+
+        moved = 0
+        for needle, names in needles.values():
+            # The segment is not written any more, it is read without the lock
+            data = os.pread(segment.fd, needle.length, needle.offset)
+            with self.lock:
+                # Names rewritten or deleted meanwhile are left alone
+                names = [name for name in names if self.index.get(name) is needle]
+                if not names:
+                    continue
+                new_segment_id, offset = self.append_needle(data)
+                copy = Needle(new_segment_id, offset, needle.length, needle.checksums, needle.version)
+                for name in names:
+                    self.set_needle(name, copy)
+            moved += len(data)
+
+        # The segment goes away only once the copies and their index records are on disk
+        self.sync()
+        with self.sync_lock, self.lock:
+            if self.segment_names[segment_id]:
+                return  # Written to meanwhile, compacted again by a later pass
+            del self.segments[segment_id]
+            del self.segment_names[segment_id]
+            del self.live_bytes[segment_id]
+            self.dirty_segments.discard(segment_id)
+            os.close(segment.fd)
+            os.remove(segment.path)
+        print(f"Segment {segment_id} compacted: {moved} live bytes of {segment.size} moved.")
+
+    def start_sync_thread(self):
+        """
+        Flush written files to disk every sync_interval seconds until the process exits
+        """
+        def sync_forever():
+            while True:
+                time.sleep(self.sync_interval)
+                try:
+                    self.sync()
+                except OSError as e:
+                    print(f"Error syncing segment store: {e}")
+
+        threading.Thread(target=sync_forever, daemon=True).start()
+
+    def start_compactor_thread(self):
+        """
+        Compact mostly dead segments every COMPACTION_INTERVAL seconds until the process exits
+        """
+        def compact_forever():
+            while True:
+                time.sleep(COMPACTION_INTERVAL)
+                for segment_id in self.compaction_candidates():
+                    try:
+                        self.compact_segment(segment_id)
+                    except OSError as e:
+                        print(f"Error compacting segment {segment_id}: {e}")
+
+        threading.Thread(target=compact_forever, daemon=True).start()
@@ -0,0 +1,50 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# The modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chunk_server1  # noqa: E402
+import master_server  # noqa: E402
+
+
+def serve_until_closed(server):
+    """
+    Run a blocking accept loop until its listening socket is closed
+    """
+    try:
+        server.start()
+    except OSError:
+        pass
+
+
+@pytest.fixture
+def master(tmp_path, monkeypatch):
+    """
+    Master server answering on a free port, its files in a temporary directory
+    """
+    # Chunk servers keep their directories relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    master = master_server.Main_Server(
+        "127.0.0.1", 0, metadata_file=str(tmp_path / "metadata.json"), log_file=str(tmp_path / "metadata.log")
+    )
+    threading.Thread(target=serve_until_closed, args=(master,), daemon=True).start()
+    yield master
+    master.server_socket.close()
+
+
+@pytest.fixture
+def chunk_server(master):
+    """
+    Chunk server registered with the master, not serving connections yet
+    """
+    # Background threads cannot be stopped, they stay idle until long after
+    # the test and its temporary directory are gone
+    chunk_server = chunk_server1.ChunkServer(
+        "127.0.0.1", 0, 1, "127.0.0.1", master.server_socket.getsockname()[1], heartbeat_interval=3600, scrub_rate=0
+    )
+    yield chunk_server
+    chunk_server.server_socket.close()
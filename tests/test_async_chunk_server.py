@@ -0,0 +1,147 @@
+import asyncio
+import threading
+
+import protocol
+from async_chunk_server import AsyncChunkServer
+
+
+def run_with_server(chunk_server, client, **options):
+    """
+    Serve chunk_server from an AsyncChunkServer while the client coroutine runs
+
+    Args:
+        chunk_server (ChunkServer): Chunk server to serve
+        client: Coroutine function called with the front end and the server address
+    """
+    front_end = AsyncChunkServer(chunk_server, **options)
+
+    async def run():
+        serving = asyncio.ensure_future(front_end.serve())
+        try:
+            await asyncio.sleep(0)
+            return await client(front_end, chunk_server.server_socket.getsockname())
+        finally:
+            serving.cancel()
+
+    try:
+        return asyncio.run(run())
+    finally:
+        front_end.executor.shutdown(wait=False)
+        front_end.read_executor.shutdown(wait=False)
+
+
+def store_file(chunk_server, file_name, data):
+    assert chunk_server.handle_request(protocol.CREATE_FILE, protocol.pack_fields(file_name))[0] == protocol.FILE_CREATED
+    response = chunk_server.handle_request(protocol.WRITE_FILE, protocol.pack_fields(file_name, data))
+    assert response[0] == protocol.FILE_WRITTEN
+
+
+def test_stalled_reader_releases_the_file_lock(chunk_server):
+    # Larger than the write buffers, the send stalls while the lock is held
+    store_file(chunk_server, "big", b"x" * (32 * 1024 * 1024))
+    chunk_server.timeout = 0.5
+
+    async def client(front_end, address):
+        reader, writer = await asyncio.open_connection(*address)
+        protocol.write_frame(writer, protocol.READ_FILE, 1, protocol.pack_fields("big"))
+        await writer.drain()
+        while not chunk_server.lock_manager.active_locks():
+            await asyncio.sleep(0.01)
+        loop = asyncio.get_running_loop()
+
+        def write_after_reader():
+            with chunk_server.lock_manager.write_lock(("file", "big"), timeout=5):
+                return True
+
+        # The client never reads, the lock comes back once the connection is dropped
+        acquired = await loop.run_in_executor(None, write_after_reader)
+        writer.close()
+        return acquired
+
+    assert run_with_server(chunk_server, client)
+    assert chunk_server.lock_manager.active_locks() == 0
+
+
+def test_pipelined_requests_are_answered_by_request_id(chunk_server):
+    files = {f"file{index}": f"content of file {index}".encode() for index in range(5)}
+    for file_name, data in files.items():
+        store_file(chunk_server, file_name, data)
+
+    async def client(front_end, address):
+        reader, writer = await asyncio.open_connection(*address)
+        # All requests are sent before the first response is read
+        requests = {100 + index: file_name for index, file_name in enumerate(files)}
+        for request_id, file_name in requests.items():
+            protocol.write_frame(writer, protocol.READ_FILE, request_id, protocol.pack_fields(file_name))
+        protocol.write_frame(writer, protocol.READ_FILE, 7, protocol.pack_fields("missing"))
+        await writer.drain()
+        responses = {}
+        for _ in range(len(requests) + 1):
+            opcode, request_id, payload = await asyncio.wait_for(protocol.read_frame(reader), 5)
+            responses[request_id] = (opcode, payload)
+        writer.close()
+        return requests, responses
+
+    requests, responses = run_with_server(chunk_server, client)
+    for request_id, file_name in requests.items():
+        assert responses[request_id] == (protocol.FILE_CONTENT, files[file_name])
+    assert responses[7][0] == protocol.FILE_NOT_FOUND
+
+
+def test_idle_connection_is_closed(chunk_server):
+    chunk_server.timeout = 0.2
+
+    async def client(front_end, address):
+        reader, writer = await asyncio.open_connection(*address)
+        protocol.write_frame(writer, protocol.CACHE_STATS, 1, b"")
+        await writer.drain()
+        answered = await asyncio.wait_for(protocol.read_frame(reader), 5)
+        # Nothing more is sent, the server closes the connection
+        closed = await asyncio.wait_for(protocol.read_frame(reader), 5)
+        writer.close()
+        return answered, closed, front_end.connection_count
+
+    answered, closed, connection_count = run_with_server(chunk_server, client)
+    assert answered[:2] == (protocol.OK, 1)
+    assert closed is None
+    assert connection_count == 0
+
+
+def test_pending_requests_limit_applies_backpressure(chunk_server, monkeypatch):
+    store_file(chunk_server, "small", b"small file")
+    handle_request = chunk_server.handle_request
+    release = threading.Event()
+
+    def blocking_handle_request(opcode, payload):
+        if opcode == protocol.CACHE_STATS:
+            release.wait(5)
+        return handle_request(opcode, payload)
+
+    monkeypatch.setattr(chunk_server, "handle_request", blocking_handle_request)
+
+    async def client(front_end, address):
+        busy_reader, busy_writer = await asyncio.open_connection(*address)
+        protocol.write_frame(busy_writer, protocol.CACHE_STATS, 1, b"")
+        await busy_writer.drain()
+        while not front_end.pending_requests.locked():
+            await asyncio.sleep(0.01)
+
+        # The only request slot is taken, a read on another connection waits for it
+        reader, writer = await asyncio.open_connection(*address)
+        protocol.write_frame(writer, protocol.READ_FILE, 2, protocol.pack_fields("small"))
+        await writer.drain()
+        read = asyncio.ensure_future(protocol.read_frame(reader))
+        await asyncio.sleep(0.3)
+        held_back = not read.done()
+
+        release.set()
+        busy = await asyncio.wait_for(protocol.read_frame(busy_reader), 5)
+        answered = await asyncio.wait_for(read, 5)
+        busy_writer.close()
+        writer.close()
+        return held_back, busy, answered
+
+    held_back, busy, answered = run_with_server(chunk_server, client, max_pending_requests=1)
+    assert held_back
+    assert busy[:2] == (protocol.OK, 1)
+    assert answered == (protocol.FILE_CONTENT, 2, b"small file")
@@ -0,0 +1,51 @@
+import asyncio
+import socket
+import threading
+
+import protocol
+from async_master_server import AsyncMasterServer
+
+
+class BusyMaster:
+    """
+    Blocks every request except heartbeats until released
+    """
+
+    def __init__(self):
+        self.server_socket = socket.create_server(("127.0.0.1", 0))
+        self.released = threading.Event()
+
+    def handle_request(self, opcode, payload):
+        if opcode != protocol.HEARTBEAT:
+            self.released.wait(5)
+        return protocol.OK, payload
+
+
+def test_heartbeats_do_not_wait_for_busy_workers():
+    master = BusyMaster()
+    front_end = AsyncMasterServer(master, max_workers=1, max_pending_requests=1)
+
+    async def exchange():
+        serving = asyncio.ensure_future(front_end.serve())
+        try:
+            reader, writer = await asyncio.open_connection(*master.server_socket.getsockname())
+            protocol.write_frame(writer, protocol.LIST_DIRECTORY, 1, b"/")
+            protocol.write_frame(writer, protocol.HEARTBEAT, 2, b"beat")
+            await writer.drain()
+            first = await asyncio.wait_for(protocol.read_frame(reader), 2)
+            master.released.set()
+            second = await asyncio.wait_for(protocol.read_frame(reader), 2)
+            writer.close()
+            return first, second
+        finally:
+            serving.cancel()
+
+    try:
+        first, second = asyncio.run(exchange())
+    finally:
+        master.released.set()
+        front_end.executor.shutdown(wait=False)
+        front_end.heartbeat_executor.shutdown(wait=False)
+        master.server_socket.close()
+    assert first == (protocol.OK, 2, b"beat")
+    assert second == (protocol.OK, 1, b"/")
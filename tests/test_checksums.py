@@ -0,0 +1,88 @@
+import os
+import zlib
+
+import pytest
+
+import checksums
+from checksums import BLOCK_SIZE, BlockChecksums, ChecksumError, block_checksums
+
+
+def expected_checksums(data):
+    return [zlib.crc32(data[start:start + BLOCK_SIZE]) for start in range(0, len(data), BLOCK_SIZE)]
+
+
+@pytest.mark.parametrize("size", [0, 1, BLOCK_SIZE - 1, BLOCK_SIZE, BLOCK_SIZE + 1, 3 * BLOCK_SIZE + 17])
+@pytest.mark.parametrize("part_size", [1000, BLOCK_SIZE - 1, BLOCK_SIZE, BLOCK_SIZE + 1, 5 * BLOCK_SIZE])
+def test_parts_across_block_boundaries(size, part_size):
+    data = os.urandom(size)
+    running = BlockChecksums()
+    for start in range(0, size, part_size):
+        running.update(data[start:start + part_size])
+    assert running.finish() == expected_checksums(data) == block_checksums(data)
+
+
+def test_empty_parts_change_nothing():
+    running = BlockChecksums()
+    running.update(b"a" * BLOCK_SIZE)
+    running.update(b"")
+    running.update(memoryview(b"b"))
+    assert running.finish() == [zlib.crc32(b"a" * BLOCK_SIZE), zlib.crc32(b"b")]
+
+
+def test_verify_data():
+    data = os.urandom(2 * BLOCK_SIZE + 5)
+    stored = tuple(block_checksums(data))
+    checksums.verify_data(data, stored)
+    with pytest.raises(ChecksumError, match="block 1"):
+        checksums.verify_data(data[:BLOCK_SIZE] + b"x" + data[BLOCK_SIZE + 1:], stored)
+    with pytest.raises(ChecksumError):
+        checksums.verify_data(data[:BLOCK_SIZE], stored)
+
+
+@pytest.fixture
+def stored(tmp_path):
+    data = bytearray(os.urandom(4 * BLOCK_SIZE + 100))
+    data_path, checksum_path = tmp_path / "data", tmp_path / "data.crc"
+    data_path.write_bytes(data)
+    checksums.write_checksum_file(str(checksum_path), block_checksums(data))
+    return data, str(data_path), str(checksum_path)
+
+
+def test_read_verified_range(stored):
+    data, data_path, checksum_path = stored
+    stored_checksums = checksums.read_checksum_file(checksum_path)
+    with open(data_path, 'rb') as data_file:
+        fd = data_file.fileno()
+        blocks = list(checksums.read_verified_blocks(fd, len(data), stored_checksums, BLOCK_SIZE - 1, 2))
+        assert b"".join(blocks) == data[:2 * BLOCK_SIZE]
+        with open(data_path, 'r+b') as writer:
+            writer.seek(2 * BLOCK_SIZE + 7)
+            writer.write(b"\x00" if data[2 * BLOCK_SIZE + 7] else b"\x01")
+        # Only the blocks overlapping the range are checked
+        checksums.verify_range(fd, len(data), stored_checksums, 0, 2 * BLOCK_SIZE)
+        with pytest.raises(ChecksumError, match="block 2"):
+            checksums.verify_range(fd, len(data), stored_checksums, 2 * BLOCK_SIZE - 1, 2)
+
+
+def test_update_entries_after_in_place_write(stored):
+    data, data_path, checksum_path = stored
+    with open(data_path, 'r+b') as data_file, open(checksum_path, 'r+b') as checksum_file:
+        fd, checksum_fd = data_file.fileno(), checksum_file.fileno()
+        # Rewrite across a block boundary and grow the data past its last block
+        for offset, part in [(BLOCK_SIZE - 3, b"boundary"), (len(data) + 10, b"appended")]:
+            start = min(offset, len(data))
+            if offset > len(data):
+                data.extend(bytes(offset - len(data)))
+            data[offset:offset + len(part)] = part
+            os.pwrite(fd, part, offset)
+            checksums.update_checksum_entries(fd, len(data), checksum_fd, start, offset + len(part))
+            checksums.verify_blocks(fd, len(data), checksum_fd, [offset, offset + len(part)])
+    assert list(checksums.read_checksum_file(checksum_path)) == block_checksums(bytes(data))
+
+
+def test_verify_blocks_detects_a_short_checksum_file(stored):
+    data, data_path, checksum_path = stored
+    os.truncate(checksum_path, os.path.getsize(checksum_path) - checksums.CHECKSUM_SIZE)
+    with open(data_path, 'rb') as data_file, open(checksum_path, 'rb') as checksum_file:
+        with pytest.raises(ChecksumError):
+            checksums.verify_blocks(data_file.fileno(), len(data), checksum_file.fileno(), [0])
@@ -0,0 +1,98 @@
+import pytest
+
+import client1
+import protocol
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(client1.Client, "connect_to_master_server", lambda self: None)
+    return client1.Client("127.0.0.1", 5011, 1)
+
+
+def serve_chunks(monkeypatch, client, answers):
+    """
+    Answer READ_CHUNK from a table: address -> response opcode, remember the addresses asked
+    """
+    asked = []
+
+    def send_to_chunk_server(address, opcode, *fields):
+        asked.append(address)
+        response = answers[address]
+        if isinstance(response, Exception):
+            raise response
+        return response, [b"data"] if response == protocol.CHUNK_DATA else []
+
+    monkeypatch.setattr(client, "send_to_chunk_server", send_to_chunk_server)
+    return asked
+
+
+def test_no_replica_raises_io_error(client):
+    with pytest.raises(IOError, match="no live replica"):
+        client.choose_replica([])
+    with pytest.raises(IOError):
+        client.read_chunk_from_replicas(1, [])
+
+
+def test_located_chunk_without_replicas_is_not_read(client, monkeypatch):
+    monkeypatch.setattr(client, "locate_chunks", lambda *args: (1024, 1, [(1, [])]))
+    assert client.read_chunked_file("lost") is None
+    assert client.read_chunked_range("lost", 0, 10) is None
+
+
+def test_single_replica(client, monkeypatch):
+    replicas = [(1, "127.0.0.1", 6001)]
+    assert client.choose_replica(replicas) == 0
+    serve_chunks(monkeypatch, client, {("127.0.0.1", 6001): protocol.CHUNK_DATA})
+    assert client.read_chunk_from_replicas(1, replicas) == b"data"
+
+
+def test_two_choices_prefer_lower_latency(client):
+    replicas = [(1, "127.0.0.1", 6001), (2, "127.0.0.1", 6002)]
+    client.replica_latency[("127.0.0.1", 6001)] = 5.0
+    client.replica_latency[("127.0.0.1", 6002)] = 0.001
+    assert all(client.choose_replica(replicas) == 1 for _ in range(20))
+
+
+def test_many_replicas_choice_is_in_range(client):
+    replicas = [(i, "127.0.0.1", 6000 + i) for i in range(1, 6)]
+    assert {client.choose_replica(replicas) for _ in range(200)} <= set(range(5))
+
+
+def test_falls_back_to_other_replicas(client, monkeypatch):
+    replicas = [(1, "127.0.0.1", 6001), (2, "127.0.0.1", 6002), (3, "127.0.0.1", 6003)]
+    asked = serve_chunks(monkeypatch, client, {
+        ("127.0.0.1", 6001): ConnectionRefusedError("down"),
+        ("127.0.0.1", 6002): protocol.CHECKSUM_ERROR,
+        ("127.0.0.1", 6003): protocol.CHUNK_DATA,
+    })
+    for _ in range(10):
+        assert client.read_chunk_from_replicas(7, replicas) == b"data"
+    assert set(asked) == {("127.0.0.1", 6001), ("127.0.0.1", 6002), ("127.0.0.1", 6003)}
+
+
+def test_every_replica_failing_raises_io_error(client, monkeypatch):
+    replicas = [(1, "127.0.0.1", 6001), (2, "127.0.0.1", 6002)]
+    serve_chunks(monkeypatch, client, {
+        ("127.0.0.1", 6001): ConnectionRefusedError("down"),
+        ("127.0.0.1", 6002): protocol.CHUNK_NOT_FOUND,
+    })
+    with pytest.raises(IOError):
+        client.read_chunk_from_replicas(7, replicas)
+
+
+def test_single_chunk_is_read_from_every_replica(client, monkeypatch):
+    replicas = [(1, "127.0.0.1", 6001), (2, "127.0.0.1", 6002), (3, "127.0.0.1", 6003)]
+    content = bytes(range(40))
+    monkeypatch.setattr(client, "locate_chunks", lambda *args: (64, 1, [(9, replicas)]))
+    asked = []
+
+    def send_to_chunk_server(address, opcode, chunk_handle, offset, length):
+        asked.append(address)
+        return protocol.CHUNK_DATA, [content[offset:offset + length]]
+
+    monkeypatch.setattr(client, "send_to_chunk_server", send_to_chunk_server)
+    assert client.parallel_read_file("one-chunk", range_size=8) == content
+    # 8 ranges of the chunk, the last 3 past the end of the file
+    assert len(asked) == 8
+    assert set(asked) == {(ip, port) for _, ip, port in replicas}
@@ -0,0 +1,97 @@
+import socket
+import threading
+
+import pytest
+
+import protocol
+from connection_pool import ConnectionPool
+
+
+class DroppingServer:
+    """
+    Answers every request with OK, except those listed in drop which are read and then left unanswered
+    """
+
+    def __init__(self, drop=()):
+        self.drop = set(drop)
+        self.received = []
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.address = self.listener.getsockname()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    frame = protocol.recv_frame(connection)
+                except (OSError, protocol.ProtocolError):
+                    return
+                if frame is None:
+                    return
+                opcode, request_id, payload = frame
+                self.received.append(opcode)
+                if len(self.received) in self.drop:
+                    return  # The request was carried out, the response is lost
+                protocol.send_frame(connection, protocol.OK, request_id)
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.fixture
+def pool():
+    pool = ConnectionPool(socket_timeout=2)
+    yield pool
+    pool.close_all()
+
+
+def test_request_reuses_connection(pool):
+    server = DroppingServer()
+    try:
+        for _ in range(3):
+            assert pool.request(server.address, protocol.READ_FILE, "a")[0] == protocol.OK
+        assert pool.open_connections[server.address] == 1
+    finally:
+        server.close()
+
+
+def test_lost_response_is_not_replayed(pool):
+    server = DroppingServer(drop={2})
+    try:
+        pool.request(server.address, protocol.WRITE_AT, "a", 0, b"x")
+        with pytest.raises((OSError, protocol.ProtocolError)):
+            pool.request(server.address, protocol.RECORD_APPEND, "a", b"record")
+        assert server.received == [protocol.WRITE_AT, protocol.RECORD_APPEND]
+    finally:
+        server.close()
+
+
+def test_lost_response_is_retried_when_idempotent(pool):
+    server = DroppingServer(drop={2})
+    try:
+        pool.request(server.address, protocol.READ_FILE, "a")
+        assert pool.request(server.address, protocol.READ_FILE, "a", idempotent=True)[0] == protocol.OK
+        assert server.received == [protocol.READ_FILE] * 3
+    finally:
+        server.close()
+
+
+def test_connections_are_bounded(pool):
+    pool.max_connections_per_peer = 1
+    server = DroppingServer()
+    try:
+        sock, _ = pool.acquire(server.address)
+        with pytest.raises(Exception, match="No connection"):
+            pool.acquire(server.address, timeout=0.05)
+        pool.release(server.address, sock)
+        assert pool.acquire(server.address, timeout=0.05)[1] is True
+    finally:
+        server.close()
@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+import extent_store
+from checksums import block_checksums
+from extent_store import SLOT_ALIGNMENT, ExtentStore
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path / "extents")
+
+
+def put(store, chunk_handle, data):
+    store.put(chunk_handle, data, block_checksums(data))
+
+
+def read(store, chunk_handle):
+    region = store.open(chunk_handle)
+    if region is None:
+        return None
+    with region:
+        return region.read()
+
+
+def test_put_open_delete(directory):
+    store = ExtentStore(directory, 64 * 1024)
+    put(store, 1, b"first chunk")
+    with store.open(1) as region:
+        assert region.read() == b"first chunk"
+        assert region.checksums == tuple(block_checksums(b"first chunk"))
+        assert region.size == len(b"first chunk") and region.base % SLOT_ALIGNMENT == 0
+    version = store.version(1)
+    put(store, 1, b"replaced")
+    assert read(store, 1) == b"replaced" and store.version(1) != version
+    assert store.delete(1) and not store.delete(1)
+    assert read(store, 1) is None and store.handles() == []
+
+
+def test_replay_after_restart(directory):
+    store = ExtentStore(directory, 64 * 1024)
+    chunks = {handle: os.urandom(100 * handle) for handle in range(1, 20)}
+    for handle, data in chunks.items():
+        put(store, handle, data)
+    for handle in range(1, 20, 3):
+        store.delete(handle)
+        chunks.pop(handle)
+    store.sync()
+
+    reopened = ExtentStore(directory, 64 * 1024)
+    assert sorted(reopened.handles()) == sorted(chunks)
+    assert all(read(reopened, handle) == data for handle, data in chunks.items())
+    # The gaps left by deleted chunks are free again
+    put(reopened, 100, b"x" * 100)
+    assert read(reopened, 100) == b"x" * 100
+
+
+def test_torn_index_tail_is_dropped(directory):
+    store = ExtentStore(directory, 64 * 1024)
+    put(store, 1, b"kept")
+    store.sync()
+    with open(os.path.join(directory, "index"), "ab") as index_file:
+        index_file.write(extent_store.RECORD_HEADER.pack(extent_store.PUT, 2, 0, 512, 4, 1))
+    reopened = ExtentStore(directory, 64 * 1024)
+    assert reopened.handles() == [1] and read(reopened, 1) == b"kept"
+    put(reopened, 3, b"after")
+    reopened.sync()
+    assert read(ExtentStore(directory, 64 * 1024), 3) == b"after"
+
+
+def test_freed_slot_is_reused(directory):
+    store = ExtentStore(directory, 64 * 1024)
+    put(store, 1, b"a" * 1000)
+    put(store, 2, b"b" * 1000)
+    offset = store.index[1].offset
+    store.delete(1)
+    put(store, 3, b"c" * 900)
+    assert store.index[3].offset == offset
+    assert read(store, 2) == b"b" * 1000
+
+
+def test_open_slot_is_not_reused(directory):
+    store = ExtentStore(directory, 64 * 1024)
+    put(store, 1, b"a" * 1000)
+    put(store, 2, b"b" * 1000)
+    region = store.open(1)
+    store.delete(1)
+    put(store, 3, b"c" * 1000)
+    assert store.index[3].offset != region.base
+    assert region.read() == b"a" * 1000
+    region.close()
+    put(store, 4, b"d" * 1000)
+    assert store.index[4].offset == region.base
+
+
+def test_neighbouring_free_slots_are_merged(directory):
+    store = ExtentStore(directory, 64 * 1024)
+    for handle in range(1, 5):
+        put(store, handle, bytes([handle]) * SLOT_ALIGNMENT)
+    first = store.index[1].offset
+    store.delete(1)
+    store.delete(3)
+    store.delete(2)
+    assert store.free_capacities == [3 * SLOT_ALIGNMENT]
+    put(store, 5, b"e" * 3 * SLOT_ALIGNMENT)
+    assert store.index[5].offset == first
+    assert read(store, 4) == bytes([4]) * SLOT_ALIGNMENT
+
+
+def test_free_space_at_the_end_goes_back_to_the_extent(directory):
+    store = ExtentStore(directory, 64 * 1024)
+    put(store, 1, b"a" * SLOT_ALIGNMENT)
+    put(store, 2, b"b" * SLOT_ALIGNMENT)
+    store.delete(1)
+    store.delete(2)
+    assert store.free_capacities == [] and store.next_offset == 0
+
+
+def test_chunk_larger_than_an_extent(directory):
+    store = ExtentStore(directory, 4096)
+    data = os.urandom(10000)
+    put(store, 1, data)
+    put(store, 2, b"small")
+    assert read(store, 1) == data and read(store, 2) == b"small"
+    store.sync()
+    assert read(ExtentStore(directory, 4096), 1) == data
@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+from lock_manager import LockManager, LockTimeoutError, ReadWriteLock
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_readers_share_the_lock():
+    locks = LockManager()
+    with locks.read_lock("a"), locks.read_lock("a", timeout=0):
+        with pytest.raises(LockTimeoutError):
+            with locks.write_lock("a", timeout=0.01):
+                pass
+    with locks.write_lock("a", timeout=0):
+        pass
+
+
+def test_writer_excludes_readers_and_writers():
+    locks = LockManager()
+    with locks.write_lock("a"):
+        with pytest.raises(LockTimeoutError):
+            locks.acquire_read("a", timeout=0.01)
+        with pytest.raises(LockTimeoutError):
+            with locks.write_lock("a", timeout=0):
+                pass
+        # Other keys are independent
+        with locks.write_lock("b", timeout=0):
+            pass
+
+
+def test_waiting_writer_blocks_new_readers():
+    lock = ReadWriteLock()
+    assert lock.acquire_read()
+    writer_acquired = threading.Event()
+
+    def write():
+        assert lock.acquire_write(2)
+        writer_acquired.set()
+        lock.release_write()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    wait_until(lambda: lock.waiting_writers == 1)
+    # A steady stream of readers cannot starve the writer
+    assert not lock.acquire_read(timeout=0.01)
+    lock.release_read()
+    assert writer_acquired.wait(2)
+    writer.join()
+    assert lock.acquire_read(timeout=0)
+
+
+def test_writer_timeout_lets_readers_in():
+    lock = ReadWriteLock()
+    assert lock.acquire_read()
+    reader_acquired = threading.Event()
+    writer_gave_up = threading.Event()
+
+    def write():
+        assert not lock.acquire_write(0.05)
+        writer_gave_up.set()
+
+    def read():
+        assert lock.acquire_read(2)
+        reader_acquired.set()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    wait_until(lambda: lock.waiting_writers == 1)
+    reader = threading.Thread(target=read)
+    reader.start()
+    assert writer_gave_up.wait(2) and reader_acquired.wait(2)
+    writer.join()
+    reader.join()
+    assert lock.readers == 2
+
+
+def test_lock_entries_are_removed_when_idle():
+    locks = LockManager()
+    with locks.write_lock("a"):
+        with pytest.raises(LockTimeoutError):
+            locks.acquire_read("a", timeout=0)
+        assert locks.active_locks() == 1
+    assert locks.active_locks() == 0 and locks.waiting_count() == 0
+
+
+def test_read_lock_released_from_another_thread():
+    locks = LockManager()
+    locks.acquire_read("a")
+    releaser = threading.Thread(target=locks.release_read, args=("a",))
+    releaser.start()
+    releaser.join()
+    with locks.write_lock("a", timeout=0):
+        pass
+    assert locks.active_locks() == 0
+
+
+def test_waiting_count():
+    locks = LockManager()
+    started = threading.Event()
+
+    def wait_for_write():
+        started.set()
+        with locks.write_lock("a", timeout=2):
+            pass
+
+    with locks.read_lock("a"):
+        waiter = threading.Thread(target=wait_for_write)
+        waiter.start()
+        started.wait()
+        wait_until(lambda: locks.waiting_count() == 1)
+    waiter.join()
+    assert locks.waiting_count() == 0
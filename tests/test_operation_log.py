@@ -0,0 +1,119 @@
+import os
+
+import pytest
+
+import protocol
+from master_server import Main_Server
+from operation_log import RECORD_HEADER_SIZE, OperationLog, OperationLogError
+
+
+def open_log(path, segment=1):
+    log = OperationLog(path)
+    log.open(segment)
+    return log
+
+
+def break_log(log):
+    # The next write fails, as it would on a full or failed disk
+    log.segment_file = open(os.devnull, 'rb')
+
+
+def test_replay_in_order(tmp_path):
+    path = str(tmp_path / "metadata.log")
+    log = open_log(path)
+    sequences = [log.append(["mkdir", f"/d{i}"]) for i in range(5)]
+    log.wait(sequences[-1])
+    assert list(OperationLog(path).replay(1)) == [["mkdir", f"/d{i}"] for i in range(5)]
+
+
+def test_rotation_and_replay_from_a_segment(tmp_path):
+    path = str(tmp_path / "metadata.log")
+    log = open_log(path)
+    log.append(["mkdir", "/old"])
+    sequence, segment = log.rotate()
+    log.wait(log.append(["mkdir", "/new"]))
+    assert segment == 2 and log.segments() == [1, 2]
+    assert list(log.replay(segment)) == [["mkdir", "/new"]]
+    log.remove_segments_before(segment)
+    assert log.segments() == [2]
+
+
+@pytest.mark.parametrize("cut", [1, RECORD_HEADER_SIZE - 1, RECORD_HEADER_SIZE + 1, -1])
+def test_torn_tail_ends_replay(tmp_path, cut):
+    path = str(tmp_path / "metadata.log")
+    log = open_log(path)
+    log.append(["mkdir", "/kept"])
+    log.wait(log.append(["mkdir", "/torn"]))
+    size = os.path.getsize(f"{path}.1")
+    record_size = size // 2
+    with open(f"{path}.1", 'r+b') as segment_file:
+        segment_file.truncate(record_size + cut if cut > 0 else size + cut)
+    assert list(OperationLog(path).replay(1)) == [["mkdir", "/kept"]]
+
+
+def test_corrupt_record_ends_replay(tmp_path):
+    path = str(tmp_path / "metadata.log")
+    log = open_log(path)
+    log.append(["mkdir", "/kept"])
+    log.append(["mkdir", "/flipped"])
+    log.wait(log.append(["mkdir", "/after"]))
+    with open(f"{path}.1", 'r+b') as segment_file:
+        data = bytearray(segment_file.read())
+        data[data.index(b"flipped")] ^= 0xFF
+        segment_file.seek(0)
+        segment_file.write(data)
+    assert list(OperationLog(path).replay(1)) == [["mkdir", "/kept"]]
+
+
+def test_failed_write_is_reported(tmp_path):
+    log = open_log(str(tmp_path / "metadata.log"))
+    log.wait(log.append(["mkdir", "/a"]))
+    break_log(log)
+    with pytest.raises(OperationLogError):
+        log.wait(log.append(["mkdir", "/b"]))
+
+
+@pytest.fixture
+def master_files(tmp_path):
+    return {'metadata_file': str(tmp_path / "metadata.json"), 'log_file': str(tmp_path / "metadata.log")}
+
+
+def start_master(master_files):
+    master = Main_Server("127.0.0.1", 0, **master_files)
+    master.server_socket.close()
+    return master
+
+
+def test_master_recovers_after_torn_tail(master_files):
+    master = start_master(master_files)
+    for path in ("/a", "/a/b", "/c"):
+        assert master.make_directory(path) == (protocol.OK, b"")
+    assert master.rename("/c", "/a/c") == (protocol.OK, b"")
+    with open(f"{master_files['log_file']}.1", 'ab') as segment_file:
+        segment_file.write(b"\x00\x00\x01")
+
+    recovered = start_master(master_files)
+    assert recovered.namespace.list_directory("/a") == ["b/", "c/"]
+    assert recovered.operation_log.segment == 2
+    assert recovered.make_directory("/d") == (protocol.OK, b"")
+    assert start_master(master_files).namespace.list_directory("/") == ["a/", "d/"]
+
+
+def test_master_applies_nothing_when_the_log_fails(master_files):
+    master = start_master(master_files)
+    master.make_directory("/a")
+    break_log(master.operation_log)
+    response = master.handle_request(protocol.MAKE_DIRECTORY, protocol.pack_fields("/b"))
+    assert response == (protocol.OPERATION_LOG_ERROR, b"")
+    assert master.namespace.list_directory("/") == ["a/"]
+
+
+def test_master_logs_no_invalid_operation(master_files):
+    master = start_master(master_files)
+    master.make_directory("/a")
+    appended = master.operation_log.appended
+    response = master.handle_request(protocol.MAKE_DIRECTORY, protocol.pack_fields("/a"))
+    assert response[0] != protocol.OK
+    response = master.handle_request(protocol.RENAME, protocol.pack_fields("/missing", "/b"))
+    assert response[0] != protocol.OK
+    assert master.operation_log.appended == appended
@@ -0,0 +1,92 @@
+import asyncio
+import socket
+import struct
+import threading
+
+import pytest
+
+import protocol
+
+
+@pytest.fixture
+def socket_pair():
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+
+def test_fields_round_trip():
+    fields = ["name:with:colons", b"\x00\xff raw", 42, ""]
+    assert protocol.unpack_fields(protocol.pack_fields(*fields)) == [b"name:with:colons", b"\x00\xff raw", b"42", b""]
+    with pytest.raises(protocol.ProtocolError):
+        protocol.unpack_fields(protocol.pack_fields(b"cut short")[:-1])
+
+
+@pytest.mark.parametrize("size", [0, 10, protocol.SMALL_PAYLOAD_SIZE, 3 * protocol.DATA_PART_SIZE + 1])
+def test_frame_round_trip(socket_pair, size):
+    left, right = socket_pair
+    payload = bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+    sender = threading.Thread(target=protocol.send_frame, args=(left, protocol.WRITE_FILE, 7, payload))
+    sender.start()
+    assert protocol.recv_frame(right) == (protocol.WRITE_FILE, 7, payload)
+    sender.join()
+
+
+def test_clean_close_between_frames(socket_pair):
+    left, right = socket_pair
+    left.close()
+    assert protocol.recv_frame(right) is None
+
+
+def test_close_mid_frame(socket_pair):
+    left, right = socket_pair
+    left.sendall(protocol.pack_header(protocol.READ_FILE, 1, 100) + b"short")
+    left.close()
+    with pytest.raises(protocol.ProtocolError, match="after 5 of 100"):
+        protocol.recv_frame(right)
+
+
+def test_oversize_payload_is_rejected(socket_pair):
+    left, right = socket_pair
+    left.sendall(struct.pack(protocol.HEADER_FORMAT, protocol.WRITE_FILE, 1, protocol.MAX_PAYLOAD_SIZE + 1))
+    with pytest.raises(protocol.ProtocolError, match="exceeds"):
+        protocol.recv_frame(right)
+    with pytest.raises(protocol.ProtocolError):
+        protocol.unpack_header(struct.pack(protocol.HEADER_FORMAT, 1, 1, 1 << 32))
+
+
+def test_largest_chunk_fits_in_a_frame():
+    fields = protocol.pack_fields("a" * 1024, 1 << 60, b"")
+    assert protocol.MAX_CHUNK_SIZE + len(fields) <= protocol.MAX_PAYLOAD_SIZE
+
+
+def test_recv_exactly_grows_with_received_data(socket_pair):
+    left, right = socket_pair
+    left.sendall(b"a" * 100)
+    left.close()
+    # Announcing the largest payload does not allocate it before the data arrives
+    with pytest.raises(protocol.ProtocolError, match="after 100 of"):
+        protocol.recv_exactly(right, protocol.MAX_PAYLOAD_SIZE)
+
+
+def test_response_id_mismatch(socket_pair):
+    left, right = socket_pair
+    protocol.send_frame(left, protocol.OK, 2, protocol.pack_fields("x"))
+    with pytest.raises(protocol.ProtocolError):
+        protocol.recv_response(right, 1)
+
+
+def test_async_frames():
+    async def exchange():
+        reader = asyncio.StreamReader()
+        reader.feed_data(protocol.pack_header(protocol.READ_FILE, 3, 4) + b"data")
+        reader.feed_data(struct.pack(protocol.HEADER_FORMAT, protocol.WRITE_FILE, 4, protocol.MAX_PAYLOAD_SIZE + 1))
+        first = await protocol.read_frame(reader)
+        with pytest.raises(protocol.ProtocolError):
+            await protocol.read_frame(reader)
+        closed = asyncio.StreamReader()
+        closed.feed_eof()
+        return first, await protocol.read_frame(closed)
+
+    assert asyncio.run(exchange()) == ((protocol.READ_FILE, 3, b"data"), None)
@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+
+import pytest
+
+import protocol
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def append_concurrently(chunk_server, file_name, records):
+    """
+    Append every record from its own thread, return the threads and the responses
+    in record order, an exception raised by record_append in place of its response
+    """
+    responses = [None] * len(records)
+
+    def append(index):
+        try:
+            responses[index] = chunk_server.record_append(file_name, records[index])
+        except RuntimeError as e:
+            responses[index] = e
+
+    threads = [threading.Thread(target=append, args=(index,)) for index in range(len(records))]
+    for thread in threads:
+        thread.start()
+    return threads, responses
+
+
+def queued_appends(chunk_server, file_name):
+    with chunk_server.append_lock:
+        queue = chunk_server.append_queues.get(file_name)
+        return 0 if queue is None else len(queue['pending'])
+
+
+@pytest.fixture
+def batches(chunk_server, monkeypatch):
+    """
+    Sizes of the batches written by write_records, in order
+    """
+    sizes = []
+    write_records = chunk_server.write_records
+
+    def counting_write_records(file_name, batch):
+        sizes.append(len(batch))
+        write_records(file_name, batch)
+
+    monkeypatch.setattr(chunk_server, "write_records", counting_write_records)
+    return sizes
+
+
+def test_concurrent_appends_are_batched_at_disjoint_offsets(chunk_server, batches):
+    records = [bytes([index]) * (index + 1) for index in range(20)]
+    # The first append writes alone and waits for the lock, the others queue up behind it
+    with chunk_server.lock_manager.write_lock(("file", "log")):
+        threads, responses = append_concurrently(chunk_server, "log", records)
+        wait_until(lambda: queued_appends(chunk_server, "log") == len(records) - 1)
+    for thread in threads:
+        thread.join()
+
+    # The waiter that becomes the next writer writes the whole queue at once
+    assert batches == [1, len(records) - 1]
+    assert all(response == protocol.RECORD_APPENDED for response, _ in responses)
+    offsets = [int(protocol.unpack_fields(fields)[0]) for _, fields in responses]
+    ordered = sorted(zip(offsets, records))
+    position = 0
+    for offset, record in ordered:
+        assert offset == position
+        position += len(record)
+
+    with open(os.path.join(chunk_server.chunk_server_directory, "log"), "rb") as file:
+        content = file.read()
+    assert len(content) == position
+    for offset, record in zip(offsets, records):
+        assert content[offset:offset + len(record)] == record
+    # The queue is dropped once no append waits on it
+    assert chunk_server.append_queues == {}
+
+
+def test_appends_after_a_batch_continue_at_the_end(chunk_server):
+    first = chunk_server.record_append("log", b"first")
+    threads, responses = append_concurrently(chunk_server, "log", [b"a", b"bb", b"ccc"])
+    for thread in threads:
+        thread.join()
+    assert first == (protocol.RECORD_APPENDED, protocol.pack_fields(0))
+    offsets = sorted(int(protocol.unpack_fields(fields)[0]) for _, fields in responses)
+    assert offsets[0] == len(b"first")
+    assert chunk_server.record_append("log", b"last")[1] == protocol.pack_fields(len(b"firstabbccc"))
+
+
+def test_failed_write_fails_the_whole_batch(chunk_server, batches, monkeypatch):
+    def failing_write_in_place(key, fd, offset, data):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(chunk_server, "write_in_place", failing_write_in_place)
+    records = [b"record"] * 8
+    with chunk_server.lock_manager.write_lock(("file", "log")):
+        threads, responses = append_concurrently(chunk_server, "log", records)
+        wait_until(lambda: queued_appends(chunk_server, "log") == len(records) - 1)
+    for thread in threads:
+        thread.join()
+
+    assert batches == [1, len(records) - 1]
+    assert responses == [(protocol.COPY_ERROR, b"")] * len(records)
+    assert chunk_server.append_queues == {}
+
+
+def test_writer_failing_unexpectedly_answers_its_batch(chunk_server, monkeypatch):
+    write_records = chunk_server.write_records
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def crashing_write_records(file_name, batch):
+        if len(batch) > 1:
+            raise RuntimeError("crashed")
+        started.set()
+        proceed.wait(5)
+        write_records(file_name, batch)
+
+    monkeypatch.setattr(chunk_server, "write_records", crashing_write_records)
+    first, first_responses = append_concurrently(chunk_server, "log", [b"first"])
+    assert started.wait(5)
+    threads, responses = append_concurrently(chunk_server, "log", [b"a", b"b", b"c"])
+    wait_until(lambda: queued_appends(chunk_server, "log") == 3)
+    proceed.set()
+    for thread in first + threads:
+        thread.join()
+
+    assert first_responses == [(protocol.RECORD_APPENDED, protocol.pack_fields(0))]
+    # The writer of the second batch raised, the other appends of its batch get an error
+    crashed = [response for response in responses if isinstance(response, RuntimeError)]
+    assert len(crashed) == 1
+    assert [response for response in responses if response not in crashed] == [(protocol.COPY_ERROR, b"")] * 2
+    assert chunk_server.append_queues == {}
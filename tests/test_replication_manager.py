@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+from namespace import ChunkRecord
+from replication_manager import ReplicationManager
+
+
+class Master:
+    """
+    The parts of Main_Server the replication manager reads
+    """
+
+    chunk_size = 1024
+    replication_factor = 2
+
+    def __init__(self, chunk_counts, chunks):
+        self.metadata_lock = threading.Lock()
+        self.chunk_servers = {
+            chunk_server_id: {'ip': "127.0.0.1", 'port': 6000 + chunk_server_id} for chunk_server_id in chunk_counts
+        }
+        self.load_reports = {
+            chunk_server_id: {'chunk_count': count, 'disk_free': 1 << 30} for chunk_server_id, count in chunk_counts.items()
+        }
+        self.chunks = {chunk_handle: ChunkRecord(locations) for chunk_handle, locations in chunks.items()}
+        self.failed_at = {}
+        self.leases = {}
+
+    def lease_holder(self, key, now):
+        return self.leases.get(key)
+
+
+def test_moves_come_from_the_scan():
+    chunks = {chunk_handle: (1, 2) for chunk_handle in range(1, 11)}
+    master = Master({1: 10, 2: 10, 3: 0}, chunks)
+    master.leases[("chunk", 1)] = 2
+    manager = ReplicationManager(master, max_copies_per_server=2)
+    under_replicated, over_replicated, movable = manager.scan()
+    assert under_replicated == [] and over_replicated == []
+    # Only as many candidates as copies can start are kept, mutating chunks are skipped
+    assert movable == [2, 3]
+
+    master.chunks[2] = ChunkRecord((1, 3))
+    copies, deletions = manager.schedule(under_replicated, over_replicated, movable)
+    assert deletions == []
+    assert [(copy[0], copy[1], copy[2], copy[5]) for copy in copies] == [(3, 2, 3, True)]
+
+
+def test_balanced_servers_move_nothing():
+    master = Master({1: 5, 2: 5, 3: 4}, {1: (1, 2)})
+    manager = ReplicationManager(master)
+    assert manager.scan() == ([], [], [])
+    assert manager.schedule([], [], []) == ([], [])
+
+
+@pytest.mark.parametrize("copy_bandwidth, copy_rate", [(0, 0), (1, 1), (10, 5)])
+def test_copy_rate(copy_bandwidth, copy_rate):
+    manager = ReplicationManager(Master({1: 0}, {}), copy_bandwidth=copy_bandwidth, max_copies_per_server=2)
+    assert manager.copy_rate == copy_rate
+    assert manager.connection_pool.socket_timeout >= 60
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+import segment_store
+from checksums import block_checksums
+from segment_store import SegmentStore
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path / "segments")
+
+
+def put(store, name, data):
+    store.put(name, data, block_checksums(data))
+
+
+def read(store, name):
+    region = store.open(name)
+    if region is None:
+        return None
+    with region:
+        return region.read()
+
+
+def test_put_read_link_delete(directory):
+    store = SegmentStore(directory)
+    put(store, "a", b"first")
+    put(store, "a", b"second")
+    assert read(store, "a") == b"second"
+    assert store.link("a", "a.old") and not store.link("missing", "b")
+    put(store, "a", b"third")
+    assert read(store, "a.old") == b"second" and read(store, "a") == b"third"
+    assert store.delete("a") and not store.delete("a")
+    assert "a" not in store and read(store, "a") is None and "a.old" in store
+
+
+def test_replay_after_restart(directory):
+    store = SegmentStore(directory, segment_size=1024)
+    files = {f"f{i}": os.urandom(100 + i) for i in range(30)}
+    for name, data in files.items():
+        put(store, name, data)
+    store.delete("f3")
+    files.pop("f3")
+    store.link("f4", "g4")
+    files["g4"] = files["f4"]
+    store.sync()
+
+    reopened = SegmentStore(directory, segment_size=1024)
+    assert len(reopened.segments) > 1
+    assert all(read(reopened, name) == data for name, data in files.items())
+    assert "f3" not in reopened
+    with reopened.open("f5") as region:
+        assert region.checksums == tuple(block_checksums(files["f5"]))
+
+
+def test_torn_index_tail_is_dropped(directory):
+    store = SegmentStore(directory)
+    put(store, "kept", b"data")
+    store.sync()
+    with open(os.path.join(directory, "index"), "ab") as index_file:
+        index_file.write(segment_store.RECORD_HEADER.pack(segment_store.PUT, 4, 0, 0, 4, 1) + b"to")
+    reopened = SegmentStore(directory)
+    assert read(reopened, "kept") == b"data" and "torn" not in reopened
+    put(reopened, "after", b"more")
+    reopened.sync()
+    assert read(SegmentStore(directory), "after") == b"more"
+
+
+def test_compaction_moves_live_needles(directory):
+    store = SegmentStore(directory, segment_size=1000, compact_ratio=0.5)
+    for i in range(10):
+        put(store, f"f{i}", bytes([i]) * 300)
+    for i in range(1, 10, 2):
+        store.delete(f"f{i}")
+    # f0 and f2 live in the first segment with one deleted needle
+    store.delete("f2")
+    candidates = store.compaction_candidates()
+    assert 0 in candidates and max(store.segments) not in candidates
+    region = store.open("f0")
+    store.compact_segment(0)
+    assert 0 not in store.segments and not os.path.exists(os.path.join(directory, "segment_0"))
+    # A reader of the compacted segment keeps its content
+    with region:
+        assert region.read() == bytes([0]) * 300
+    assert read(store, "f0") == bytes([0]) * 300
+
+    reopened = SegmentStore(directory, segment_size=1000)
+    assert sorted(reopened.index) == ["f0", "f4", "f6", "f8"]
+    assert all(read(reopened, f"f{i}") == bytes([i]) * 300 for i in (0, 4, 6, 8))
+
+
+def test_index_compaction(directory):
+    store = SegmentStore(directory)
+    for i in range(5):
+        put(store, "same", bytes([i]) * 10)
+    store.sync()
+    store.compact_index()
+    assert store.index_records == 1
+    put(store, "other", b"x")
+    store.sync()
+    reopened = SegmentStore(directory)
+    assert read(reopened, "same") == bytes([4]) * 10 and read(reopened, "other") == b"x"
+    assert reopened.index_records == 2